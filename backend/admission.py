@@ -0,0 +1,206 @@
+"""Admission control for upstream GAIA calls.
+
+Every upstream completion (one per single-flight, see gaia_client) must hold
+a slot of the global limiter and of its assistant's limiter for as long as it
+runs, retries included. Callers that find no free slot wait in a FIFO queue:
+
+- the queue is bounded (GAIA_QUEUE_MAX waiters across all limiters); when it
+  is full the call is shed immediately with 503 + Retry-After;
+- a waiter gives up after min(GAIA_QUEUE_TIMEOUT, remaining call deadline),
+  and expired waiters are skipped when a slot is handed out.
+
+Limits are adaptive (AIMD): each successful call adds 1/limit, while a 429/503
+from upstream or a time-to-first-token above GAIA_LATENCY_TARGET multiplies
+the limit by GAIA_LIMIT_BACKOFF (at most once per GAIA_LIMIT_COOLDOWN
+seconds). The limit stays between GAIA_MIN_CONCURRENCY and the configured
+maximum. Queue depth, limits and shed counts are reported by stats() and
+backend.metrics.
+"""
+import asyncio
+import logging
+import os
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Deque, Dict, Optional, Tuple
+
+from fastapi import HTTPException
+
+from . import metrics, retry
+
+logger = logging.getLogger("admission")
+
+MAX_CONCURRENCY = int(os.getenv("GAIA_MAX_CONCURRENCY", "64"))
+ASSISTANT_CONCURRENCY = int(os.getenv("GAIA_ASSISTANT_CONCURRENCY", "16"))
+MIN_CONCURRENCY = int(os.getenv("GAIA_MIN_CONCURRENCY", "2"))
+QUEUE_MAX = int(os.getenv("GAIA_QUEUE_MAX", "256"))
+QUEUE_TIMEOUT = float(os.getenv("GAIA_QUEUE_TIMEOUT", "15"))
+SHED_RETRY_AFTER = int(os.getenv("GAIA_SHED_RETRY_AFTER", "2"))
+ADAPTIVE = os.getenv("GAIA_ADAPTIVE_LIMIT", "true").lower() in ("1", "true", "yes", "on")
+LATENCY_TARGET = float(os.getenv("GAIA_LATENCY_TARGET", "10"))
+LIMIT_BACKOFF = float(os.getenv("GAIA_LIMIT_BACKOFF", "0.7"))
+LIMIT_COOLDOWN = float(os.getenv("GAIA_LIMIT_COOLDOWN", "2"))
+
+metrics.register_histogram("gaia_admission_wait_seconds", (0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0))
+
+_queued = 0
+
+
+class _Shed(Exception):
+    def __init__(self, reason: str):
+        super().__init__(reason)
+        self.reason = reason
+
+
+class Limiter:
+    """FIFO concurrency limiter whose limit can change at runtime (event-loop only)."""
+
+    def __init__(self, name: str, max_limit: int):
+        self.name = name
+        self.max_limit = max(1, max_limit)
+        self.limit = float(self.max_limit)
+        self.in_use = 0
+        self._waiters: Deque[Tuple[asyncio.Future, float]] = deque()
+        self._last_decrease = 0.0
+
+    def capacity(self) -> int:
+        return max(1, int(self.limit))
+
+    async def acquire(self, deadline: retry.Deadline) -> None:
+        global _queued
+        if self.in_use < self.capacity() and not self._waiters:
+            self.in_use += 1
+            return
+        if _queued >= QUEUE_MAX:
+            raise _Shed("queue_full")
+        timeout = min(QUEUE_TIMEOUT, deadline.remaining())
+        if timeout <= 0:
+            raise _Shed("deadline")
+        fut = asyncio.get_running_loop().create_future()
+        waiter = (fut, time.monotonic() + timeout)
+        self._waiters.append(waiter)
+        _queued += 1
+        try:
+            await asyncio.wait_for(fut, timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError, _Shed) as e:
+            if fut.done() and not fut.cancelled() and fut.exception() is None:
+                self.release()  # 超时与分配同时发生：把刚拿到的名额交还
+            if isinstance(e, asyncio.CancelledError):
+                raise
+            raise _Shed(e.reason if isinstance(e, _Shed) else "timeout") from None
+        finally:
+            try:
+                self._waiters.remove(waiter)
+                _queued -= 1
+            except ValueError:
+                pass
+
+    def release(self) -> None:
+        self.in_use -= 1
+        self._wake()
+
+    def _wake(self) -> None:
+        global _queued
+        now = time.monotonic()
+        while self._waiters and self.in_use < self.capacity():
+            fut, expires = self._waiters.popleft()
+            _queued -= 1
+            if fut.done():
+                continue
+            if expires <= now:
+                fut.set_exception(_Shed("deadline"))
+                continue
+            self.in_use += 1
+            fut.set_result(None)
+
+    def feedback(self, throttled: bool, latency: Optional[float]) -> None:
+        if not ADAPTIVE:
+            return
+        now = time.monotonic()
+        if throttled or (latency is not None and latency > LATENCY_TARGET):
+            if now - self._last_decrease >= LIMIT_COOLDOWN:
+                self._last_decrease = now
+                self.limit = max(float(min(MIN_CONCURRENCY, self.max_limit)), self.limit * LIMIT_BACKOFF)
+                metrics.inc("gaia_admission_limit_decreases_total", scope=self.name)
+                logger.info("Admission limit %s lowered to %.1f", self.name, self.limit)
+        elif latency is not None:
+            self.limit = min(float(self.max_limit), self.limit + 1.0 / self.limit)
+            self._wake()
+
+    def stats(self) -> dict:
+        return {"limit": round(self.limit, 2), "in_flight": self.in_use, "queued": len(self._waiters)}
+
+
+_global = Limiter("global", MAX_CONCURRENCY)
+_assistants: Dict[str, Limiter] = {}
+
+
+def _limiter_for(assistantid: Optional[str]) -> Limiter:
+    key = assistantid or ""
+    lim = _assistants.get(key)
+    if lim is None:
+        lim = _assistants[key] = Limiter("assistant", ASSISTANT_CONCURRENCY)
+    return lim
+
+
+class Slot:
+    """Held while one upstream call runs; report() feeds the adaptive limits."""
+
+    __slots__ = ("_limiters",)
+
+    def __init__(self, limiters):
+        self._limiters = limiters
+
+    def report(self, throttled: bool = False, latency: Optional[float] = None) -> None:
+        for lim in self._limiters:
+            lim.feedback(throttled, latency)
+
+
+@asynccontextmanager
+async def slot(assistantid: Optional[str], deadline: retry.Deadline) -> AsyncIterator[Slot]:
+    """Admit one upstream call or raise HTTPException(503) with Retry-After."""
+    acquired = []
+    t0 = time.monotonic()
+    try:
+        for lim in (_limiter_for(assistantid), _global):
+            await lim.acquire(deadline)
+            acquired.append(lim)
+    except _Shed as e:
+        for lim in reversed(acquired):
+            lim.release()
+        metrics.inc("gaia_admission_shed_total", reason=e.reason)
+        logger.warning("Shedding GAIA call for assistant %s: %s", assistantid, e.reason)
+        raise HTTPException(
+            status_code=503,
+            detail="服务繁忙，请稍后再试。",
+            headers={"Retry-After": str(SHED_RETRY_AFTER)},
+        ) from None
+    except BaseException:
+        for lim in reversed(acquired):
+            lim.release()
+        raise
+    metrics.observe("gaia_admission_wait_seconds", time.monotonic() - t0, **metrics.context_labels())
+    try:
+        yield Slot(acquired)
+    finally:
+        for lim in reversed(acquired):
+            lim.release()
+
+
+def load(assistantid: Optional[str] = None) -> float:
+    """Share of slots in use, globally or for the assistant, whichever is higher; 1.0 while calls are queued."""
+    if _queued:
+        return 1.0
+    lims = [_global]
+    if (assistantid or "") in _assistants:
+        lims.append(_assistants[assistantid or ""])
+    return max(lim.in_use / lim.capacity() for lim in lims)
+
+
+def stats() -> dict:
+    return {
+        "queued": _queued,
+        "queue_max": QUEUE_MAX,
+        "global": _global.stats(),
+        "assistants": {k or "-": lim.stats() for k, lim in _assistants.items()},
+    }
@@ -0,0 +1,73 @@
+"""Benchmark: /api/search_ifu response size and CPU per encoding.
+
+For a search result of --results items with --snippet-chars characters each,
+reports the body size and compression time of every available encoding
+(br / zstd only when their packages are installed), and the CPU of building a
+response from scratch vs. from the representations stored with a cache entry.
+
+    python -m backend.bench.bench_compress [--results 1000] [--snippet-chars 3000]
+"""
+import argparse
+import json
+import sys
+import time
+
+from starlette.requests import Request
+
+from backend import http_cache, result_cache
+from backend.bench.bench_results import make_content
+from backend.results import SearchResult, render_json
+
+
+def _request(accept_encoding: str) -> Request:
+    return Request({"type": "http", "method": "GET", "path": "/api/search_ifu", "query_string": b"",
+                    "headers": [(b"accept-encoding", accept_encoding.encode())]})
+
+
+def _best(fn, rounds: int) -> float:
+    best = float("inf")
+    for _ in range(rounds):
+        t0 = time.process_time()
+        fn()
+        best = min(best, time.process_time() - t0)
+    return round(best * 1000, 2)
+
+
+def main(argv=None) -> int:
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--results", type=int, default=1000)
+    ap.add_argument("--snippet-chars", type=int, default=3000)
+    ap.add_argument("--rounds", type=int, default=5)
+    args = ap.parse_args(argv)
+
+    content = make_content(args.results, args.snippet_chars)
+    body = render_json({"results": SearchResult.parse(content).ifu_results("a")})
+    print(json.dumps({"encoding": "identity", "bytes": len(body)}))
+    for encoding in http_cache.ENCODINGS:
+        data = http_cache.compress(encoding, body)
+        ms = _best(lambda: http_cache.compress(encoding, body), args.rounds)
+        print(json.dumps({"encoding": encoding, "bytes": len(data), "ratio": round(len(data) / len(body), 3),
+                          "compress_ms": ms}))
+
+    # 完整响应：每次重新解析、序列化、压缩 vs. 从缓存条目保存的表示直接返回
+    cache = result_cache.ResultCache(max_bytes=1 << 30)
+    key = result_cache.make_key("a", "", "search", "bench")
+    cache.put(key, content)
+    request = _request("gzip, deflate, br, zstd")
+
+    def uncached():
+        result = SearchResult.parse(content)
+        http_cache.respond(request, lambda: render_json({"results": result.ifu_results("a")}))
+
+    def cached():
+        reps = cache.representations(key)
+        http_cache.respond(request, lambda: render_json({"results": SearchResult.parse(content).ifu_results("a")}), reps)
+
+    cached()
+    print(json.dumps({"variant": "uncached", "cpu_ms": _best(uncached, args.rounds)}))
+    print(json.dumps({"variant": "cached", "cpu_ms": _best(cached, args.rounds)}))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
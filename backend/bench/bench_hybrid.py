@@ -0,0 +1,159 @@
+"""Benchmark: assistant-only mode=ask vs hybrid retrieval + grounded context.
+
+Both paths go through gaia_client.call_atlan_qa against a GAIA endpoint
+(by default the local stand-in backend.fake_gaia, started in-process), and
+the report compares end-to-end latency percentiles and prompt tokens as
+counted by the stand-in.
+
+    python -m backend.bench.bench_hybrid                       # synthetic corpus
+    python -m backend.bench.bench_hybrid --container <id>      # existing local index
+    python -m backend.bench.bench_hybrid --gaia-url http://host:port/api/assistants/{assistantid}/chat/completions?format=codegpt&stream=true
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+from typing import List
+
+QUERIES = [
+    "O2 传感器如何校准", "报警音量怎么调节", "泄漏测试失败怎么办", "电池续航时间",
+    "how to replace the O2 sensor", "alarm limits for minute volume", "呼吸回路清洁消毒", "屏幕校准步骤",
+]
+WORDS = ("报警 氧气 传感器 校准 泄漏 测试 呼吸 回路 电池 屏幕 清洁 消毒 更换 音量 限值 "
+         "alarm O2 sensor calibration leak test battery screen cleaning volume limit").split()
+
+
+def _synthetic_corpus(index_dir: str, containerid: str, docs: int, pages: int) -> None:
+    os.environ["IFU_INDEX_DIR"] = index_dir
+    from backend import ifu_index
+    rnd = random.Random(7)
+    documents = [
+        (f"Device{d}/IFU.pdf", [" ".join(rnd.choices(WORDS, k=350)) for _ in range(pages)])
+        for d in range(docs)
+    ]
+    ifu_index.IFU_INDEX_DIR = ifu_index.Path(index_dir)
+    print("synthetic index:", ifu_index.write_index(containerid, documents))
+
+
+def _start_stand_in(port: int) -> None:
+    import uvicorn
+    from backend.fake_gaia import app
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning"))
+    threading.Thread(target=server.run, daemon=True).start()
+    deadline = time.time() + 10
+    while not server.started:
+        if time.time() > deadline:
+            raise RuntimeError("fake_gaia did not start")
+        time.sleep(0.05)
+
+
+def _stand_in_stats(base: str) -> dict:
+    try:
+        with urllib.request.urlopen(base + "/stats", timeout=5) as r:
+            return json.loads(r.read())
+    except Exception:
+        return {}
+
+
+def _pct(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q * (len(values) - 1))))]
+
+
+async def _run(label: str, queries: List[str], assistantid: str, containerid: str, hybrid: bool, concurrency: int, stats_base: str) -> dict:
+    from backend import gaia_client, retrieval
+    sem = asyncio.Semaphore(concurrency)
+    latencies: List[float] = []
+    context_chars: List[int] = []
+
+    async def one(q: str) -> None:
+        async with sem:
+            t0 = time.perf_counter()
+            passages = None
+            if hybrid:
+                passages = await asyncio.to_thread(retrieval.retrieve, containerid, q)
+                context_chars.append(sum(len(p["text"]) for p in passages))
+            await gaia_client.call_atlan_qa(q, assistantid, mode="ask", passages=passages)
+            latencies.append(time.perf_counter() - t0)
+
+    before = _stand_in_stats(stats_base)
+    t0 = time.perf_counter()
+    await asyncio.gather(*(one(q) for q in queries))
+    wall = time.perf_counter() - t0
+    after = _stand_in_stats(stats_base)
+    prompt_tokens = after.get("prompt_tokens", 0) - before.get("prompt_tokens", 0)
+    return {
+        "path": label,
+        "requests": len(queries),
+        "p50_ms": round(_pct(latencies, 0.5) * 1000, 1),
+        "p95_ms": round(_pct(latencies, 0.95) * 1000, 1),
+        "p99_ms": round(_pct(latencies, 0.99) * 1000, 1),
+        "mean_ms": round(statistics.fmean(latencies) * 1000, 1) if latencies else 0.0,
+        "wall_s": round(wall, 2),
+        "prompt_tokens_per_request": round(prompt_tokens / len(queries), 1) if stats_base else None,
+        "context_chars_per_request": round(statistics.fmean(context_chars), 1) if context_chars else None,
+    }
+
+
+def main(argv=None) -> int:
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--container", help="existing local index container id (default: build a synthetic one)")
+    ap.add_argument("--assistant", default="bench-assistant")
+    ap.add_argument("--gaia-url", help="real GAIA URL template instead of the in-process stand-in")
+    ap.add_argument("--port", type=int, default=8799)
+    ap.add_argument("--requests", type=int, default=64)
+    ap.add_argument("--concurrency", type=int, default=8)
+    ap.add_argument("--docs", type=int, default=4)
+    ap.add_argument("--pages", type=int, default=200)
+    ap.add_argument("--top-k", type=int)
+    args = ap.parse_args(argv)
+
+    containerid = args.container or "bench-container"
+    if not args.container:
+        _synthetic_corpus(tempfile.mkdtemp(prefix="ifu-bench-"), containerid, args.docs, args.pages)
+    stats_base = ""
+    if args.gaia_url:
+        os.environ["GAIA_BASE_URL"] = args.gaia_url
+    else:
+        stats_base = f"http://127.0.0.1:{args.port}"
+        os.environ["GAIA_BASE_URL"] = stats_base + "/api/assistants/{assistantid}/chat/completions?format=codegpt&stream=true"
+        _start_stand_in(args.port)
+    os.environ.setdefault("GAIA_LOG_PAYLOADS", "false")
+    if args.top_k:
+        os.environ["IFU_HYBRID_TOP_K"] = str(args.top_k)
+
+    import logging
+    logging.disable(logging.INFO)
+    from backend import gaia_client, retrieval
+    if not retrieval.available():
+        print("numpy is not installed; hybrid retrieval is unavailable", file=sys.stderr)
+        return 1
+
+    queries = [QUERIES[i % len(QUERIES)] + f" {i}" for i in range(args.requests)]
+    retrieval.retrieve(containerid, QUERIES[0])  # 预先计算页向量，不计入延迟
+
+    async def both():
+        try:
+            return [
+                await _run("assistant-only", queries, args.assistant, containerid, False, args.concurrency, stats_base),
+                await _run("hybrid", queries, args.assistant, containerid, True, args.concurrency, stats_base),
+            ]
+        finally:
+            await gaia_client.aclose_client()
+
+    for row in asyncio.run(both()):
+        print(json.dumps(row, ensure_ascii=False))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,113 @@
+"""Benchmark: logging cost per search request on the request thread.
+
+    python -m backend.bench.bench_logging [--requests 5000] [--answer-chars 20000]
+
+Each simulated request builds an IFU search payload and finalizes an upstream
+answer of --answer-chars characters, i.e. the log calls a /api/search_ifu call
+makes. Variants:
+
+- none:   root logger at WARNING (no log output at all), the floor;
+- sync:   the previous setup: logging.basicConfig stream handler, full system
+          prompt, full payload and clipped answer logged on every request;
+- queued: backend.logs: JSON records formatted and written on the listener
+          thread, prompt by ID, payload/answer sampled at
+          LOG_PAYLOAD_SAMPLE_RATE.
+
+Output goes to a temporary file (a real write, but no terminal in the loop).
+Reports request-thread µs per request (p50/p99/mean) and how long the queued
+variant then needs to drain.
+"""
+import argparse
+import contextvars
+import json
+import logging
+import statistics
+import sys
+import tempfile
+import time
+
+from backend import gaia_client, logs
+
+
+def make_answer(chars: int) -> list:
+    item = json.dumps({"doc": "IFU.pdf", "page": 1, "refId": "r1", "score": 1.0, "snippet": "说明书" * 200}, ensure_ascii=False)
+    text = '{"results":[' + ",".join([item] * max(1, chars // len(item))) + "]}"
+    return [text[i:i + 16] for i in range(0, len(text), 16)]
+
+
+def old_request(log: logging.Logger, parts: list) -> None:
+    # 改动前 gaia_client 的日志调用（f-string 提示词、整份 payload、截断后的回答）
+    payload = gaia_client._ifu_search_payload("报警 设置", "assistant-1", "container-1", "search")
+    log.info(f"本批 prompt:\n{gaia_client.IFU_SEARCH_SYSTEM_PROMPT}")
+    log.info("请求 payload 内容: %s", payload)
+    content = "".join(parts).strip()
+    log.info("Gaia 返回内容: %s", logs.clip(content))
+    gaia_client.SearchResult.parse(content)
+
+
+def new_request(parts: list) -> None:
+    gaia_client._ifu_search_payload("报警 设置", "assistant-1", "container-1", "search")
+    gaia_client.finalize_result(parts)
+
+
+def timed(fn, n: int) -> dict:
+    samples = []
+    for _ in range(n):
+        # 每个请求一个新的上下文：payload 采样按请求决定
+        ctx = contextvars.copy_context()
+        t0 = time.perf_counter()
+        ctx.run(fn)
+        samples.append(time.perf_counter() - t0)
+    samples.sort()
+    return {
+        "p50_us": round(statistics.median(samples) * 1e6, 1),
+        "p99_us": round(samples[int(len(samples) * 0.99) - 1] * 1e6, 1),
+        "mean_us": round(statistics.fmean(samples) * 1e6, 1),
+    }
+
+
+def main(argv=None) -> int:
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--requests", type=int, default=5000)
+    ap.add_argument("--answer-chars", type=int, default=20000)
+    args = ap.parse_args(argv)
+
+    parts = make_answer(args.answer_chars)
+    root = logging.getLogger()
+    logs.shutdown()
+    for h in list(root.handlers):
+        root.removeHandler(h)
+    rows = []
+
+    with tempfile.TemporaryFile("w+", encoding="utf-8") as out:
+        # none：只做业务本身（payload + 结果解析），不输出日志
+        root.setLevel(logging.WARNING)
+        timed(lambda: new_request(parts), args.requests // 5)  # 预热
+        rows.append({"variant": "none", **timed(lambda: new_request(parts), args.requests)})
+
+        # sync：每个请求在调用线程内格式化并写出三条完整日志
+        handler = logging.StreamHandler(out)
+        root.addHandler(handler)
+        root.setLevel(logging.INFO)
+        log = logging.getLogger("gaia_client")
+        rows.append({"variant": "sync", **timed(lambda: old_request(log, parts), args.requests)})
+        root.removeHandler(handler)
+
+        # queued：backend.logs（setup 在 root 上加一个队列 handler）
+        logs.setup(stream=out)
+        row = timed(lambda: new_request(parts), args.requests)
+        t0 = time.perf_counter()
+        logs.shutdown()
+        rows.append({"variant": "queued", "sample_rate": logs.PAYLOAD_SAMPLE_RATE,
+                     "drain_ms": round((time.perf_counter() - t0) * 1000, 1), **row})
+
+    base = rows[0]["mean_us"]
+    print(f"requests: {args.requests}; answer chars: {args.answer_chars}")
+    for row in rows:
+        row["overhead_us"] = round(row["mean_us"] - base, 1)
+        print(json.dumps(row))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
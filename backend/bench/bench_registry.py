@@ -0,0 +1,124 @@
+"""Benchmark: get_ifu model lookup, linear substring scan vs. compiled registry index.
+
+    python -m backend.bench.bench_registry [--models 10000] [--queries 2000]
+
+Builds a synthetic registry of vendor/series/number/variant model names and
+times lookups for exact names, noisy case/spacing, word prefixes ("Vista 3"),
+trailing numbers ("300 Plus") OCR look-alikes ("Vlsta 3O0") and other single typos. Reports
+build time, index memory and per-lookup p50/p99 for both variants.
+"""
+import argparse
+import json
+import random
+import statistics
+import sys
+import time
+import tracemalloc
+
+from backend.ifu_registry import RegistryIndex
+
+SERIES = ["Vista", "Atlan", "Epic", "Perseus", "Fabius", "Primus", "Savina", "Evita", "Babylog", "Infinity",
+          "Oxylog", "Carina", "Zeus", "Apollo", "Polaris", "Delta", "Gamma", "Kappa", "Sigma", "Omega"]
+VARIANTS = ["", " Plus", " XL", " Pro", " Neo", " S", " Mini", " Max"]
+
+
+def make_models(n: int, seed: int = 7) -> list:
+    rnd = random.Random(seed)
+    names, seen = [], set()
+    while len(names) < n:
+        name = f"{rnd.choice(SERIES)} {rnd.randint(10, 9999)}{rnd.choice(VARIANTS)}"
+        if name not in seen:
+            seen.add(name)
+            names.append(name)
+    return names
+
+
+def make_queries(names: list, n: int, seed: int = 11) -> list:
+    rnd = random.Random(seed)
+    ocr = {"i": "l", "o": "0", "s": "5", "a": "e", "t": "f"}
+    out = []
+    for _ in range(n):
+        name = rnd.choice(names)
+        kind = rnd.choice(("exact", "noisy", "prefix", "word", "typo"))
+        if kind == "noisy":
+            q = name.upper().replace(" ", "-")
+        elif kind == "prefix":
+            q = name[: max(3, len(name) - 2)]
+        elif kind == "word":
+            q = name.split(" ", 1)[1]
+        elif kind == "typo":
+            chars = list(name)
+            i = rnd.randrange(len(chars))
+            chars[i] = ocr.get(chars[i].lower(), chars[i])
+            q = "".join(chars)
+        else:
+            q = name
+        out.append((q, name))
+    return out
+
+
+class LinearScan:
+    """The old get_ifu: exact key, else first case-insensitive substring match (returns the entry)."""
+
+    def __init__(self, mapping: dict):
+        self.mapping = mapping
+
+    def lookup(self, model: str):
+        if model in self.mapping:
+            return self.mapping[model]
+        low = model.lower()
+        for k, v in self.mapping.items():
+            if low in k.lower():
+                return v
+        return None
+
+
+def timed(fn, queries: list) -> dict:
+    samples, hits, correct = [], 0, 0
+    for q, name in queries:
+        t0 = time.perf_counter()
+        found = fn(q)
+        samples.append(time.perf_counter() - t0)
+        hits += found is not None
+        # 前缀查询可能合法地命中另一个型号，只统计是否找回了原型号
+        correct += found is not None and found[0] == name
+    samples.sort()
+    return {
+        "p50_us": round(statistics.median(samples) * 1e6, 1),
+        "p99_us": round(samples[int(len(samples) * 0.99) - 1] * 1e6, 1),
+        "hit_rate": round(hits / len(queries), 3),
+        "accuracy": round(correct / len(queries), 3),
+    }
+
+
+def main(argv=None) -> int:
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--models", type=int, default=10000)
+    ap.add_argument("--queries", type=int, default=2000)
+    args = ap.parse_args(argv)
+
+    names = make_models(args.models)
+    entries = {n: (n, f"assistant-{i % 50}", f"container-{i % 200}") for i, n in enumerate(names)}
+    queries = make_queries(names, args.queries)
+
+    t0 = time.perf_counter()
+    index = RegistryIndex((n, e) for n, e in entries.items())
+    build = time.perf_counter() - t0
+    tracemalloc.start()
+    RegistryIndex((n, e) for n, e in entries.items())
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    rows = [
+        {"variant": "linear_scan", **timed(LinearScan(entries).lookup, queries)},
+        {"variant": "registry_index", "build_ms": round(build * 1000, 1), "build_peak_mib": round(peak / 2 ** 20, 1),
+         **timed(lambda q: (index.lookup(q) or (None,))[0], queries)},
+    ]
+    print(f"models: {len(names)}; queries: {len(queries)}")
+    for row in rows:
+        print(json.dumps(row))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
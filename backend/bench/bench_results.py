@@ -0,0 +1,101 @@
+"""Benchmark: /api/search_ifu response building, before vs. after SearchResult.
+
+before: the previous pipeline — json.loads + sort + json.dumps in the client,
+        json.loads + dict rebuild in the endpoint, FastAPI's jsonable_encoder
+        + JSONResponse serialization.
+after:  SearchResult.parse (one parse, sorted __slots__ items) and one
+        FastJSONResponse render.
+
+    python -m backend.bench.bench_results [--results 1000] [--snippet-chars 800]
+
+Reports CPU time per response and the peak memory traced while building it.
+"""
+import argparse
+import json
+import random
+import sys
+import time
+import tracemalloc
+
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+
+from backend import results
+from backend.results import FastJSONResponse, SearchResult
+
+
+def make_content(n: int, snippet_chars: int) -> str:
+    rnd = random.Random(3)
+    text = "检查氧气传感器校准与泄漏测试。O2 sensor calibration and leak test. "
+    snippet = (text * (snippet_chars // len(text) + 1))[:snippet_chars]
+    return json.dumps({"results": [
+        {"doc": f"Device/IFU_{i % 7}.pdf", "page": rnd.randint(1, 400), "refId": f"r{i}", "score": 0.5, "snippet": snippet}
+        for i in range(n)
+    ]}, ensure_ascii=False)
+
+
+def before(content: str, assistantid: str) -> bytes:
+    # gaia_client._sort_results_by_page
+    parsed = json.loads(content)
+    if isinstance(parsed, dict) and isinstance(parsed.get("results"), list):
+        def _key(item):
+            p = item.get("page") if isinstance(item, dict) else None
+            return p if isinstance(p, (int, float)) else float("inf")
+        parsed["results"] = sorted(parsed["results"], key=_key)
+        content = json.dumps(parsed, ensure_ascii=False)
+    # main._normalize_ifu_results
+    data = json.loads(content)
+    valid = []
+    for it in data.get("results", []):
+        doc = str(it.get("doc", assistantid)).strip()
+        page = int(it.get("page", 0))
+        snippet = str(it.get("snippet", "")).strip()
+        if doc:
+            valid.append({"doc": doc, "page": max(0, page), "snippet": snippet[:3000]})
+    # FastAPI: jsonable_encoder + JSONResponse
+    return JSONResponse(jsonable_encoder({"results": valid})).body
+
+
+def after(content: str, assistantid: str) -> bytes:
+    result = SearchResult.parse(content)
+    return FastJSONResponse({"results": result.ifu_results(assistantid)}).body
+
+
+def measure(fn, content: str, rounds: int) -> dict:
+    body = fn(content, "a")
+    best = float("inf")
+    for _ in range(rounds):
+        t0 = time.process_time()
+        fn(content, "a")
+        best = min(best, time.process_time() - t0)
+    tracemalloc.start()
+    fn(content, "a")
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        "variant": fn.__name__,
+        "cpu_ms": round(best * 1000, 2),
+        "peak_mib": round(peak / 2 ** 20, 2),
+        "body_bytes": len(body),
+    }
+
+
+def main(argv=None) -> int:
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--results", type=int, default=1000)
+    ap.add_argument("--snippet-chars", type=int, default=800)
+    ap.add_argument("--rounds", type=int, default=10)
+    args = ap.parse_args(argv)
+
+    content = make_content(args.results, args.snippet_chars)
+    print(f"orjson: {'yes' if results.orjson is not None else 'no'}; upstream content: {len(content.encode()) / 2 ** 20:.2f} MiB")
+    rows = [measure(fn, content, args.rounds) for fn in (before, after)]
+    if json.loads(before(content, "a")) != json.loads(after(content, "a")):
+        print("WARNING: responses differ", file=sys.stderr)
+    for row in rows:
+        print(json.dumps(row))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,177 @@
+"""Micro-benchmark: incremental SSE parser (backend.sse) vs. the previous line loop.
+
+Both variants turn a GAIA stream into text deltas: the legacy loop decodes
+and strips every line and runs json.loads on each `data:` payload; the new
+one parses raw byte chunks with sse.SSEParser and decodes with sse.loads.
+
+Fixtures are raw GAIA response bodies (text/event-stream). Without
+--fixture a stream equivalent to a 1000-result search answer is generated.
+Record a real stream with:
+
+    python -m backend.bench.bench_sse record <assistantid> "<keyword>" stream.sse
+
+and benchmark it with:
+
+    python -m backend.bench.bench_sse --fixture stream.sse [--fixture ...]
+
+Reported per variant: throughput (MB/s), events/s and the peak of memory
+traced by tracemalloc while parsing, overall and per 1000 events (CPython
+has no allocation counter, so the transient peak stands in for allocation
+churn).
+"""
+import argparse
+import asyncio
+import codecs
+import json
+import sys
+import time
+import tracemalloc
+from pathlib import Path
+from typing import Callable, Iterable, List, Tuple
+
+from backend import sse
+
+
+def synthetic_stream(results: int = 1000, chunk_chars: int = 8) -> bytes:
+    text = json.dumps({"results": [
+        {"doc": f"Device/IFU_{i % 7}.pdf", "page": i % 300 + 1, "refId": f"r{i}", "score": 0.5,
+         "snippet": f"第{i}条：检查氧气传感器校准与泄漏测试 O2 sensor calibration"}
+        for i in range(results)
+    ]}, ensure_ascii=False)
+    out = []
+    for i in range(0, len(text), chunk_chars):
+        chunk = {"id": "chatcmpl-1", "object": "chat.completion.chunk",
+                 "choices": [{"index": 0, "delta": {"content": text[i:i + chunk_chars]}, "finish_reason": None}]}
+        out.append("data: " + json.dumps(chunk, ensure_ascii=False) + "\n\n")
+    out.append('data: {"choices":[],"usage":{"prompt_tokens":900,"completion_tokens":%d}}\n\n' % (len(text) // 2))
+    out.append("data: [DONE]\n\n")
+    return "".join(out).encode("utf-8")
+
+
+def _delta(chunk) -> str:
+    if isinstance(chunk, dict) and chunk.get("choices"):
+        return ((chunk["choices"][0] or {}).get("delta") or {}).get("content") or ""
+    return ""
+
+
+def legacy_loop(chunks: Iterable[bytes]) -> Tuple[int, int]:
+    """The previous implementation: decoded lines + strip + json.loads per line."""
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    pending = ""
+    events = chars = 0
+
+    def lines():
+        nonlocal pending
+        for chunk in chunks:
+            text = pending + decoder.decode(chunk)
+            parts = text.splitlines(keepends=True)
+            pending = parts.pop() if parts and not parts[-1].endswith(("\n", "\r")) else ""
+            for p in parts:
+                yield p.rstrip("\r\n")
+        if pending:
+            yield pending
+
+    for raw_line in lines():
+        line = raw_line.strip()
+        if not line or not line.startswith("data:"):
+            continue
+        payload_str = line[5:].strip()
+        if payload_str == "[DONE]":
+            break
+        try:
+            chunk = json.loads(payload_str)
+        except Exception:
+            continue
+        events += 1
+        chars += len(_delta(chunk))
+    return events, chars
+
+
+def incremental_parser(chunks: Iterable[bytes]) -> Tuple[int, int]:
+    parser = sse.SSEParser()
+    events = chars = 0
+    for chunk in chunks:
+        for _event, data in parser.feed(chunk):
+            if data == b"[DONE]":
+                return events, chars
+            events += 1
+            chars += len(_delta(sse.loads(data)))
+    for _event, data in parser.flush():
+        if data != b"[DONE]":
+            events += 1
+            chars += len(_delta(sse.loads(data)))
+    return events, chars
+
+
+def _chunks(body: bytes, size: int) -> List[bytes]:
+    return [body[i:i + size] for i in range(0, len(body), size)]
+
+
+def measure(fn: Callable, body: bytes, chunk_size: int, rounds: int) -> dict:
+    chunks = _chunks(body, chunk_size)
+    fn(chunks)  # warm-up
+    best = float("inf")
+    for _ in range(rounds):
+        t0 = time.perf_counter()
+        events, chars = fn(chunks)
+        best = min(best, time.perf_counter() - t0)
+    tracemalloc.start()
+    fn(chunks)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        "variant": fn.__name__,
+        "events": events,
+        "delta_chars": chars,
+        "mb_per_s": round(len(body) / best / 1e6, 1),
+        "events_per_s": int(events / best) if best else 0,
+        "peak_kib": round(peak / 1024, 1),
+        "peak_bytes_per_1k_events": round(peak * 1000 / max(events, 1), 1),
+    }
+
+
+async def _record(assistantid: str, keyword: str, out: Path) -> None:
+    from backend import gaia_client
+    payload = gaia_client._ifu_search_payload(keyword, assistantid, None, None)
+    url = gaia_client._build_gaia_url(assistantid)
+    async with gaia_client._get_client().stream("POST", url, json=payload) as resp:
+        resp.raise_for_status()
+        with out.open("wb") as f:
+            async for chunk in resp.aiter_bytes():
+                f.write(chunk)
+    await gaia_client.aclose_client()
+    print(f"recorded {out.stat().st_size} bytes to {out}")
+
+
+def main(argv=None) -> int:
+    if argv is None:
+        argv = sys.argv[1:]
+    if argv[:1] == ["record"]:
+        if len(argv) != 4:
+            print(__doc__)
+            return 2
+        asyncio.run(_record(argv[1], argv[2], Path(argv[3])))
+        return 0
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--fixture", action="append", default=[], help="raw text/event-stream body")
+    ap.add_argument("--results", type=int, default=1000, help="size of the synthetic stream")
+    ap.add_argument("--chunk-size", type=int, default=4096, help="bytes per simulated socket read")
+    ap.add_argument("--rounds", type=int, default=5)
+    args = ap.parse_args(argv)
+
+    fixtures = [(p, Path(p).read_bytes()) for p in args.fixture] or [
+        (f"synthetic-{args.results}-results", synthetic_stream(args.results))
+    ]
+    print(f"orjson: {'yes' if sse.orjson is not None else 'no'}")
+    for name, body in fixtures:
+        print(f"# {name}: {len(body) / 1e6:.2f} MB")
+        rows = [measure(fn, body, args.chunk_size, args.rounds) for fn in (legacy_loop, incremental_parser)]
+        if rows[0]["delta_chars"] != rows[1]["delta_chars"]:
+            print("WARNING: variants disagree on the decoded text", file=sys.stderr)
+        for row in rows:
+            print(json.dumps(row, ensure_ascii=False))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,295 @@
+"""End-to-end load test: the backend over HTTP against the local GAIA stand-in.
+
+    python -m backend.bench.load                                   # all endpoints, concurrency 1,8,32
+    python -m backend.bench.load --endpoints search_ifu --concurrency 16,64 --duration 20
+    python -m backend.bench.load --error-rate 0.05 --rate-limit-rate 0.02
+    GAIA_HEDGE=true python -m backend.bench.load --endpoints search_ifu --stall-rate 0.05
+    python -m backend.bench.load --url http://127.0.0.1:9000 --pid <uvicorn pid>   # running backend
+
+By default two subprocesses are started: backend.fake_gaia (with the
+FAKE_GAIA_* settings given on the command line) and `uvicorn backend.main:app`
+pointed at it, with a scratch votes database and the result cache off, so
+every search reaches the stand-in. Other backend settings pass through from
+the environment. For each endpoint and concurrency level, that many closed-loop
+clients send requests for --duration seconds:
+
+- search_ifu: GET /api/search_ifu?keyword=...&assistantid=...
+- doc_search: POST /api/doc_search
+- vote:       POST /api/vote
+
+Each row reports RPS, p50/p95/p99 latency, non-2xx responses, the backend's
+CPU use (user+system seconds over wall time, 100% = one core) and its RSS at
+the end. CPU and RSS come from /proc (or psutil when installed); they are
+empty for --url without --pid.
+
+Every run is appended to backend/bench/results/load.jsonl with the git
+commit, so runs can be compared across commits. --compare prints the change
+against the latest earlier run from a different commit.
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import httpx
+
+try:
+    import psutil
+except ImportError:  # optional dependency
+    psutil = None
+
+RESULTS_FILE = Path(__file__).with_name("results") / "load.jsonl"
+ENDPOINTS = ("search_ifu", "doc_search", "vote")
+KEYWORDS = ["报警", "O2 传感器校准", "泄漏测试", "电池", "alarm limits", "cleaning", "屏幕校准", "呼吸回路"]
+FAKE_OPTIONS = ("base_latency", "tokens_per_second", "answer_chars", "results",
+                "rate_limit_rate", "error_rate", "drop_rate", "stall_rate", "stall_seconds", "replay")
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _git(*args: str) -> str:
+    try:
+        return subprocess.run(["git", *args], capture_output=True, text=True, timeout=10,
+                              cwd=Path(__file__).parent).stdout.strip()
+    except (OSError, subprocess.SubprocessError):
+        return ""
+
+
+def _pct(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q * (len(values) - 1))))]
+
+
+class ProcessStats:
+    """CPU seconds and RSS of one process (psutil, else /proc on Linux)."""
+
+    def __init__(self, pid: Optional[int]):
+        self.pid = pid
+        self._proc = psutil.Process(pid) if psutil is not None and pid else None
+        self._tick = os.sysconf("SC_CLK_TCK") if hasattr(os, "sysconf") else 100
+
+    def cpu_seconds(self) -> Optional[float]:
+        if not self.pid:
+            return None
+        if self._proc is not None:
+            t = self._proc.cpu_times()
+            return t.user + t.system
+        try:
+            fields = Path(f"/proc/{self.pid}/stat").read_text().rsplit(")", 1)[1].split()
+        except OSError:
+            return None
+        return (int(fields[11]) + int(fields[12])) / self._tick  # utime + stime
+
+    def rss_mib(self) -> Optional[float]:
+        if not self.pid:
+            return None
+        if self._proc is not None:
+            return self._proc.memory_info().rss / 2 ** 20
+        try:
+            for line in Path(f"/proc/{self.pid}/status").read_text().splitlines():
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+        except OSError:
+            pass
+        return None
+
+
+def _request(client: httpx.AsyncClient, endpoint: str, i: int, assistant: str, distinct: int):
+    keyword = f"{KEYWORDS[i % len(KEYWORDS)]} {i % distinct if distinct else i}"
+    if endpoint == "search_ifu":
+        return client.get("/api/search_ifu", params={"keyword": keyword, "assistantid": assistant})
+    if endpoint == "doc_search":
+        return client.post("/api/doc_search", json={"query": keyword, "assistantId": assistant})
+    return client.post("/api/vote", json={"type": "up" if i % 3 else "down", "assistantid": assistant, "answerid": f"a{i % 50}"})
+
+
+async def run_level(base_url: str, endpoint: str, concurrency: int, duration: float, assistant: str,
+                    distinct: int, proc: ProcessStats) -> dict:
+    latencies: List[float] = []
+    failures: Dict[str, int] = {}
+    counter = iter(range(10 ** 9))
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=120) as client:
+
+        async def worker(stop_at: float) -> None:
+            while time.perf_counter() < stop_at:
+                i = next(counter)
+                t0 = time.perf_counter()
+                try:
+                    resp = await _request(client, endpoint, i, assistant, distinct)
+                    status = str(resp.status_code)
+                except httpx.HTTPError as e:
+                    status = type(e).__name__
+                latencies.append(time.perf_counter() - t0)
+                if not status.startswith("2"):
+                    failures[status] = failures.get(status, 0) + 1
+
+        cpu0 = proc.cpu_seconds()
+        t0 = time.perf_counter()
+        await asyncio.gather(*(worker(t0 + duration) for _ in range(concurrency)))
+        wall = time.perf_counter() - t0
+        cpu1 = proc.cpu_seconds()
+    rss = proc.rss_mib()
+    return {
+        "endpoint": endpoint,
+        "concurrency": concurrency,
+        "requests": len(latencies),
+        "rps": round(len(latencies) / wall, 1),
+        "p50_ms": round(_pct(latencies, 0.50) * 1000, 1),
+        "p95_ms": round(_pct(latencies, 0.95) * 1000, 1),
+        "p99_ms": round(_pct(latencies, 0.99) * 1000, 1),
+        "mean_ms": round(statistics.fmean(latencies) * 1000, 1) if latencies else 0.0,
+        "errors": failures,
+        "cpu_pct": round((cpu1 - cpu0) / wall * 100, 1) if cpu0 is not None and cpu1 is not None else None,
+        "rss_mib": round(rss, 1) if rss is not None else None,
+    }
+
+
+def _wait_ready(url: str, proc: subprocess.Popen, timeout: float = 30) -> None:
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError(f"{url} exited with code {proc.returncode}")
+        try:
+            httpx.get(url, timeout=1)
+            return
+        except httpx.HTTPError:
+            time.sleep(0.1)
+    raise RuntimeError(f"{url} did not start within {timeout}s")
+
+
+def _start(module: str, port: int, env: dict) -> subprocess.Popen:
+    return subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", module, "--host", "127.0.0.1", "--port", str(port), "--log-level", "warning"],
+        env=env, cwd=str(Path(__file__).resolve().parents[2]), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+
+
+def _previous(commit: str) -> Optional[dict]:
+    if not RESULTS_FILE.exists():
+        return None
+    runs = [json.loads(line) for line in RESULTS_FILE.read_text(encoding="utf-8").splitlines() if line.strip()]
+    for run in reversed(runs):
+        if run.get("commit") != commit:
+            return run
+    return None
+
+
+def _compare(rows: List[dict], previous: dict) -> None:
+    old = {(r["endpoint"], r["concurrency"]): r for r in previous.get("rows", [])}
+    print(f"vs {previous.get('commit')} ({previous.get('time')}):")
+    for row in rows:
+        base = old.get((row["endpoint"], row["concurrency"]))
+        if base is None:
+            continue
+        diff = {k: f"{(row[k] - base[k]) / base[k] * 100:+.1f}%" for k in ("rps", "p50_ms", "p99_ms") if base.get(k)}
+        print(json.dumps({"endpoint": row["endpoint"], "concurrency": row["concurrency"], **diff}))
+
+
+def main(argv=None) -> int:
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--url", help="running backend to test instead of starting one")
+    ap.add_argument("--pid", type=int, help="backend process for CPU/RSS when --url is given")
+    ap.add_argument("--endpoints", default=",".join(ENDPOINTS))
+    ap.add_argument("--concurrency", default="1,8,32", help="comma-separated levels")
+    ap.add_argument("--duration", type=float, default=10.0, help="seconds per level")
+    ap.add_argument("--assistant", default="bench-assistant")
+    ap.add_argument("--distinct", type=int, default=0, help="distinct keywords (0: every request unique)")
+    ap.add_argument("--label", default="", help="free-form note stored with the results")
+    ap.add_argument("--no-save", action="store_true")
+    ap.add_argument("--compare", action="store_true")
+    for name in FAKE_OPTIONS:
+        ap.add_argument("--" + name.replace("_", "-"), help=f"fake_gaia {name} (FAKE_GAIA_* default)")
+    args = ap.parse_args(argv)
+
+    endpoints = [e.strip() for e in args.endpoints.split(",") if e.strip()]
+    unknown = [e for e in endpoints if e not in ENDPOINTS]
+    if unknown:
+        ap.error(f"unknown endpoints: {', '.join(unknown)}")
+    levels = [int(c) for c in args.concurrency.split(",") if c.strip()]
+
+    procs: List[subprocess.Popen] = []
+    fake_config: dict = {}
+    try:
+        if args.url:
+            base_url, pid = args.url.rstrip("/"), args.pid
+        else:
+            fake_port, api_port = _free_port(), _free_port()
+            env = dict(os.environ)
+            for name in FAKE_OPTIONS:
+                value = getattr(args, name)
+                if value is not None:
+                    env["FAKE_GAIA_" + ("429_RATE" if name == "rate_limit_rate" else name.upper())] = value
+            procs.append(_start("backend.fake_gaia:app", fake_port, env))
+            _wait_ready(f"http://127.0.0.1:{fake_port}/stats", procs[-1])
+            fake_config = httpx.get(f"http://127.0.0.1:{fake_port}/config").json()
+            scratch = tempfile.mkdtemp(prefix="ifu-load-")
+            env.update({
+                "GAIA_BASE_URL": f"http://127.0.0.1:{fake_port}/api/assistants/{{assistantid}}/chat/completions?format=codegpt&stream=true",
+                "IFU_VOTES_DB": os.path.join(scratch, "votes.db"),
+                "IFU_CACHE_ENABLED": "false",
+                "GAIA_LOG_PAYLOADS": env.get("GAIA_LOG_PAYLOADS", "false"),
+                "LOG_LEVEL": env.get("LOG_LEVEL", "WARNING"),
+            })
+            procs.append(_start("backend.main:app", api_port, env))
+            base_url, pid = f"http://127.0.0.1:{api_port}", procs[-1].pid
+            _wait_ready(base_url + "/health", procs[-1])
+
+        stats = ProcessStats(pid)
+        rows = []
+        for endpoint in endpoints:
+            for level in levels:
+                row = asyncio.run(run_level(base_url, endpoint, level, args.duration, args.assistant, args.distinct, stats))
+                rows.append(row)
+                print(json.dumps(row, ensure_ascii=False), flush=True)
+    finally:
+        for p in reversed(procs):
+            p.terminate()
+            try:
+                p.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                p.kill()
+
+    commit = _git("rev-parse", "--short", "HEAD") + ("-dirty" if _git("status", "--porcelain", "--untracked-files=no") else "")
+    if args.compare:
+        previous = _previous(commit)
+        if previous is None:
+            print("no earlier run from another commit to compare with")
+        else:
+            _compare(rows, previous)
+    if not args.no_save:
+        run = {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "commit": commit,
+            "label": args.label,
+            "python": platform.python_version(),
+            "cpus": os.cpu_count(),
+            "duration_s": args.duration,
+            "target": args.url or "local",
+            "fake_gaia": fake_config,
+            "rows": rows,
+        }
+        RESULTS_FILE.parent.mkdir(parents=True, exist_ok=True)
+        with RESULTS_FILE.open("a", encoding="utf-8") as f:
+            f.write(json.dumps(run, ensure_ascii=False) + "\n")
+        print(f"saved to {RESULTS_FILE}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
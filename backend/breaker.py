@@ -0,0 +1,131 @@
+"""Per-assistant circuit breaker for GAIA calls.
+
+Every upstream attempt of an assistant's calls reports an outcome. It is a
+failure when the attempt errored (timeout, transport error, 5xx) or took
+longer than GAIA_BREAKER_SLOW_SECONDS to its first token. 429 is throttling,
+left to Retry-After and the adaptive limit (see admission), and does not count.
+
+- closed: calls go through. Once the last GAIA_BREAKER_WINDOW outcomes hold
+  at least GAIA_BREAKER_MIN_CALLS calls and a failure ratio of at least
+  GAIA_BREAKER_FAILURE_RATIO, the breaker opens.
+- open: calls are rejected at once for GAIA_BREAKER_OPEN_SECONDS; gaia_client
+  answers them with PLACEHOLDER, which the endpoints replace with the last
+  good cached result when there is one (see main._ifu_content).
+- half-open: after that, up to GAIA_BREAKER_HALF_OPEN_PROBES calls are let
+  through as probes. When that many probes succeed, the breaker closes. Any
+  failed probe opens it again.
+
+Client errors (400/401/403), 429 and calls abandoned by their caller release a
+probe without a verdict. Disable with GAIA_BREAKER=false. State changes are
+counted in gaia_breaker_transitions_total{state}, rejected calls in
+gaia_breaker_rejected_total; current states are in stats().
+"""
+import logging
+import os
+import time
+from collections import deque
+from typing import Deque, Dict, Optional
+
+from . import metrics
+
+logger = logging.getLogger("breaker")
+
+ENABLED = os.getenv("GAIA_BREAKER", "true").lower() in ("1", "true", "yes", "on")
+WINDOW = int(os.getenv("GAIA_BREAKER_WINDOW", "20"))
+MIN_CALLS = int(os.getenv("GAIA_BREAKER_MIN_CALLS", "5"))
+FAILURE_RATIO = float(os.getenv("GAIA_BREAKER_FAILURE_RATIO", "0.5"))
+SLOW_SECONDS = float(os.getenv("GAIA_BREAKER_SLOW_SECONDS", "20"))
+OPEN_SECONDS = float(os.getenv("GAIA_BREAKER_OPEN_SECONDS", "30"))
+HALF_OPEN_PROBES = int(os.getenv("GAIA_BREAKER_HALF_OPEN_PROBES", "1"))
+
+CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+
+class CircuitBreaker:
+    """Breaker state of one assistant (event-loop only)."""
+
+    def __init__(self, name: str = ""):
+        self.name = name
+        self.state = CLOSED
+        self._outcomes: Deque[bool] = deque(maxlen=max(1, WINDOW))  # True = failure
+        self._opened_at = 0.0
+        self._probes = 0  # 半开状态下正在进行的探测
+        self._probe_successes = 0
+
+    def _transition(self, state: str) -> None:
+        if state == self.state:
+            return
+        logger.warning("助手 %s 熔断状态：%s -> %s", self.name or "-", self.state, state)
+        self.state = state
+        self._probes = 0
+        self._probe_successes = 0
+        if state == OPEN:
+            self._opened_at = time.monotonic()
+        elif state == CLOSED:
+            self._outcomes.clear()
+        metrics.inc("gaia_breaker_transitions_total", state=state)
+
+    def allow(self) -> bool:
+        """Whether a call (or retry attempt) may go upstream now; a True in half-open takes a probe."""
+        if self.state == OPEN:
+            if time.monotonic() - self._opened_at < OPEN_SECONDS:
+                return False
+            self._transition(HALF_OPEN)
+        if self.state == HALF_OPEN:
+            if self._probes >= max(1, HALF_OPEN_PROBES):
+                return False
+            self._probes += 1
+        return True
+
+    def record(self, failed: bool) -> None:
+        """Outcome of an allowed attempt."""
+        if self.state == HALF_OPEN:
+            self._probes = max(0, self._probes - 1)
+            if failed:
+                self._transition(OPEN)
+            else:
+                self._probe_successes += 1
+                if self._probe_successes >= max(1, HALF_OPEN_PROBES):
+                    self._transition(CLOSED)
+            return
+        if self.state == OPEN:
+            return  # 熔断前已放行的调用，结果不再影响状态
+        self._outcomes.append(failed)
+        n = len(self._outcomes)
+        if n >= MIN_CALLS and sum(self._outcomes) / n >= FAILURE_RATIO:
+            self._transition(OPEN)
+
+    def release(self) -> None:
+        """An allowed attempt ended without a verdict (client error, caller went away)."""
+        if self.state == HALF_OPEN:
+            self._probes = max(0, self._probes - 1)
+
+    def stats(self) -> dict:
+        n = len(self._outcomes)
+        out = {"state": self.state, "calls": n, "failure_ratio": round(sum(self._outcomes) / n, 3) if n else 0.0}
+        if self.state == OPEN:
+            out["retry_in"] = round(max(0.0, OPEN_SECONDS - (time.monotonic() - self._opened_at)), 1)
+        return out
+
+
+_breakers: Dict[str, CircuitBreaker] = {}
+
+
+def get(assistantid: Optional[str]) -> CircuitBreaker:
+    key = assistantid or ""
+    cb = _breakers.get(key)
+    if cb is None:
+        cb = _breakers[key] = CircuitBreaker(key)
+    return cb
+
+
+def is_open(assistantid: Optional[str]) -> bool:
+    """True while calls for this assistant would be rejected (does not take a probe)."""
+    if not ENABLED:
+        return False
+    cb = _breakers.get(assistantid or "")
+    return cb is not None and cb.state == OPEN and time.monotonic() - cb._opened_at < OPEN_SECONDS
+
+
+def stats() -> dict:
+    return {"enabled": ENABLED, "assistants": {k or "-": cb.stats() for k, cb in _breakers.items()}}
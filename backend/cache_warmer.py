@@ -0,0 +1,352 @@
+"""Cache warming: precompute the answers to common queries of each device model.
+
+The queries come from IFU_WARM_FILE (default backend/warm_queries.json):
+
+    {"modes": ["search"],
+     "default": ["报警", "清洁和消毒"],
+     "models": {"Vista 300": ["O2 传感器校准", {"keyword": "如何更换电池", "mode": "ask"}]}}
+
+Every model of the device registry (ifu_registry) gets its own queries plus
+the default ones, in each of `modes` unless a query names its mode. Models
+sharing an assistant and container share cache entries, so each distinct
+cache key is fetched once. The file is reread for every run.
+
+A run fetches the queries that are not cached yet through the same path as
+/api/search_ifu and stores the answers in the result cache. It never competes
+with live traffic:
+- at most IFU_WARM_CONCURRENCY queries at a time, started at no more than
+  IFU_WARM_RATE per second;
+- a query waits while GAIA calls are queued or more than IFU_WARM_MAX_LOAD of
+  the admission slots are in use (see admission.load), but no longer than
+  IFU_WARM_MAX_WAIT seconds: then it is given up and counted as "busy";
+- assistants whose circuit breaker is open are skipped.
+
+Runs are started by POST /api/admin/cache/warm, by DELETE /api/admin/cache
+with warm=true (after an IFU container update), IFU_WARM_START_DELAY seconds
+after startup with IFU_WARM_ON_START=true, and every IFU_WARM_INTERVAL
+seconds when set. With several workers a shared state backend (shared_state)
+makes sure only one of them runs a scheduled warm-up. Progress and per-model
+coverage are reported by GET /api/admin/cache/warm.
+
+Seed the file from access logs (uvicorn or Nginx, any format that contains
+the request line). The most frequent queries of each model are merged into
+the file:
+
+    python -m backend.cache_warmer seed /var/log/nginx/access.log --top 20
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import re
+import time
+from collections import Counter
+from pathlib import Path
+from typing import Awaitable, Callable, Dict, List, NamedTuple, Optional
+from urllib.parse import parse_qs
+
+from . import admission, breaker, ifu_registry, metrics, result_cache, shared_state
+
+logger = logging.getLogger("cache_warmer")
+
+WARM_FILE = os.getenv("IFU_WARM_FILE", str(Path(__file__).with_name("warm_queries.json")))
+CONCURRENCY = int(os.getenv("IFU_WARM_CONCURRENCY", "2"))
+RATE = float(os.getenv("IFU_WARM_RATE", "1"))
+MAX_LOAD = float(os.getenv("IFU_WARM_MAX_LOAD", "0.5"))
+ON_START = os.getenv("IFU_WARM_ON_START", "false").lower() in ("1", "true", "yes", "on")
+START_DELAY = float(os.getenv("IFU_WARM_START_DELAY", "30"))
+INTERVAL = float(os.getenv("IFU_WARM_INTERVAL", "0"))
+MAX_WAIT = float(os.getenv("IFU_WARM_MAX_WAIT", "60"))
+# 负载过高时每次等待的时长
+BUSY_POLL = 0.5
+
+
+class WarmQuery(NamedTuple):
+    model: str
+    assistantid: str
+    containerid: str
+    mode: str
+    keyword: str
+
+    @property
+    def key(self) -> result_cache.CacheKey:
+        return result_cache.make_key(self.assistantid, self.containerid, self.mode, self.keyword)
+
+
+def _read_file(path: str) -> dict:
+    try:
+        data = json.loads(Path(path).read_text(encoding="utf-8"))
+    except FileNotFoundError:
+        return {}
+    if not isinstance(data, dict):
+        raise ValueError(f"{path}: 顶层必须为 JSON 对象")
+    return data
+
+
+def load_plan(path: str = WARM_FILE, assistantid: Optional[str] = None) -> List[WarmQuery]:
+    """Queries of every registry model (optionally of one assistant), in file order."""
+    data = _read_file(path)
+    modes = [m for m in data.get("modes") or ["search"] if m in ("search", "ask")] or ["search"]
+    defaults = list(data.get("default") or [])
+    per_model: Dict[str, list] = data.get("models") or {}
+    entries = {}
+    for entry in ifu_registry.get_registry().index.entries:
+        entries.setdefault(entry[0], entry)
+    for name in per_model:
+        if name not in entries:
+            logger.warning("预热文件中的型号 %s 不在设备型号表中，已跳过", name)
+
+    plan: List[WarmQuery] = []
+    for model, aid, cid in entries.values():
+        if not aid or (assistantid and aid != assistantid):
+            continue
+        seen = set()
+        for q in list(per_model.get(model) or []) + defaults:
+            if isinstance(q, dict):
+                keyword, q_modes = str(q.get("keyword") or ""), [str(q.get("mode") or "search")]
+            else:
+                keyword, q_modes = str(q), modes
+            keyword = keyword.strip()
+            for mode in q_modes:
+                item = WarmQuery(model, aid, cid, mode, keyword)
+                if keyword and item.key not in seen:
+                    seen.add(item.key)
+                    plan.append(item)
+    return plan
+
+
+class Warmer:
+    """Runs one warm-up at a time on the event loop; fetch(query) goes through the live search path."""
+
+    def __init__(self, fetch: Callable[[WarmQuery], Awaitable[object]], path: str = WARM_FILE):
+        self.fetch = fetch
+        self.path = path
+        self._task: Optional[asyncio.Task] = None
+        self._progress: dict = {"state": "idle"}
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    async def start(self, assistantid: Optional[str] = None, reason: str = "admin") -> bool:
+        """Start a run in the background; False if one is already running."""
+        if self.running:
+            return False
+        # 读文件和设备型号表：放到线程中，不阻塞事件循环
+        plan = await asyncio.to_thread(load_plan, self.path, assistantid)
+        if self.running:  # 读取期间另一个调用已启动
+            return False
+        todo = self._begin(plan, reason)
+        self._task = asyncio.create_task(self._run(todo))
+        return True
+
+    async def run(self, plan: List[WarmQuery], reason: str = "admin") -> dict:
+        """Warm `plan` in the current task and return the final progress."""
+        return await self._run(self._begin(plan, reason))
+
+    def _begin(self, plan: List[WarmQuery], reason: str) -> List[WarmQuery]:
+        todo: Dict[result_cache.CacheKey, WarmQuery] = {}
+        for q in plan:
+            todo.setdefault(q.key, q)
+        self._progress = {
+            "state": "running", "reason": reason, "started_at": time.time(), "finished_at": None,
+            "total": len(todo), "done": 0, "fetched": 0, "cached": 0, "failed": 0, "skipped": 0, "busy": 0,
+        }
+        logger.info("缓存预热开始（%s）：%d 个查询", reason, len(todo))
+        return list(todo.values())
+
+    async def _run(self, todo: List[WarmQuery]) -> dict:
+        p = self._progress
+        sem = asyncio.Semaphore(max(1, CONCURRENCY))
+        pace = _Pacer(RATE)
+
+        async def one(q: WarmQuery) -> None:
+            async with sem:
+                outcome = await self._warm(q, pace)
+            p[outcome] += 1
+            p["done"] += 1
+            metrics.inc("ifu_cache_warm_queries_total", outcome=outcome)
+
+        try:
+            await asyncio.gather(*(one(q) for q in todo))
+            p["state"] = "finished"
+        except asyncio.CancelledError:
+            p["state"] = "cancelled"
+            raise
+        finally:
+            p["finished_at"] = time.time()
+            logger.info(
+                "缓存预热%s：新增 %d，已缓存 %d，失败 %d，跳过 %d，负载过高放弃 %d，用时 %.1f 秒",
+                "完成" if p["state"] == "finished" else "中止", p["fetched"], p["cached"], p["failed"],
+                p["skipped"], p["busy"], p["finished_at"] - p["started_at"],
+            )
+        return dict(p)
+
+    async def _warm(self, q: WarmQuery, pace: "_Pacer") -> str:
+        metrics.set_context(endpoint="cache_warm", mode=q.mode, assistantid=q.assistantid)
+        if await result_cache.cache.acontains(q.key):
+            return "cached"
+        # 让位于线上请求：有排队或占用过多并发名额时等待，最多 MAX_WAIT 秒
+        give_up = time.monotonic() + MAX_WAIT
+        while admission.load(q.assistantid) >= MAX_LOAD:
+            if time.monotonic() >= give_up:
+                logger.info("负载持续过高，放弃预热查询（%s / %s）", q.model, q.keyword)
+                return "busy"
+            await asyncio.sleep(BUSY_POLL)
+        await pace.wait()
+        if breaker.is_open(q.assistantid):
+            return "skipped"
+        try:
+            await self.fetch(q)
+        except Exception as e:
+            logger.warning("预热查询失败（%s / %s）：%s", q.model, q.keyword, e)
+            return "failed"
+        # 上游失败时结果不会写入缓存
+        return "fetched" if await result_cache.cache.acontains(q.key) else "failed"
+
+    def cancel(self) -> None:
+        if self.running:
+            self._task.cancel()
+
+    def progress(self) -> dict:
+        return dict(self._progress)
+
+    def coverage(self, assistantid: Optional[str] = None) -> dict:
+        """Share of each model's warm queries that currently have a fresh cache entry."""
+        models: Dict[str, Dict[str, int]] = {}
+        for q in load_plan(self.path, assistantid):
+            m = models.setdefault(q.model, {"queries": 0, "cached": 0})
+            m["queries"] += 1
+            m["cached"] += result_cache.cache.contains(q.key)
+        total = sum(m["queries"] for m in models.values())
+        cached = sum(m["cached"] for m in models.values())
+        return {"queries": total, "cached": cached, "ratio": round(cached / total, 3) if total else 0.0, "models": models}
+
+
+class _Pacer:
+    """Spaces out starts to at most `rate` per second (event-loop only)."""
+
+    def __init__(self, rate: float):
+        self.interval = 1.0 / rate if rate > 0 else 0.0
+        self._next = time.monotonic()
+
+    async def wait(self) -> None:
+        now = time.monotonic()
+        at = max(self._next, now)
+        self._next = at + self.interval
+        if at > now:
+            await asyncio.sleep(at - now)
+
+
+def _claim(name: str, ttl: float) -> bool:
+    """True for exactly one worker per `ttl` seconds (always True without shared state)."""
+    try:
+        return shared_state.get_state().set(f"warm:{name}", str(os.getpid()), ttl=ttl, nx=True)
+    except shared_state.SharedStateError:
+        return True
+
+
+async def schedule(warmer: Warmer) -> None:
+    """Background loop for IFU_WARM_ON_START / IFU_WARM_INTERVAL."""
+    if not result_cache.CACHE_ENABLED:
+        return
+    if ON_START:
+        await asyncio.sleep(START_DELAY)
+        if await asyncio.to_thread(_claim, "start", max(START_DELAY, 60.0)):
+            await warmer.start(reason="start")
+    while INTERVAL > 0:
+        await asyncio.sleep(INTERVAL)
+        if await asyncio.to_thread(_claim, "interval", INTERVAL * 0.9):
+            await warmer.start(reason="schedule")
+
+
+# =============================
+# 从访问日志生成预热列表：python -m backend.cache_warmer seed access.log
+# =============================
+_REQUEST_RE = re.compile(r'/api/search_ifu(?:/stream)?\?([^\s"]+)')
+
+
+def count_log_queries(paths: List[str]) -> Counter:
+    """(assistantid, containerid, mode, keyword) -> count over /api/search_ifu request lines."""
+    counts: Counter = Counter()
+    display: Dict[result_cache.CacheKey, tuple] = {}
+    for path in paths:
+        with open(path, encoding="utf-8", errors="replace") as f:
+            for line in f:
+                m = _REQUEST_RE.search(line)
+                if m is None:
+                    continue
+                qs = parse_qs(m.group(1))
+                keyword = (qs.get("keyword") or [""])[0].strip()
+                mode = (qs.get("mode") or ["search"])[0].strip().lower() or "search"
+                aid = (qs.get("assistantid") or [""])[0].strip()
+                if not keyword or not aid or mode not in ("search", "ask"):
+                    continue
+                cid = (qs.get("containerid") or [""])[0].strip()
+                key = result_cache.make_key(aid, cid, mode, keyword)
+                # 同一归一化关键词的多种写法计为一个查询，保留首次出现的写法
+                display.setdefault(key, (aid, cid, mode, keyword))
+                counts[display[key]] += 1
+    return counts
+
+
+def seed(paths: List[str], out: str = WARM_FILE, top: int = 20, min_count: int = 2) -> Dict[str, int]:
+    """Merge the `top` most frequent logged queries of each model into the warm file."""
+    counts = count_log_queries(paths)
+    entries = ifu_registry.get_registry().index.entries
+    data = _read_file(out)
+    models = data.setdefault("models", {})
+    added: Dict[str, int] = {}
+    for (aid, cid, mode, keyword), n in counts.most_common():
+        if n < min_count:
+            break
+        model = next((e[0] for e in entries if e[1] == aid and (not cid or e[2] == cid)), None)
+        if model is None:
+            continue
+        queries = models.setdefault(model, [])
+        if added.get(model, 0) >= top:
+            continue
+        item = keyword if mode == "search" else {"keyword": keyword, "mode": mode}
+        if item not in queries:
+            queries.append(item)
+            added[model] = added.get(model, 0) + 1
+    data.setdefault("modes", ["search"])
+    data.setdefault("default", [])
+    Path(out).write_text(json.dumps(data, ensure_ascii=False, indent=2) + "\n", encoding="utf-8")
+    return added
+
+
+async def _run_cli(assistantid: Optional[str]) -> dict:
+    from .gaia_client import aclose_client
+    from .main import _ifu_content
+    warmer = Warmer(lambda q: _ifu_content(q.keyword, q.assistantid, q.containerid, q.mode))
+    try:
+        return await warmer.run(load_plan(WARM_FILE, assistantid), reason="cli")
+    finally:
+        await aclose_client()
+
+
+def main(argv=None) -> int:
+    ap = argparse.ArgumentParser(description="IFU result cache warming.")
+    sub = ap.add_subparsers(dest="cmd", required=True)
+    s = sub.add_parser("seed", help="add the most frequent queries from access logs to the warm file")
+    s.add_argument("logs", nargs="+")
+    s.add_argument("--out", default=WARM_FILE)
+    s.add_argument("--top", type=int, default=20, help="queries per model")
+    s.add_argument("--min-count", type=int, default=2)
+    r = sub.add_parser("run", help="warm now (useful with IFU_CACHE_DISK_PATH or SHARED_STATE_URL)")
+    r.add_argument("--assistant")
+    args = ap.parse_args(argv)
+    if args.cmd == "seed":
+        added = seed(args.logs, args.out, args.top, args.min_count)
+        for model, n in sorted(added.items()):
+            print(f"{model}: +{n}")
+        print(f"written to {args.out}")
+    else:
+        print(json.dumps(asyncio.run(_run_cli(args.assistant)), ensure_ascii=False))
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,271 @@
+"""Local stand-in for the GAIA chat completions API, for benchmarks and load tests.
+
+Speaks the same streaming protocol gaia_client expects (SSE `data:` lines with
+OpenAI-style deltas, a final usage chunk and `[DONE]`). Latency is modelled as
+
+    first token = FAKE_GAIA_BASE_LATENCY + prompt_tokens * FAKE_GAIA_PREFILL_SECONDS
+    output      = FAKE_GAIA_TOKENS_PER_SECOND
+
+Requests on the assistant route (payload without "model") additionally pay
+for the assistant's built-in RAG: FAKE_GAIA_RAG_TOKENS of retrieved context,
+randomly scaled by 0.5–1.5 to mimic how much the assistant decides to pull in.
+
+Run:
+    python -m uvicorn backend.fake_gaia:app --port 8765
+and point GAIA_BASE_URL at
+    http://127.0.0.1:8765/api/assistants/{assistantid}/chat/completions?format=codegpt&stream=true
+
+Answers are {"results": [...]} documents with FAKE_GAIA_RESULTS items of
+FAKE_GAIA_ANSWER_CHARS characters each. Completion tokens are counted as they
+are sent, so a client that closes the stream early is only billed for what
+was generated up to then.
+
+Fault injection (each a probability per request):
+- FAKE_GAIA_429_RATE: 429 with Retry-After: FAKE_GAIA_RETRY_AFTER;
+- FAKE_GAIA_ERROR_RATE: FAKE_GAIA_ERROR_STATUS (default 503);
+- FAKE_GAIA_DROP_RATE: the stream is cut after about half of the answer;
+- FAKE_GAIA_STALL_RATE: the first token comes FAKE_GAIA_STALL_SECONDS
+  (default 10) later than usual, a stalled stream as seen by hedging.
+
+Replay: FAKE_GAIA_REPLAY names a JSON-lines file of recorded answers,
+{"assistantid": ..., "query": <user message>, "content": <answer text>}.
+A request gets the recording for its (assistantid, user message), else one
+for its assistant (round-robin), else the synthetic answer. Record one from
+the real API with
+
+    python -m backend.fake_gaia record --out recorded.jsonl --assistant <id> "报警" "O2 传感器"
+
+GET /stats returns call and token counters, POST /stats/reset clears them.
+GET /config shows the settings above; POST /config changes them at runtime
+(JSON body with lower-case keys, e.g. {"error_rate": 0.05, "base_latency": 0.1}).
+"""
+import asyncio
+import itertools
+import json
+import os
+import random
+from typing import Any, Dict, List, Optional, Tuple
+
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+CHUNK_TOKENS = 8
+
+_config: Dict[str, Any] = {
+    "base_latency": float(os.getenv("FAKE_GAIA_BASE_LATENCY", "0.3")),
+    "prefill_seconds": float(os.getenv("FAKE_GAIA_PREFILL_SECONDS", "0.00005")),
+    "tokens_per_second": float(os.getenv("FAKE_GAIA_TOKENS_PER_SECOND", "400")),
+    "rag_tokens": int(os.getenv("FAKE_GAIA_RAG_TOKENS", "6000")),
+    "answer_chars": int(os.getenv("FAKE_GAIA_ANSWER_CHARS", "400")),
+    "results": int(os.getenv("FAKE_GAIA_RESULTS", "1")),
+    "rate_limit_rate": float(os.getenv("FAKE_GAIA_429_RATE", "0")),
+    "retry_after": os.getenv("FAKE_GAIA_RETRY_AFTER", "1"),
+    "error_rate": float(os.getenv("FAKE_GAIA_ERROR_RATE", "0")),
+    "error_status": int(os.getenv("FAKE_GAIA_ERROR_STATUS", "503")),
+    "drop_rate": float(os.getenv("FAKE_GAIA_DROP_RATE", "0")),
+    "stall_rate": float(os.getenv("FAKE_GAIA_STALL_RATE", "0")),
+    "stall_seconds": float(os.getenv("FAKE_GAIA_STALL_SECONDS", "10")),
+    "replay": os.getenv("FAKE_GAIA_REPLAY", ""),
+}
+
+app = FastAPI()
+
+_stats: Dict[str, Any] = {}
+# (assistantid, query) -> 回答；assistantid -> 该助手全部回答的循环迭代器
+_replay_exact: Dict[Tuple[str, str], str] = {}
+_replay_by_assistant: Dict[str, Any] = {}
+
+
+def _reset() -> None:
+    _stats.update(calls=0, assistant_calls=0, model_calls=0, prompt_tokens=0, completion_tokens=0, closed_early=0,
+                  throttled=0, errors=0, dropped=0, stalled=0, replayed=0)
+
+
+def _load_replay(path: str) -> int:
+    _replay_exact.clear()
+    _replay_by_assistant.clear()
+    if not path:
+        return 0
+    grouped: Dict[str, List[str]] = {}
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            rec = json.loads(line)
+            aid, content = str(rec.get("assistantid") or ""), str(rec.get("content") or "")
+            _replay_exact[(aid, str(rec.get("query") or ""))] = content
+            grouped.setdefault(aid, []).append(content)
+    for aid, answers in grouped.items():
+        _replay_by_assistant[aid] = itertools.cycle(answers)
+    return len(_replay_exact)
+
+
+_reset()
+_load_replay(_config["replay"])
+
+
+def _count_tokens(text: str) -> int:
+    return len(text) // 2
+
+
+def _answer(assistantid: str) -> str:
+    # 固定长度的回答，使不同 prompt 之间的输出耗时可比
+    chars = _config["answer_chars"]
+    snippet = ("说明书第1页：请按照操作步骤执行。" * (chars // 16 + 1))[:chars]
+    return json.dumps({"results": [
+        {"doc": f"{assistantid}/IFU.pdf", "page": i + 1, "refId": f"r{i + 1}", "score": 1.0, "snippet": snippet}
+        for i in range(_config["results"])
+    ]}, ensure_ascii=False)
+
+
+def _replayed(assistantid: str, query: str) -> Optional[str]:
+    content = _replay_exact.get((assistantid, query))
+    if content is None and assistantid in _replay_by_assistant:
+        content = next(_replay_by_assistant[assistantid])
+    return content
+
+
+def _user_message(payload: Dict[str, Any]) -> str:
+    for m in reversed(payload.get("messages") or []):
+        if isinstance(m, dict) and m.get("role") == "user":
+            return str(m.get("content") or "")
+    return ""
+
+
+@app.post("/api/assistants/{assistantid}/chat/completions")
+async def chat_completions(assistantid: str, request: Request):
+    payload = await request.json()
+    cfg = dict(_config)
+    _stats["calls"] += 1
+    roll = random.random()
+    if roll < cfg["rate_limit_rate"]:
+        _stats["throttled"] += 1
+        return JSONResponse({"error": "rate limited"}, status_code=429, headers={"Retry-After": str(cfg["retry_after"])})
+    if roll < cfg["rate_limit_rate"] + cfg["error_rate"]:
+        _stats["errors"] += 1
+        return JSONResponse({"error": "injected failure"}, status_code=cfg["error_status"])
+
+    prompt_tokens = sum(_count_tokens(str(m.get("content") or "")) for m in payload.get("messages") or [])
+    if "model" not in payload:
+        # 助手自带 RAG：检索到的上下文也要计入 prompt
+        prompt_tokens += int(cfg["rag_tokens"] * random.uniform(0.5, 1.5))
+        _stats["assistant_calls"] += 1
+    else:
+        _stats["model_calls"] += 1
+    _stats["prompt_tokens"] += prompt_tokens
+
+    text = _replayed(assistantid, _user_message(payload))
+    if text is None:
+        text = _answer(assistantid)
+    else:
+        _stats["replayed"] += 1
+    completion_tokens = max(1, _count_tokens(text))
+    step = CHUNK_TOKENS * 2  # chars per chunk
+    # 注入断流：发送约一半内容后直接中断连接
+    cut_at = len(text) // 2 if random.random() < cfg["drop_rate"] else None
+
+    first_token = cfg["base_latency"] + prompt_tokens * cfg["prefill_seconds"]
+    if random.random() < cfg["stall_rate"]:
+        _stats["stalled"] += 1
+        first_token += cfg["stall_seconds"]
+
+    async def gen():
+        await asyncio.sleep(first_token)
+        sent = False
+        try:
+            for i in range(0, len(text), step):
+                if cut_at is not None and i >= cut_at:
+                    _stats["dropped"] += 1
+                    raise RuntimeError("injected stream drop")
+                yield "data: " + json.dumps({"choices": [{"delta": {"content": text[i:i + step]}}]}, ensure_ascii=False) + "\n\n"
+                _stats["completion_tokens"] += CHUNK_TOKENS
+                await asyncio.sleep(CHUNK_TOKENS / cfg["tokens_per_second"])
+            sent = True
+        finally:
+            if not sent and cut_at is None:
+                _stats["closed_early"] += 1
+        usage = {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens}
+        yield "data: " + json.dumps({"choices": [], "usage": usage}) + "\n\n"
+        yield "data: [DONE]\n\n"
+
+    return StreamingResponse(gen(), media_type="text/event-stream")
+
+
+@app.get("/stats")
+def stats():
+    return dict(_stats)
+
+
+@app.post("/stats/reset")
+def reset_stats():
+    _reset()
+    return dict(_stats)
+
+
+@app.get("/config")
+def get_config():
+    return dict(_config, replay_entries=len(_replay_exact))
+
+
+@app.post("/config")
+async def set_config(request: Request):
+    changes = await request.json()
+    if not isinstance(changes, dict):
+        raise HTTPException(status_code=400, detail="请求体必须为 JSON 对象")
+    unknown = sorted(set(changes) - set(_config))
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"未知配置项: {', '.join(unknown)}")
+    for key, value in changes.items():
+        try:
+            _config[key] = type(_config[key])(value)
+        except (TypeError, ValueError):
+            raise HTTPException(status_code=400, detail=f"配置项 {key} 的值无效")
+    if "replay" in changes:
+        try:
+            _load_replay(_config["replay"])
+        except (OSError, ValueError) as e:
+            raise HTTPException(status_code=400, detail=f"回放文件无法加载: {e}")
+    return get_config()
+
+
+async def _record(out: str, assistantid: str, queries: List[str], mode: Optional[str]) -> int:
+    """Call the real GAIA (GAIA_BASE_URL / GAIA_API_KEY) and append the answers to `out`."""
+    from . import gaia_client
+    n = 0
+    try:
+        with open(out, "a", encoding="utf-8") as f:
+            for q in queries:
+                if (mode or "").lower() == "ask":
+                    payload = gaia_client._ask_payload(q, assistantid, mode, None)
+                else:
+                    payload = gaia_client._ifu_search_payload(q, assistantid, None, mode)
+                result = await gaia_client._post_with_retry(payload, assistantid)
+                if result.raw == gaia_client.PLACEHOLDER:
+                    print(f"skipped (upstream failed): {q}")
+                    continue
+                rec = {"assistantid": assistantid, "query": _user_message(payload), "content": result.raw}
+                f.write(json.dumps(rec, ensure_ascii=False) + "\n")
+                n += 1
+    finally:
+        await gaia_client.aclose_client()
+    return n
+
+
+def main(argv=None) -> int:
+    import argparse
+    ap = argparse.ArgumentParser(description="Record real GAIA answers for FAKE_GAIA_REPLAY.")
+    sub = ap.add_subparsers(dest="cmd", required=True)
+    rec = sub.add_parser("record")
+    rec.add_argument("--out", required=True)
+    rec.add_argument("--assistant", required=True)
+    rec.add_argument("--mode", help="search (default) or ask")
+    rec.add_argument("queries", nargs="+")
+    args = ap.parse_args(argv)
+    n = asyncio.run(_record(args.out, args.assistant, args.queries, args.mode))
+    print(f"recorded {n} answers to {args.out}")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
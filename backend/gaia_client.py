@@ -1,26 +1,21 @@
 import os
-import threading
+import asyncio
 import time
 import logging
-from typing import Any, Dict, Optional
+from typing import Any, AsyncIterator, Dict, Optional
 
-import requests
+import httpx
 import uuid
 import json
 from fastapi import HTTPException
 
-# Logger setup
-logger = logging.getLogger("gaia_client")
-import logging
+from . import admission, breaker, hedge, logs, metrics, retry, shared_state, sse, tokens
+from .results import ResultItem, ResultStream, SearchResult
+from .singleflight import SingleFlight, fingerprint
+from .tokens import count_tokens
 
-""" logging.basicConfig(
-    level=logging.INFO,
-    filename='mylog.txt',    # 写到日志文件
-    filemode='a',
-    encoding='utf-8',        # 指定编码为 UTF-8
-    format='%(levelname)s:%(name)s:%(message)s'
-) """
-logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO"))
+# JSON 日志经队列在后台线程写出：由应用启动时调用 logs.setup()（见 backend/logs.py）
+logger = logging.getLogger("gaia_client")
 
 # Config
 # Allow GAIA_BASE_URL to be a template containing {assistantid}.
@@ -34,18 +29,32 @@ GAIA_BASE_URL = None
 MODEL_NAME = os.getenv("GAIA_MODEL", "GPT 5.1")
 TIMEOUT = int(os.getenv("GAIA_TIMEOUT", "60"))
 MAX_RETRY = int(os.getenv("GAIA_MAX_RETRY", "3"))
-BACKOFF_BASE = float(os.getenv("GAIA_BACKOFF_BASE", "1.5"))
+BACKOFF_BASE = retry.BACKOFF_BASE
 SESSION_TOKEN_LIMIT = int(os.getenv("GAIA_SESSION_TOKEN_LIMIT", "120000"))
 MAX_RESPONSE_TOKENS = int(os.getenv("GAIA_MAX_RESPONSE_TOKENS", "102400"))
 PLACEHOLDER = os.getenv("GAIA_PLACEHOLDER", "对不起，服务繁忙，请稍后再试。")
 GAIA_API_KEY   = os.getenv("GAIA_API_KEY", "wQ51aOrIoNh1MCbm54bsUtCsmYRCPxH6FGRj54Dlw1s")
 
-# Logging controls
-LOG_PAYLOADS = os.getenv("GAIA_LOG_PAYLOADS", "true").lower() in ("1", "true", "yes", "on")
-MAX_LOG_CHARS = int(os.getenv("GAIA_MAX_LOG_CHARS", "2000"))
+# Connection pool (one AsyncClient per process, shared by all requests)
+POOL_MAX_CONNECTIONS = int(os.getenv("GAIA_POOL_MAX_CONNECTIONS", "500"))
+POOL_MAX_KEEPALIVE = int(os.getenv("GAIA_POOL_MAX_KEEPALIVE", "100"))
+# Idle keep-alive connections are evicted after this many seconds
+POOL_KEEPALIVE_EXPIRY = float(os.getenv("GAIA_POOL_KEEPALIVE_EXPIRY", "120"))
+# Connections opened to GAIA at startup so the first requests skip TCP+TLS setup
+POOL_PREWARM = int(os.getenv("GAIA_POOL_PREWARM", "4"))
+HTTP2 = os.getenv("GAIA_HTTP2", "false").lower() in ("1", "true", "yes", "on")
+
+# Concurrent identical requests share one upstream stream (single-flight)
+COALESCE = os.getenv("GAIA_COALESCE", "true").lower() in ("1", "true", "yes", "on")
 
 # Internal state
-_session_obj = requests.Session()
+_client: Optional[httpx.AsyncClient] = None
+_flights = SingleFlight("gaia")
+
+# 上游各阶段耗时（秒），按 endpoint / mode / assistantid 标记（见 metrics.context_labels）
+STAGE_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 30.0, 60.0, 120.0)
+for _name in ("gaia_connect_seconds", "gaia_ttfb_seconds", "gaia_ttft_seconds", "gaia_stream_seconds"):
+    metrics.register_histogram(_name, STAGE_BUCKETS)
 
 
 def _build_gaia_url(assitantid: Optional[str]) -> str:
@@ -80,68 +89,141 @@ def _build_gaia_url(assitantid: Optional[str]) -> str:
         raise HTTPException(status_code=500, detail="GAIA_BASE_URL 无效：必须以 http:// 或 https:// 开头。")
 
     return url
-_lock = threading.Lock()
-_used_tokens = 0
-
-# Session identification (can be provided via env or auto-generated)
-_session_id = os.getenv("GAIA_SESSION_ID") or uuid.uuid4().hex
+# Logical sessions (X-Session-Id + token budget) per assistant; independent of the connection pool.
+# GAIA_SESSION_ID, if set, is used as the first session id. Shared by all workers with SHARED_STATE_URL.
+_budget = tokens.SessionBudget(
+    SESSION_TOKEN_LIMIT, MAX_RESPONSE_TOKENS, os.getenv("GAIA_SESSION_ID"), state=shared_state.get_state()
+)
 
 # Ensure auth headers are set for the session (Gaia requires token)
 if GAIA_API_KEY:
-    _session_obj.headers.update({
+    try:
+        logger.info(f"Gaia auth configured: key_len={len(GAIA_API_KEY)}")
+    except Exception:
+        pass
+else:
+    logger.warning("GAIA_API_KEY is not set; requests will likely fail with 401.")
+
+
+def _default_headers() -> Dict[str, str]:
+    return {
         "Accept-Encoding": "gzip, deflate", # 压缩更快
         "Accept-Charset": "utf-8",
         "Content-Type": "application/json; charset=utf-8",
         "Connection": "keep-alive",
         "Accept": "text/event-stream",
         "Authorization": f"Bearer {GAIA_API_KEY}",
-        "X-Session-Id": _session_id
-    })
-    try:
-        logger.info(f"Gaia auth configured: key_len={len(GAIA_API_KEY)}, session_id={_session_id}")
-    except Exception:
-        pass
-else:
-    logger.warning("GAIA_API_KEY is not set; requests will likely fail with 401.")
+    }
 
 
+def _new_client() -> httpx.AsyncClient:
+    http2 = HTTP2
+    if http2:
+        try:
+            import h2  # noqa: F401  (httpx[http2] extra)
+        except ImportError:
+            logger.warning("GAIA_HTTP2 is enabled but the 'h2' package is missing; falling back to HTTP/1.1.")
+            http2 = False
+    return httpx.AsyncClient(
+        headers=_default_headers(),
+        timeout=httpx.Timeout(TIMEOUT),
+        limits=httpx.Limits(
+            max_connections=POOL_MAX_CONNECTIONS,
+            max_keepalive_connections=POOL_MAX_KEEPALIVE,
+            keepalive_expiry=POOL_KEEPALIVE_EXPIRY,
+        ),
+        http2=http2,
+    )
 
-def _reset_session() -> None:
-    global _session_obj, _used_tokens
-    _session_obj.close()
-    _session_obj = requests.Session()
-    _session_obj.headers.update({
-            "Accept-Encoding": "gzip, deflate", # 压缩更快
-            "Accept-Charset": "utf-8",
-            "Content-Type": "application/json; charset=utf-8",
-            "Connection": "keep-alive",
-            "Accept": "text/event-stream",
-            "Authorization": f"Bearer {GAIA_API_KEY}",
-            "X-Session-Id":  _session_id
-        })
-    _used_tokens = 0
 
+def _get_client() -> httpx.AsyncClient:
+    """Return the process-wide AsyncClient, creating it lazily inside the running event loop.
 
-def count_tokens(text: str) -> int:
-    """Very rough token estimator.
-    Roughly 1 token ≈ 4 chars for English; Chinese roughly 1 char ≈ 1 token.
-    We'll use a heuristic: tokens = max(len(text) // 2, 1)
+    The client (and its connection pool) lives for the whole process; session
+    rollover (see tokens.SessionBudget) never replaces it.
     """
-    if not text:
-        return 0
-    # simple heuristic that works ok for mixed content
-    return max(len(text) // 2, 1)
+    global _client
+    if _client is None or _client.is_closed:
+        _client = _new_client()
+    return _client
+
+
+class _PoolTrace:
+    """httpx trace hook for one request: counts pool hits vs. new connections
+    and records the connect time (TCP + TLS) of new ones."""
+
+    __slots__ = ("connected", "connect_started")
+
+    def __init__(self):
+        self.connected = False
+        self.connect_started = 0.0
+
+    async def __call__(self, event: str, info: Dict[str, Any]) -> None:
+        if event == "connection.connect_tcp.started":
+            self.connect_started = time.monotonic()
+        elif event == "connection.connect_tcp.complete":
+            self.connected = True
+            metrics.inc("gaia_pool_connections_opened_total")
+        elif event == "connection.start_tls.complete":
+            metrics.inc("gaia_pool_tls_handshakes_total")
+        elif event.endswith("send_request_headers.started"):
+            if self.connected:
+                self.connected = False  # 同一请求的重定向等再次发送时按复用计
+                metrics.observe(
+                    "gaia_connect_seconds", time.monotonic() - self.connect_started, **metrics.context_labels()
+                )
+            else:
+                metrics.inc("gaia_pool_hits_total")
 
 
-def _clip_for_log(s: Any) -> str:
-    """Clip long text for safe logging."""
+def _gaia_origin() -> Optional[str]:
+    template = GAIA_BASE_URL_RAW or GAIA_BASE_URL_TEMPLATE
     try:
-        t = "" if s is None else str(s)
+        url = httpx.URL(template.replace("{assistantid}", "_").replace("{assitantid}", "_"))
     except Exception:
-        t = "<unprintable>"
-    if len(t) <= MAX_LOG_CHARS:
-        return t
-    return f"{t[:MAX_LOG_CHARS]}... [truncated {len(t) - MAX_LOG_CHARS} chars]"
+        return None
+    if url.scheme not in ("http", "https") or not url.host:
+        return None
+    return f"{url.scheme}://{url.netloc.decode('ascii')}"
+
+
+async def prewarm_pool(count: int = POOL_PREWARM) -> int:
+    """Open up to `count` keep-alive connections to the GAIA host; returns how many succeeded.
+
+    Sends concurrent HEAD requests to the origin; any HTTP status counts, the
+    point is only to leave established (TLS) connections in the pool.
+    """
+    origin = _gaia_origin()
+    if count <= 0 or origin is None:
+        return 0
+    client = _get_client()
+
+    async def one() -> bool:
+        try:
+            resp = await client.head(origin + "/", timeout=min(TIMEOUT, 10), extensions={"trace": _PoolTrace()})
+            await resp.aclose()
+            return True
+        except Exception as e:
+            logger.debug("GAIA 连接预热失败: %s", e)
+            return False
+
+    warmed = sum(await asyncio.gather(*(one() for _ in range(min(count, POOL_MAX_KEEPALIVE)))))
+    metrics.inc("gaia_pool_prewarmed_total", warmed)
+    logger.info("Pre-warmed %d/%d connections to %s", warmed, count, origin)
+    return warmed
+
+
+async def aclose_client() -> None:
+    """Close the pooled client; called from the FastAPI lifespan on shutdown."""
+    global _client
+    client, _client = _client, None
+    if client is not None and not client.is_closed:
+        await client.aclose()
+
+
+async def token_stats() -> dict:
+    """Per-assistant session token usage (for /api/stats)."""
+    return await _budget.astats()
 
 
 def _parse_gaia_response(data: Dict[str, Any]) -> str:
@@ -153,23 +235,462 @@ def _parse_gaia_response(data: Dict[str, Any]) -> str:
         return (data["choices"][0].get("message", {}) or {}).get("content", "").strip()
     raise RuntimeError("Unexpected Gaia response format")
 
-def _call_gaia_core(
+
+def _apply_glob_filter(payload: Dict[str, Any], glob_filter: Optional[str]) -> None:
+    if glob_filter:
+        if "*" not in glob_filter and "?" not in glob_filter:
+            glob_filter = glob_filter.rstrip("/") + "/**"
+        payload["ragConfig"] = {"globFilter": glob_filter}
+
+
+def _chunk_completion_tokens(chunk: Dict[str, Any]) -> int:
+    return int(
+        chunk.get("completionTokenCount")
+        or (chunk.get("usage", {}) or {}).get("completion_tokens", 0)
+        or 0
+    )
+
+
+def _chunk_prompt_tokens(chunk: Dict[str, Any]) -> int:
+    return int(
+        chunk.get("promptTokenCount")
+        or (chunk.get("usage", {}) or {}).get("prompt_tokens", 0)
+        or 0
+    )
+
+
+def _chunk_delta(chunk: Any) -> Optional[str]:
+    # Two possible shapes: OpenAI-style delta, or custom content field
+    if not isinstance(chunk, dict):
+        return None
+    if "choices" in chunk and chunk.get("choices"):
+        return (((chunk.get("choices")[0] or {}).get("delta") or {}).get("content"))
+    if "content" in chunk:
+        return chunk.get("content")
+    return None
+
+
+# Yielded by stream_completion() when a partially streamed attempt failed and is
+# being retried from scratch: consumers must discard the deltas received so far.
+STREAM_RESET = object()
+
+
+async def _iter_deltas(resp: httpx.Response, usage: Dict[str, int]) -> AsyncIterator[str]:
+    """Yield text deltas from one upstream response (SSE or plain JSON).
+
+    Upstream-reported token counts are added to usage["prompt_tokens"] / usage["completion_tokens"].
+    """
+    ctype = (resp.headers.get("Content-Type") or "").lower()
+    # Determine charset; default to utf-8 (Gaia uses UTF-8 for SSE/JSON)
+    charset = "utf-8"
+    if "charset=" in ctype:
+        try:
+            charset = (ctype.split("charset=")[-1].split(";")[0] or "utf-8").strip()
+        except Exception:
+            charset = "utf-8"
+    try:
+        resp.encoding = charset
+    except Exception:
+        pass
+
+    if "text/event-stream" not in ctype:
+        # Non-stream JSON response
+        data = json.loads(await resp.aread())
+        usage["prompt_tokens"] += _chunk_prompt_tokens(data)
+        usage["completion_tokens"] += _chunk_completion_tokens(data)
+        yield _parse_gaia_response(data)
+        return
+
+    logger.debug("Parsing SSE stream from Gaia…")
+    async for _event, data in sse.aiter_events(resp.aiter_bytes()):
+        if data == b"[DONE]":
+            break
+        for chunk in _decode_event(data):
+            if isinstance(chunk, dict):
+                # Count tokens if provided on final message
+                usage["prompt_tokens"] += _chunk_prompt_tokens(chunk)
+                usage["completion_tokens"] += _chunk_completion_tokens(chunk)
+            delta = _chunk_delta(chunk)
+            if delta:
+                yield str(delta)
+
+
+def _decode_event(data: bytes) -> list:
+    """JSON chunk(s) of one SSE event; malformed payloads are skipped.
+
+    Tolerates upstreams that omit the blank line between events, in which case
+    several `data:` lines arrive joined into one event.
+    """
+    try:
+        return [sse.loads(data)]
+    except ValueError:
+        if b"\n" not in data:
+            return []
+    chunks = []
+    for line in data.split(b"\n"):
+        if line == b"[DONE]":
+            break
+        try:
+            chunks.append(sse.loads(line))
+        except ValueError:
+            continue
+    return chunks
+
+
+class _Upstream:
+    """One streaming POST to GAIA, read up to its first delta by open()."""
+
+    __slots__ = ("resp", "deltas", "usage", "first", "ttft")
+
+    def __init__(self):
+        self.resp: Optional[httpx.Response] = None
+        self.deltas: Optional[AsyncIterator[str]] = None
+        self.usage = {"prompt_tokens": 0, "completion_tokens": 0}
+        self.first: Optional[str] = None  # None：流结束时没有任何内容
+        self.ttft = 0.0
+
+    async def open(self, url: str, payload: Dict[str, Any], headers: Dict[str, str], timeout: float) -> "_Upstream":
+        t0 = time.monotonic()
+        client = _get_client()
+        request = client.build_request(
+            "POST", url, json=payload, headers=headers, timeout=timeout, extensions={"trace": _PoolTrace()}
+        )
+        try:
+            self.resp = await client.send(request, stream=True)
+            ctx = metrics.context_labels()
+            metrics.observe("gaia_ttfb_seconds", time.monotonic() - t0, **ctx)
+            metrics.inc("gaia_upstream_responses_total", status=self.resp.status_code, **ctx)
+            if self.resp.status_code >= 400:
+                await self.resp.aread()
+            self.resp.raise_for_status()
+            self.deltas = _iter_deltas(self.resp, self.usage)
+            self.first = await self.next()
+        except BaseException:
+            await self.aclose()
+            raise
+        self.ttft = time.monotonic() - t0
+        return self
+
+    async def next(self) -> Optional[str]:
+        try:
+            return await self.deltas.__anext__()
+        except StopAsyncIteration:
+            return None
+
+    async def aclose(self) -> None:
+        if self.deltas is not None:
+            await self.deltas.aclose()
+        if self.resp is not None:
+            await self.resp.aclose()
+
+
+async def _open_upstream(
+    url: str,
+    payload: Dict[str, Any],
+    headers: Dict[str, str],
+    timeout: float,
+    assistantid: Optional[str],
+    on_cancelled,
+) -> _Upstream:
+    """Open the upstream stream up to its first delta, hedging a stalled request.
+
+    With GAIA_HEDGE enabled, an identical second request is sent when no first
+    delta has arrived after hedge.delay(assistantid) (and the hedge budget
+    allows it). The first request to deliver a delta, or to finish cleanly,
+    wins. The other is cancelled and reported through on_cancelled(). A failure
+    of one request only counts once the other has failed too. If the caller
+    itself is cancelled, both requests are closed without on_cancelled(): the
+    caller's own cancel path settles the call once.
+    """
+    if not hedge.ENABLED:
+        return await _Upstream().open(url, payload, headers, timeout)
+
+    primary = _Upstream()
+    pending = {asyncio.create_task(primary.open(url, payload, headers, timeout)): primary}
+    hedged = False
+    won = False
+    error: Optional[BaseException] = None
+    try:
+        while pending:
+            done, _ = await asyncio.wait(
+                pending, timeout=None if hedged else hedge.delay(assistantid), return_when=asyncio.FIRST_COMPLETED
+            )
+            if not done:
+                hedged = True
+                if await hedge.acquire():
+                    backup = _Upstream()
+                    pending[asyncio.create_task(backup.open(url, payload, headers, timeout))] = backup
+                continue
+            for task in done:
+                upstream = pending.pop(task)
+                exc = task.exception()
+                if exc is None:
+                    hedge.observe(assistantid, upstream.ttft)
+                    if upstream is not primary:
+                        metrics.inc("gaia_hedge_wins_total", **metrics.context_labels())
+                    won = True
+                    return upstream
+                error = error or exc
+        raise error
+    finally:
+        # 落败（或调用方已取消）的请求：取消并关闭连接；只有输给胜者的请求单独记账
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+        for upstream in pending.values():
+            await upstream.aclose()
+            if won:
+                on_cancelled()
+
+
+def stream_completion(
+    payload: Dict[str, Any],
+    assistantid: Optional[str],
+    deadline: Optional[retry.Deadline] = None,
+) -> AsyncIterator[Any]:
+    """Stream text deltas for one Gaia completion (see _stream_upstream).
+
+    With GAIA_COALESCE enabled, concurrent calls with the same assistant and
+    payload share one upstream request; each caller receives every delta.
+    """
+    if not COALESCE:
+        return _stream_upstream(payload, assistantid, deadline)
+    key = fingerprint(assistantid, payload)
+    return _flights.stream(key, lambda: _stream_upstream(payload, assistantid, deadline))
+
+
+async def _stream_upstream(
+    payload: Dict[str, Any],
+    assistantid: Optional[str],
+    deadline: Optional[retry.Deadline] = None,
+) -> AsyncIterator[Any]:
+    """Stream text deltas for one Gaia completion, with retries.
+
+    Yields str deltas as they arrive. If an attempt fails after it has already
+    produced deltas, STREAM_RESET is yielded before the retry starts. When all
+    attempts fail, PLACEHOLDER is yielded as the only (remaining) delta.
+    Raises HTTPException(503) when admission control sheds the call (see admission).
+    While the assistant's circuit breaker is open, PLACEHOLDER is yielded at once
+    without calling upstream (see breaker).
+    """
+    cb = breaker.get(assistantid) if breaker.ENABLED else None
+    if cb is not None and not cb.allow():
+        # 熔断打开：不排队、不请求上游，直接失败
+        ctx = metrics.context_labels()
+        metrics.inc("gaia_breaker_rejected_total", **ctx)
+        metrics.inc("gaia_placeholder_total", reason="breaker", **ctx)
+        yield PLACEHOLDER
+        return
+    pending = cb is not None  # 已放行、尚未向熔断器报告结果的尝试
+
+    def verdict(failed: Optional[bool]) -> None:
+        # failed=None：没有结论（客户端错误、调用方放弃），只归还半开探测名额
+        nonlocal pending
+        if pending:
+            pending = False
+            if failed is None:
+                cb.release()
+            else:
+                cb.record(failed)
+
+    # Resolve URL per-call using function parameter or env
+    url = _build_gaia_url(assistantid)
+    logger.debug(f"Resolved Gaia URL: {url}")
+    prompt_estimate = tokens.count_messages(payload.get("messages"))
+    session_id = await _budget.areserve(assistantid, prompt_estimate)
+    headers = {"X-Session-Id": session_id}
+
+    def settle_cancelled() -> None:
+        # 被取消的对冲请求：上游已收到 prompt，按估算计入
+        _budget.settle(assistantid, session_id, 0, prompt_estimate, 0, wait=False)
+
+    deadline = deadline or retry.Deadline()
+    try:
+        # 排队等待并占用并发名额（全局 + 每个助手），队列满时直接 503
+        async with admission.slot(assistantid, deadline) as adm:
+            err = None
+            started = False
+            giveup = "attempts"
+            for attempt in range(1, MAX_RETRY + 1):
+                if attempt > 1 and cb is not None:
+                    if not cb.allow():
+                        # 重试期间熔断已打开：不再重试
+                        metrics.inc("gaia_breaker_rejected_total", **metrics.context_labels())
+                        logger.error(f"Gaia call gave up after {attempt - 1} attempts: circuit open ({err})")
+                        giveup = "breaker"
+                        break
+                    pending = True
+                status = None
+                retry_after = None
+                if started:
+                    yield STREAM_RESET
+                    started = False
+                try:
+                    logger.debug(f"Calling Gaia, attempt {attempt}")
+                    parts: list[str] = []
+                    # Gaia endpoint may return Server-Sent Events (text/event-stream) when stream=true
+                    timeout = min(TIMEOUT, deadline.remaining())
+                    t0 = time.monotonic()
+                    ttft = None
+                    upstream = await _open_upstream(url, payload, headers, timeout, assistantid, settle_cancelled)
+                    usage = upstream.usage
+                    try:
+                        ctx = metrics.context_labels()
+                        delta = upstream.first
+                        if delta is not None:
+                            ttft = time.monotonic() - t0
+                            metrics.observe("gaia_ttft_seconds", ttft, **ctx)
+                            adm.report(latency=ttft)
+                        while delta is not None:
+                            if deadline.expired():
+                                raise asyncio.TimeoutError()
+                            parts.append(delta)
+                            started = True
+                            yield delta
+                            delta = await upstream.next()
+                    finally:
+                        await upstream.aclose()
+                    metrics.observe("gaia_stream_seconds", time.monotonic() - t0, **ctx)
+
+                    # Update token usage: upstream numbers when reported, local count otherwise
+                    completion_tokens = usage["completion_tokens"]
+                    if not completion_tokens and parts:
+                        completion_tokens = count_tokens("".join(parts))
+                    _budget.settle(assistantid, session_id, prompt_estimate, usage["prompt_tokens"], completion_tokens,
+                                   wait=False)
+                    verdict((ttft if ttft is not None else time.monotonic() - t0) > breaker.SLOW_SECONDS)
+                    return
+
+                except (GeneratorExit, asyncio.CancelledError):
+                    # 调用方已拿到足够结果（或已断开）：上游连接随之关闭，按已生成部分记账
+                    _budget.settle(assistantid, session_id, prompt_estimate, 0, count_tokens("".join(parts)), wait=False)
+                    # 已有首个 token 按其耗时判断；否则只有等待已超过慢调用阈值才算失败
+                    elapsed = ttft if ttft is not None else time.monotonic() - t0
+                    verdict(True if elapsed > breaker.SLOW_SECONDS else (False if ttft is not None else None))
+                    raise
+                except asyncio.TimeoutError:
+                    err = "DeadlineExceeded"
+                    metrics.inc("gaia_upstream_responses_total", status="deadline", **metrics.context_labels())
+                except (httpx.TimeoutException, httpx.TransportError) as e:
+                    err = f"{type(e).__name__}"
+                    status_label = "timeout" if isinstance(e, httpx.TimeoutException) else "transport"
+                    metrics.inc("gaia_upstream_responses_total", status=status_label, **metrics.context_labels())
+                except httpx.HTTPStatusError as e:
+                    status = e.response.status_code
+                    # 出错时总是记录（不受采样率影响）
+                    try:
+                        body = e.response.text
+                    except Exception:
+                        body = "<unreadable body>"
+                    logger.warning(
+                        "Gaia 上游返回错误: HTTP %s, body=%s, payload=%s",
+                        status, logs.clip(body), logs.clip(logs.payload_summary(payload)),
+                    )
+                    if status in (401, 403):
+                        # Surface upstream auth failures to the client as 401
+                        logger.error("Upstream auth failed (HTTP %s). Please check GAIA_API_KEY / permissions.", status)
+                        raise HTTPException(status_code=401, detail="上游鉴权失败，请检查 GAIA_API_KEY 或权限是否正确。") from e
+                    if status not in (429, 500, 502, 503, 504):
+                        logger.error(f"HTTP error: {status}")
+                        raise
+                    retry_after = e.response.headers.get("Retry-After")
+                    err = f"HTTP {status}"
+                    if status in (429, 503):
+                        adm.report(throttled=True)
+                except Exception as e:
+                    # Any JSON/parse errors etc. — retry as transient once
+                    err = f"{type(e).__name__}: {e}"
+                # 429 是限流而非故障，由 Retry-After 与自适应并发处理，不计入熔断
+                verdict(None if status == 429 else True)
+
+                if attempt == MAX_RETRY:
+                    metrics.inc("gaia_retry_giveups_total", reason="attempts")
+                    logger.error(f"Gaia call failed after {MAX_RETRY} attempts: {err}")
+                    break
+                wait = retry.next_delay(attempt, status, retry_after)
+                logger.warning(f"{err}, retry {attempt}/{MAX_RETRY} in {wait:.2f}s …")
+                if not await retry.sleep_within(wait, deadline, reason=str(status or "transport")):
+                    logger.error(f"Gaia call gave up after {attempt} attempts: deadline budget exhausted ({err})")
+                    break
+
+            if started:
+                yield STREAM_RESET
+            metrics.inc("gaia_placeholder_total", reason=giveup, **metrics.context_labels())
+            yield PLACEHOLDER
+    finally:
+        verdict(None)
+
+
+def finalize_result(parts: list[str]) -> SearchResult:
+    """Join streamed deltas into the final answer, parsed once (results sorted by page)."""
+    content = "".join(parts).strip()
+    if logs.sample_payload():
+        logger.info("Gaia 返回内容: %s", logs.clip(content))
+    return SearchResult.parse(content)
+
+
+async def _collect(stream: AsyncIterator[Any], limit: Optional[int] = None) -> SearchResult:
+    """Accumulate a delta stream. With `limit`, result items are extracted while
+    they arrive and the stream is closed as soon as `limit` items are complete."""
+    parts: list[str] = []
+    items = ResultStream() if limit else None
+    try:
+        async for delta in stream:
+            if delta is STREAM_RESET:
+                parts.clear()
+                if items is not None:
+                    items.reset()
+                continue
+            parts.append(delta)
+            if items is not None and items.feed(delta) and len(items.items) >= limit:
+                metrics.inc("gaia_streams_closed_early_total")
+                return items.result(limit)
+    finally:
+        await stream.aclose()
+    if items is not None and items.items:
+        return items.result(limit)
+    return finalize_result(parts)
+
+
+async def _post_with_retry(payload: Dict[str, Any], assistantid: Optional[str], limit: Optional[int] = None) -> SearchResult:
+    """POST the payload to Gaia with retries; returns the parsed answer (PLACEHOLDER on failure).
+
+    The whole call, including backoff waits, is bounded by one retry.Deadline.
+    With `limit`, at most that many result items are returned and generation
+    is stopped once they have arrived (see _collect).
+    """
+    deadline = retry.Deadline()
+    try:
+        return await asyncio.wait_for(
+            _collect(stream_completion(payload, assistantid, deadline), limit), timeout=deadline.remaining()
+        )
+    except asyncio.TimeoutError:
+        metrics.inc("gaia_retry_giveups_total", reason="deadline")
+        logger.error("Gaia call exceeded its deadline budget (%ss).", retry.CALL_DEADLINE)
+        metrics.inc("gaia_placeholder_total", reason="deadline", **metrics.context_labels())
+        return SearchResult(PLACEHOLDER)
+
+
+def _log_payload(payload: Dict[str, Any]) -> None:
+    """Full payload (prompt by ID) for sampled requests; otherwise only the prompt ID at DEBUG."""
+    if logs.sample_payload():
+        logger.info("请求 payload 内容: %s", logs.payload_summary(payload))
+        return
+    if logger.isEnabledFor(logging.DEBUG):
+        messages = payload.get("messages") or []
+        system = next((m.get("content") for m in messages if m.get("role") == "system"), None)
+        if system is not None:
+            # 提示词只记哈希 ID，全文在该 ID 首次出现时记录一次（logs.prompt_ref）
+            logger.debug("本批 prompt: %s", logs.prompt_ref(system))
+
+
+def _build_core_payload(
     text: str,
     system_prompt: str,
     assistantid: str | None = None,
     glob_filter: str | None = None,
     mode: Optional[str] = None
-) -> str:
-    logger.info(f"本批 prompt:\n{system_prompt}")
-    global _used_tokens
-    prompt_tokens = count_tokens(text) + count_tokens(system_prompt) + 50
-
-    with _lock:
-        if _used_tokens + prompt_tokens + MAX_RESPONSE_TOKENS >= SESSION_TOKEN_LIMIT:
-            logger.info("Token limit reached, resetting session.")
-            _reset_session()
-        _used_tokens += prompt_tokens
-
+) -> Dict[str, Any]:
     call_mode = (mode or "").strip().lower()
     # 1) 构造 payload
     if call_mode == "ask":
@@ -185,10 +706,7 @@ def _call_gaia_core(
         }
         # 一般不再传 ragConfig，避免覆盖助手的容器设置
         # 如确实要按文件再细分，可以在这里按需开启
-        # if glob_filter:
-        #     if "*" not in glob_filter and "?" not in glob_filter:
-        #         glob_filter = glob_filter.rstrip("/") + "/**"
-        #     payload["ragConfig"] = {"globFilter": glob_filter}
+        # _apply_glob_filter(payload, glob_filter)
     else:
         # 裸模型调用
         payload = {
@@ -203,208 +721,101 @@ def _call_gaia_core(
             "max_tokens": MAX_RESPONSE_TOKENS,
             "reasoningEffort": "Low",
         }
-        if glob_filter:
-            if "*" not in glob_filter and "?" not in glob_filter:
-                glob_filter = glob_filter.rstrip("/") + "/**"
-            payload["ragConfig"] = {"globFilter": glob_filter}
-
-    if LOG_PAYLOADS:
-        logger.info("请求 payload 内容: %s", payload)
+        _apply_glob_filter(payload, glob_filter)
 
-    err = None
-    for attempt in range(1, MAX_RETRY + 1):
-        try:
-            logger.debug(f"Calling Gaia, attempt {attempt}")
-            url = _build_gaia_url(assistantid)
-            logger.debug(f"Resolved Gaia URL: {url}")
+    _log_payload(payload)
+    return payload
 
-            resp = _session_obj.post(url, json=payload, timeout=TIMEOUT, stream=True)
-            resp.raise_for_status()
 
-            ctype = (resp.headers.get("Content-Type") or "").lower()
-            charset = "utf-8"
-            if "charset=" in ctype:
-                try:
-                    charset = (ctype.split("charset=")[-1].split(";")[0] or "utf-8").strip()
-                except Exception:
-                    charset = "utf-8"
-            try:
-                resp.encoding = charset
-            except Exception:
-                pass
-            is_sse = "text/event-stream" in ctype
-
-            accumulated: list[str] = []
-            completion_tokens = 0
-
-            if is_sse:
-                logger.debug("Parsing SSE stream from Gaia…")
-                for raw_line in resp.iter_lines(decode_unicode=False):
-                    if not raw_line:
-                        continue
-                    try:
-                        line = raw_line.decode(charset, errors="replace").strip()
-                    except Exception:
-                        try:
-                            line = raw_line.decode("utf-8", errors="replace").strip()
-                        except Exception:
-                            continue
-                    if not line.startswith("data:"):
-                        continue
-                    payload_str = line[5:].strip()
-                    if payload_str == "[DONE]":
-                        break
-                    try:
-                        chunk = json.loads(payload_str)
-                    except Exception:
-                        continue
-
-                    delta = None
-                    if isinstance(chunk, dict):
-                        completion_tokens += int(
-                            chunk.get("completionTokenCount")
-                            or (chunk.get("usage", {}) or {}).get("completion_tokens", 0)
-                            or 0
-                        )
-                        if "choices" in chunk and chunk.get("choices"):
-                            delta = (((chunk.get("choices")[0] or {}).get("delta") or {}).get("content"))
-                        elif "content" in chunk:
-                            delta = chunk.get("content")
-                    if delta:
-                        accumulated.append(str(delta))
-
-                content = ("".join(accumulated)).strip()
-            else:
-                data = resp.json()
-                completion_tokens = int(
-                    data.get("completionTokenCount")
-                    or (data.get("usage", {}) or {}).get("completion_tokens", 0)
-                    or 0
-                )
-                content = _parse_gaia_response(data)
-
-            if not completion_tokens and content:
-                completion_tokens = count_tokens(content)
-            with _lock:
-                _used_tokens += int(completion_tokens or 0)
-
-            # 如果是 JSON 且有 results.page，就按 page 排序
-            if content:
-                try:
-                    parsed = json.loads(content)
-                    if isinstance(parsed, dict) and isinstance(parsed.get("results"), list):
-                        results = parsed["results"]
-
-                        def _key(item):
-                            try:
-                                p = item.get("page") if isinstance(item, dict) else None
-                                return p if isinstance(p, (int, float)) else float("inf")
-                            except Exception:
-                                return float("inf")
-
-                        parsed["results"] = sorted(results, key=_key)
-                        content = json.dumps(parsed, ensure_ascii=False)
-                except Exception:
-                    pass
-
-            if LOG_PAYLOADS:
-                logger.info("Gaia 返回内容: %s", _clip_for_log(content))
-            return content
-
-        except (requests.ReadTimeout, requests.ConnectionError) as e:
-            err = f"{type(e).__name__}"
-        except requests.HTTPError as e:
-            status = e.response.status_code if e.response is not None else None
-            if LOG_PAYLOADS and e.response is not None:
-                try:
-                    body = e.response.text
-                except Exception:
-                    body = "<unreadable body>"
-                logger.warning("Gaia 上游返回错误: HTTP %s, body=%s", status, _clip_for_log(body))
-            if status in (401, 403):
-                logger.error("Upstream auth failed (HTTP %s).", status)
-                raise HTTPException(status_code=401, detail="上游鉴权失败，请检查 GAIA_API_KEY 或权限是否正确。") from e
-            if status not in (429, 500, 502, 503, 504):
-                logger.error(f"HTTP error: {status}")
-                raise
-            err = f"HTTP {status}"
-        except Exception as e:
-            err = f"{type(e).__name__}: {e}"
-
-        if attempt == MAX_RETRY:
-            logger.error(f"Gaia call failed after {MAX_RETRY} attempts: {err}")
-            break
-        wait = BACKOFF_BASE ** attempt
-        logger.warning(f"{err}, retry {attempt}/{MAX_RETRY} in {wait}s …")
-        print(f"[warn] {err}, retry {attempt}/{MAX_RETRY} in {wait}s …")
-        time.sleep(wait)
-
-    return PLACEHOLDER
+async def _call_gaia_core(
+    text: str,
+    system_prompt: str,
+    assistantid: str | None = None,
+    glob_filter: str | None = None,
+    mode: Optional[str] = None
+) -> SearchResult:
+    payload = _build_core_payload(text, system_prompt, assistantid, glob_filter, mode)
+    return await _post_with_retry(payload, assistantid)
+
+
+GROUNDED_QA_SYSTEM_PROMPT = (
+    "你是医疗设备说明书问答助手。只能依据用户消息中给出的说明书片段回答，不要使用片段以外的知识。\n"
+    "回答使用简洁中文，并在相关句子后用 [编号] 标注所依据的片段。\n"
+    "若片段中没有答案，请直接说明说明书片段中未找到相关内容。"
+)
+
+
+def _grounded_question(question: str, passages: list[dict]) -> str:
+    lines = ["说明书片段："]
+    for i, p in enumerate(passages, start=1):
+        lines.append(f"[{i}] {p.get('doc', '')} 第{p.get('page', '')}页：\n{p.get('text', '')}")
+    lines.append(f"\n问题：{question}")
+    return "\n\n".join(lines)
+
+
+def _ask_payload(question: str, assistantid: str, mode: Optional[str], passages: Optional[list[dict]]) -> Dict[str, Any]:
+    if passages:
+        # 混合检索：只把本地检索出的 top-k 片段作为上下文，走裸模型调用（不触发助手自带 RAG）
+        return _build_core_payload(
+            text=_grounded_question(question, passages),
+            system_prompt=GROUNDED_QA_SYSTEM_PROMPT,
+            assistantid=assistantid,
+            glob_filter=None,
+            mode=None,
+        )
+    return _build_core_payload(
+        text=question,
+        system_prompt="",
+        assistantid=assistantid,
+        glob_filter=None,  # 容器在助手里已经绑定好了
+        mode=mode,
+    )
 
 
-def call_atlan_qa(question: str, assistantid: str,mode: Optional[str] = None) -> str:
+async def call_atlan_qa(question: str, assistantid: str,mode: Optional[str] = None, passages: Optional[list[dict]] = None, limit: Optional[int] = None) -> SearchResult:
     """
     用 Atlan eIFU 助手做自然语言问答。
-    需求：将原本返回的自由文本转换为固定结构的 JSON 字符串：
+    需求：将原本返回的自由文本转换为固定结构的结果（SearchResult，raw 为对应的 JSON 字符串）：
     {"results":[{"doc":string,"page":number,"refId":string,"score":number,"snippet":string}]}
 
     为保持兼容：
     - 若上游已经返回符合该结构的 JSON，则原样返回；
     - 否则将自由文本包装进上述 schema 中，字段按以下规则填充：
         doc -> assistantid；page -> 1；refId -> 随机UUID；score -> 1.0；snippet -> 上游文本。
+
+    passages（可选，见 retrieval.retrieve）：本地检索出的 {"doc","page","text"} 片段；
+    提供时仅以这些片段作为上下文提问，而不依赖助手自带的文档检索。
+    limit（可选）：上游返回结构化 results 时最多取前 limit 条，取满即停止生成。
     """
 
-    raw = _call_gaia_core(
-        text=question,
-        system_prompt= "",
-        assistantid=assistantid,
-        glob_filter=None,  # 容器在助手里已经绑定好了
-        mode=mode
-    )
+    payload = _ask_payload(question, assistantid, mode, passages)
+    result = await _post_with_retry(payload, assistantid, limit)
 
     # 如果已经是目标结构的 JSON，直接透传
-    try:
-        parsed = json.loads(raw)
-        if isinstance(parsed, dict) and isinstance(parsed.get("results"), list):
-            return raw
-    except Exception:
-        pass
+    if result.structured:
+        return result
 
     # 否则进行包装
-    try:
-        snippet = "" if raw is None else str(raw)
-    except Exception:
-        snippet = "<unprintable>"
-
-    wrapped = {
-        "results": [
-            {
-                "doc": str(assistantid or "atlan-eifu"),
-                "page": 0, # skip this, frontend will not show it
-                "refId": str(uuid.uuid4()),
-                "score": 1.0,
-                "snippet": snippet,
-            }
-        ]
-    }
-    return json.dumps(wrapped, ensure_ascii=False)
+    item = ResultItem(
+        doc=str(assistantid or "atlan-eifu"),
+        page=0,  # skip this, frontend will not show it
+        refId=str(uuid.uuid4()),
+        score=1.0,
+        snippet=result.raw,
+    )
+    return SearchResult(json.dumps({"results": [item.to_dict()]}, ensure_ascii=False), [item])
 
 
-def call_ifu_search(keyword: str, assistantid: str | None = None, container_id: str | None = None, mode: Optional[str] = None) -> str:
-    """
-    调用 IFU 搜索助手，返回 JSON：
-    {"results":[{"doc":..., "page":..., "refId":..., "score":..., "snippet":...}]}
-    注意：结构由 GAIA 助手的 Structured Output Schema 保证。
-    """
+IFU_SEARCH_SYSTEM_PROMPT = (
+    "你是医疗设备说明书检索助手。仅在 ragConfig.globFilter 指定的 IFU 文档中检索。\n"
+    "根据用户关键词返回严格的 JSON（仅 JSON，无多余文字）。\n"
+    "snippet 必须为原文截取：以命中关键词为中心，向前后扩展若干句，尽量接近长度上限。\n"
+    "输出格式: {\"results\":[{\"doc\":string,\"page\":number,\"refId\":string,\"score\":number,\"snippet\":string}]}\n"
+    "要求: 每条 snippet 300–800字，允许换行与标点；尽量接近上限；若无法确定页码，使用1；返回最多1000条。"
+)
 
-    system_prompt = (
-        "你是医疗设备说明书检索助手。仅在 ragConfig.globFilter 指定的 IFU 文档中检索。\n"
-        "根据用户关键词返回严格的 JSON（仅 JSON，无多余文字）。\n"
-        "snippet 必须为原文截取：以命中关键词为中心，向前后扩展若干句，尽量接近长度上限。\n"
-        "输出格式: {\"results\":[{\"doc\":string,\"page\":number,\"refId\":string,\"score\":number,\"snippet\":string}]}\n"
-        "要求: 每条 snippet 300–800字，允许换行与标点；尽量接近上限；若无法确定页码，使用1；返回最多1000条。"
-    )
 
+def _ifu_search_payload(keyword: str, assistantid: str | None, container_id: str | None, mode: Optional[str]) -> Dict[str, Any]:
     # 通常不需要再传 ragConfig，容器已在助手配置中绑定。
     # 如你想强行限定某个容器，可以传 container_id -> ragConfig，
     # 但要确保不会和助手的默认设置冲突。
@@ -412,26 +823,39 @@ def call_ifu_search(keyword: str, assistantid: str | None = None, container_id:
     if container_id:
         glob_filter = container_id  # 内部会自动加上 /**
 
-    return _call_gaia_core(
+    return _build_core_payload(
         text=keyword,
-        system_prompt=system_prompt,
+        system_prompt=IFU_SEARCH_SYSTEM_PROMPT,
         assistantid=assistantid,
         glob_filter=glob_filter,
         mode=mode
     )
 
 
-def call_gaia(text: str, system_prompt: str, assistantid:str = None, glob_filter: str = None) -> str:
-    logger.info(f"本批 prompt:\n{system_prompt}")
-    global _used_tokens
-    prompt_tokens = count_tokens(text) + count_tokens(system_prompt) + 50  # 估算 system prompt 50 token
+async def call_ifu_search(keyword: str, assistantid: str | None = None, container_id: str | None = None, mode: Optional[str] = None, limit: Optional[int] = None) -> SearchResult:
+    """
+    调用 IFU 搜索助手，返回解析后的结果（raw 为上游 JSON 文本）：
+    {"results":[{"doc":..., "page":..., "refId":..., "score":..., "snippet":...}]}
+    注意：结构由 GAIA 助手的 Structured Output Schema 保证。
+    limit（可选）：结果在流式返回过程中逐条解析，收满 limit 条后立即关闭上游流，停止继续生成。
+    """
+    payload = _ifu_search_payload(keyword, assistantid, container_id, mode)
+    return await _post_with_retry(payload, assistantid, limit)
+
+
+def stream_ifu_search(keyword: str, assistantid: str | None = None, container_id: str | None = None, mode: Optional[str] = None, passages: Optional[list[dict]] = None) -> AsyncIterator[Any]:
+    """Streaming variant of call_ifu_search / call_atlan_qa: yields deltas (see stream_completion).
+
+    mode=="ask" asks the assistant like call_atlan_qa (grounded on `passages` when given).
+    """
+    if (mode or "").strip().lower() == "ask":
+        payload = _ask_payload(keyword, assistantid, mode, passages)
+    else:
+        payload = _ifu_search_payload(keyword, assistantid, container_id, mode)
+    return stream_completion(payload, assistantid)
 
-    with _lock:
-        if _used_tokens + prompt_tokens + MAX_RESPONSE_TOKENS >= SESSION_TOKEN_LIMIT:
-            logger.info("Token limit reached, resetting session.")
-            _reset_session()
-        _used_tokens += prompt_tokens
 
+def _build_gaia_payload(text: str, system_prompt: str, assistantid: str = None, glob_filter: str = None) -> Dict[str, Any]:
     # 如果有 assistantid，走 Assistant 接口
     if assistantid:
         # 对于 Assistant，一般不需要再传 model / ragConfig，
@@ -448,10 +872,6 @@ def call_gaia(text: str, system_prompt: str, assistantid:str = None, glob_filter
             "reasoningEffort": "Low"
         }
         # 允许在 Assistant 调用时也传递 ragConfig.globFilter，以便按容器/文件过滤
-        if glob_filter:
-            if "*" not in glob_filter and "?" not in glob_filter:
-                glob_filter = glob_filter.rstrip("/") + "/**"
-            payload["ragConfig"] = {"globFilter": glob_filter}
     else:
         payload = {
             "model": MODEL_NAME,
@@ -464,155 +884,18 @@ def call_gaia(text: str, system_prompt: str, assistantid:str = None, glob_filter
             "max_tokens": MAX_RESPONSE_TOKENS,
             "reasoningEffort": "Low"
         }
+    _apply_glob_filter(payload, glob_filter)
 
-        if glob_filter:
-            if "*" not in glob_filter and "?" not in glob_filter:
-                glob_filter = glob_filter.rstrip("/") + "/**"
-            payload["ragConfig"] = {"globFilter": glob_filter}
-
-    if LOG_PAYLOADS:
-           logger.info("请求 payload 内容: %s", payload)
-
-
-
-
-    err = None
-    for attempt in range(1, MAX_RETRY + 1):
-        try:
-            logger.debug(f"Calling Gaia, attempt {attempt}")
-            # Resolve URL per-call using function parameter or env
-            url = _build_gaia_url(assistantid)
-            logger.debug(f"Resolved Gaia URL: {url}")
-            # Gaia endpoint may return Server-Sent Events (text/event-stream) when stream=true
-            resp = _session_obj.post(url, json=payload, timeout=TIMEOUT, stream=True)
-            resp.raise_for_status()
-
-            ctype = (resp.headers.get("Content-Type") or "").lower()
-            # Determine charset; default to utf-8 (Gaia uses UTF-8 for SSE/JSON)
-            charset = "utf-8"
-            if "charset=" in ctype:
-                try:
-                    charset = (ctype.split("charset=")[-1].split(";")[0] or "utf-8").strip()
-                except Exception:
-                    charset = "utf-8"
-            # Hint requests for subsequent .text/.json decoding
-            try:
-                resp.encoding = charset
-            except Exception:
-                pass
-            is_sse = "text/event-stream" in ctype
-
-            # Accumulate content whether streaming or not
-            accumulated = []
-            completion_tokens = 0
-
-            if is_sse:
-                logger.debug("Parsing SSE stream from Gaia…")
-                for raw_line in resp.iter_lines(decode_unicode=False):
-                    if not raw_line:
-                        continue
-                    try:
-                        line = raw_line.decode(charset, errors="replace").strip()
-                    except Exception:
-                        # Fallback to utf-8 decoding
-                        try:
-                            line = raw_line.decode("utf-8", errors="replace").strip()
-                        except Exception:
-                            continue
-                    if not line.startswith("data:"):
-                        continue
-                    payload_str = line[5:].strip()  # trim leading 'data:'
-                    if payload_str == "[DONE]":
-                        break
-                    try:
-                        chunk = json.loads(payload_str)
-                    except Exception:
-                        # Skip malformed lines
-                        continue
-
-                    # Two possible shapes: OpenAI-style delta, or custom content field
-                    delta = None
-                    if isinstance(chunk, dict):
-                        # Count tokens if provided on final message
-                        completion_tokens += int(
-                            chunk.get("completionTokenCount") or
-                            (chunk.get("usage", {}) or {}).get("completion_tokens", 0) or 0
-                        )
-                        if "choices" in chunk and chunk.get("choices"):
-                            delta = (((chunk.get("choices")[0] or {}).get("delta") or {}).get("content"))
-                        elif "content" in chunk:
-                            delta = chunk.get("content")
-                    if delta:
-                        accumulated.append(str(delta))
-
-                content = ("".join(accumulated)).strip()
-            else:
-                # Non-stream JSON response
-                data = resp.json()
-                completion_tokens = int(
-                    data.get("completionTokenCount") or
-                    (data.get("usage", {}) or {}).get("completion_tokens", 0) or 0
-                )
-                content = _parse_gaia_response(data)
+    _log_payload(payload)
+    return payload
 
-            # Update token usage (best effort)
-            if not completion_tokens and content:
-                completion_tokens = count_tokens(content)
-            with _lock:
-                _used_tokens += int(completion_tokens or 0)
 
-            # Post-process: if Gaia returns JSON with a results list, sort by page ascending
-            # 需求：如果响应包含 results 且其中含有 page 字段，则按 page 升序返回给前端
-            if content:
-                try:
-                    parsed = json.loads(content)
-                    if isinstance(parsed, dict) and isinstance(parsed.get("results"), list):
-                        results = parsed.get("results")
-                        # 仅当元素为 dict 且存在 page 字段时进行排序；无法比较的置于末尾
-                        def _key(item):
-                            try:
-                                p = item.get("page") if isinstance(item, dict) else None
-                                return p if isinstance(p, (int, float)) else float('inf')
-                            except Exception:
-                                return float('inf')
-                        parsed["results"] = sorted(results, key=_key)
-                        content = json.dumps(parsed, ensure_ascii=False)
-                except Exception:
-                    # 非 JSON 或解析/排序失败时，保持原样
-                    pass
-
-            if LOG_PAYLOADS:
-                logger.info("Gaia 返回内容: %s", _clip_for_log(content))
-            return content
-
-        except (requests.ReadTimeout, requests.ConnectionError) as e:
-            err = f"{type(e).__name__}"
-        except requests.HTTPError as e:
-            status = e.response.status_code if e.response is not None else None
-            if LOG_PAYLOADS and e.response is not None:
-                try:
-                    body = e.response.text
-                except Exception:
-                    body = "<unreadable body>"
-                logger.warning("Gaia 上游返回错误: HTTP %s, body=%s", status, _clip_for_log(body))
-            if status in (401, 403):
-                # Surface upstream auth failures to the client as 401
-                logger.error("Upstream auth failed (HTTP %s). Please check GAIA_API_KEY / permissions.", status)
-                raise HTTPException(status_code=401, detail="上游鉴权失败，请检查 GAIA_API_KEY 或权限是否正确。") from e
-            if status not in (429, 500, 502, 503, 504):
-                logger.error(f"HTTP error: {status}")
-                raise
-            err = f"HTTP {status}"
-        except Exception as e:
-            # Any JSON/parse errors etc. — retry as transient once
-            err = f"{type(e).__name__}: {e}"
+async def call_gaia(text: str, system_prompt: str, assistantid:str = None, glob_filter: str = None) -> SearchResult:
+    payload = _build_gaia_payload(text, system_prompt, assistantid, glob_filter)
+    return await _post_with_retry(payload, assistantid)
 
-        if attempt == MAX_RETRY:
-            logger.error(f"Gaia call failed after {MAX_RETRY} attempts: {err}")
-            break
-        wait = BACKOFF_BASE ** attempt
-        logger.warning(f"{err}, retry {attempt}/{MAX_RETRY} in {wait}s …")
-        print(f"[warn] {err}, retry {attempt}/{MAX_RETRY} in {wait}s …")
-        time.sleep(wait)
 
-    return PLACEHOLDER
+def stream_gaia(text: str, system_prompt: str, assistantid: str = None, glob_filter: str = None) -> AsyncIterator[Any]:
+    """Streaming variant of call_gaia: yields deltas (see stream_completion)."""
+    payload = _build_gaia_payload(text, system_prompt, assistantid, glob_filter)
+    return stream_completion(payload, assistantid)
@@ -0,0 +1,149 @@
+"""Hedged GAIA requests: when to send a second copy of a stalled call.
+
+gaia_client opens an upstream stream and waits for its first token. If none
+has arrived after delay(assistantid), it sends the same request again, and
+the first stream to produce a token is used. The other one is cancelled.
+
+- The delay is the GAIA_HEDGE_QUANTILE (default p95) of the assistant's last
+  GAIA_HEDGE_WINDOW times to first token, clamped to [GAIA_HEDGE_MIN_DELAY,
+  GAIA_HEDGE_MAX_DELAY]. Until GAIA_HEDGE_MIN_SAMPLES have been seen,
+  GAIA_HEDGE_DEFAULT_DELAY is used.
+- Extra upstream load is capped by a token bucket holding
+  GAIA_HEDGE_BUDGET_PER_MINUTE hedges per process, refilled continuously.
+  When the bucket is empty, the call just keeps waiting for its first token.
+  With a shared state backend (SHARED_STATE_URL) the budget is one counter per
+  clock minute for all workers instead, updated from a worker thread.
+
+Hedging is off unless GAIA_HEDGE=true. Counters: gaia_hedges_total (sent),
+gaia_hedge_wins_total (the hedge answered first) and
+gaia_hedge_skipped_total{reason="budget"}. Delays and budget are in stats().
+"""
+import asyncio
+import os
+import time
+from collections import deque
+from typing import Deque, Dict, Optional
+
+from . import metrics, shared_state
+
+ENABLED = os.getenv("GAIA_HEDGE", "false").lower() in ("1", "true", "yes", "on")
+QUANTILE = float(os.getenv("GAIA_HEDGE_QUANTILE", "0.95"))
+WINDOW = int(os.getenv("GAIA_HEDGE_WINDOW", "200"))
+MIN_SAMPLES = int(os.getenv("GAIA_HEDGE_MIN_SAMPLES", "20"))
+DEFAULT_DELAY = float(os.getenv("GAIA_HEDGE_DEFAULT_DELAY", "5"))
+MIN_DELAY = float(os.getenv("GAIA_HEDGE_MIN_DELAY", "0.5"))
+MAX_DELAY = float(os.getenv("GAIA_HEDGE_MAX_DELAY", "20"))
+BUDGET_PER_MINUTE = float(os.getenv("GAIA_HEDGE_BUDGET_PER_MINUTE", "30"))
+
+
+class TtftWindow:
+    """Last `size` times to first token of one assistant; quantile() is cached until the next sample."""
+
+    __slots__ = ("_samples", "_cached")
+
+    def __init__(self, size: int = WINDOW):
+        self._samples: Deque[float] = deque(maxlen=max(1, size))
+        self._cached: Optional[float] = None
+
+    def __len__(self) -> int:
+        return len(self._samples)
+
+    def add(self, seconds: float) -> None:
+        self._samples.append(seconds)
+        self._cached = None
+
+    def quantile(self, q: float = QUANTILE) -> float:
+        if self._cached is None:
+            ordered = sorted(self._samples)
+            self._cached = ordered[min(len(ordered) - 1, int(q * len(ordered)))] if ordered else 0.0
+        return self._cached
+
+
+class Budget:
+    """Token bucket: `per_minute` hedges per minute, at most `per_minute` at once (event-loop only)."""
+
+    def __init__(self, per_minute: float = BUDGET_PER_MINUTE):
+        self.per_minute = max(0.0, per_minute)
+        self._tokens = self.per_minute
+        self._stamp = time.monotonic()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self._tokens = min(self.per_minute, self._tokens + (now - self._stamp) * self.per_minute / 60.0)
+        self._stamp = now
+
+    def try_take(self) -> bool:
+        self._refill()
+        if self._tokens < 1.0:
+            return False
+        self._tokens -= 1.0
+        return True
+
+    @property
+    def available(self) -> float:
+        self._refill()
+        return self._tokens
+
+
+_windows: Dict[str, TtftWindow] = {}
+_budget = Budget()
+
+
+def observe(assistantid: Optional[str], seconds: float) -> None:
+    """Record the time to first token of one upstream request (measured from its own start)."""
+    key = assistantid or ""
+    window = _windows.get(key)
+    if window is None:
+        window = _windows[key] = TtftWindow()
+    window.add(seconds)
+
+
+def delay(assistantid: Optional[str]) -> float:
+    """Seconds to wait for a first token before hedging this assistant's call."""
+    window = _windows.get(assistantid or "")
+    if window is None or len(window) < MIN_SAMPLES:
+        return DEFAULT_DELAY
+    return min(MAX_DELAY, max(MIN_DELAY, window.quantile()))
+
+
+def _window_key() -> str:
+    return f"hedge:budget:{int(time.time() // 60)}"
+
+
+def _take() -> bool:
+    state = shared_state.get_state()
+    if state.shared:
+        try:
+            return state.incr(_window_key(), 1, ttl=120) <= BUDGET_PER_MINUTE
+        except shared_state.SharedStateError:
+            pass  # 共享状态不可用：改用本进程的令牌桶
+    return _budget.try_take()
+
+
+def _available() -> float:
+    state = shared_state.get_state()
+    if state.shared:
+        try:
+            return max(0.0, BUDGET_PER_MINUTE - int(state.get(_window_key()) or 0))
+        except shared_state.SharedStateError:
+            pass
+    return _budget.available
+
+
+async def acquire() -> bool:
+    """Take one hedge from the budget; counts the hedge (or the skip)."""
+    taken = await asyncio.to_thread(_take) if shared_state.get_state().shared else _take()
+    if taken:
+        metrics.inc("gaia_hedges_total", **metrics.context_labels())
+        return True
+    metrics.inc("gaia_hedge_skipped_total", reason="budget")
+    return False
+
+
+def stats() -> dict:
+    return {
+        "enabled": ENABLED,
+        "budget_per_minute": _budget.per_minute,
+        "budget_available": round(_available(), 2),
+        "delays": {k or "-": round(delay(k), 3) for k in _windows},
+    }
@@ -0,0 +1,189 @@
+"""Compressed, conditional JSON responses for the GET endpoints.
+
+respond() serializes a body once and derives a strong ETag from it (BLAKE2b
+of the JSON bytes). A request whose If-None-Match carries that tag gets a 304
+without a body. Otherwise the body is compressed with the best encoding the
+client accepts (br / zstd when their optional packages are installed, gzip
+always), provided it is at least HTTP_COMPRESS_MIN_BYTES long.
+
+A compressed response is a different representation, so its ETag carries the
+encoding ("<hash>-gzip"); If-None-Match compares only the hash part, so a tag
+obtained with one encoding still validates after the client switches to another.
+
+Given a store (result_cache.Representations), the ETag, the identity body and
+every compressed variant are kept next to the cache entry: a hot result is
+serialized and compressed once, not per request.
+
+arespond() is the entry point for the event loop: when that work has to be
+done for a body of at least HTTP_OFFLOAD_MIN_BYTES, the whole respond() call
+runs in a worker thread, so a large miss does not stall other requests.
+
+Settings:
+- HTTP_COMPRESS (default true)
+- HTTP_COMPRESS_MIN_BYTES (default 1024)
+- HTTP_ENCODINGS: server preference among the available encodings (default br,zstd,gzip)
+- HTTP_GZIP_LEVEL (6), HTTP_BROTLI_QUALITY (5), HTTP_ZSTD_LEVEL (3)
+- HTTP_CACHE_CONTROL (default "no-cache": clients keep the response but revalidate it)
+- HTTP_OFFLOAD_MIN_BYTES (default 32768)
+"""
+import asyncio
+import gzip
+import hashlib
+import os
+from typing import Callable, Dict, Optional
+
+from fastapi import Request
+from fastapi.responses import Response
+
+from . import metrics
+
+try:
+    import brotli
+except ImportError:  # optional dependency
+    try:
+        import brotlicffi as brotli
+    except ImportError:
+        brotli = None
+
+try:
+    import zstandard
+except ImportError:  # optional dependency
+    zstandard = None
+
+COMPRESS = os.getenv("HTTP_COMPRESS", "true").lower() in ("1", "true", "yes", "on")
+MIN_BYTES = int(os.getenv("HTTP_COMPRESS_MIN_BYTES", "1024"))
+GZIP_LEVEL = int(os.getenv("HTTP_GZIP_LEVEL", "6"))
+BROTLI_QUALITY = int(os.getenv("HTTP_BROTLI_QUALITY", "5"))
+ZSTD_LEVEL = int(os.getenv("HTTP_ZSTD_LEVEL", "3"))
+CACHE_CONTROL = os.getenv("HTTP_CACHE_CONTROL", "no-cache")
+OFFLOAD_BYTES = int(os.getenv("HTTP_OFFLOAD_MIN_BYTES", "32768"))
+
+
+def _gzip(data: bytes) -> bytes:
+    # mtime=0：相同内容得到相同字节
+    return gzip.compress(data, compresslevel=GZIP_LEVEL, mtime=0)
+
+
+def _brotli(data: bytes) -> bytes:
+    return brotli.compress(data, quality=BROTLI_QUALITY)
+
+
+def _zstd(data: bytes) -> bytes:
+    return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(data)
+
+
+_CODECS: Dict[str, Callable[[bytes], bytes]] = {"gzip": _gzip}
+if brotli is not None:
+    _CODECS["br"] = _brotli
+if zstandard is not None:
+    _CODECS["zstd"] = _zstd
+
+ENCODINGS = [
+    e for e in (p.strip().lower() for p in os.getenv("HTTP_ENCODINGS", "br,zstd,gzip").split(","))
+    if e in _CODECS
+]
+
+
+def negotiate(accept_encoding: Optional[str]) -> Optional[str]:
+    """Preferred encoding the client accepts (q > 0), None for identity."""
+    if not COMPRESS or not accept_encoding:
+        return None
+    accepted: Dict[str, float] = {}
+    for part in accept_encoding.split(","):
+        name, _, params = part.partition(";")
+        name = name.strip().lower()
+        if not name:
+            continue
+        q = 1.0
+        for param in params.split(";"):
+            k, _, v = param.partition("=")
+            if k.strip().lower() == "q":
+                try:
+                    q = float(v)
+                except ValueError:
+                    q = 0.0
+        accepted[name] = q
+    best, best_q = None, 0.0
+    for enc in ENCODINGS:
+        q = accepted.get(enc, accepted.get("*", 0.0))
+        if q > best_q:  # 同等 q 值时按服务端顺序
+            best, best_q = enc, q
+    return best
+
+
+def make_etag(body: bytes) -> str:
+    return '"' + hashlib.blake2b(body, digest_size=16).hexdigest() + '"'
+
+
+def _opaque(tag: str) -> str:
+    tag = tag.strip()
+    if tag.startswith("W/"):
+        tag = tag[2:]
+    return tag.strip('"').split("-", 1)[0]
+
+
+def not_modified(if_none_match: Optional[str], etag: str) -> bool:
+    """If-None-Match check (weak comparison, encoding suffix ignored)."""
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    current = _opaque(etag)
+    return any(_opaque(t) == current for t in if_none_match.split(",") if t.strip())
+
+
+def compress(encoding: str, body: bytes) -> bytes:
+    with metrics.timer("ifu_result_processing_seconds", stage="compress"):
+        return _CODECS[encoding](body)
+
+
+def respond(request: Request, render: Callable[[], bytes], store=None,
+            media_type: str = "application/json") -> Response:
+    """Response for the body `render()` returns, reusing/filling `store` when given."""
+    etag = store.get("etag") if store is not None else None
+    body = store.get("identity") if store is not None else None
+    if etag is None or body is None:
+        body = render()
+        etag = make_etag(body).encode()
+        if store is not None:
+            store.put("identity", body)
+            store.put("etag", etag)
+    tag = etag.decode()
+    headers = {"ETag": tag, "Vary": "Accept-Encoding", "Cache-Control": CACHE_CONTROL}
+    if not_modified(request.headers.get("if-none-match"), tag):
+        metrics.inc("http_not_modified_total", **metrics.context_labels())
+        return Response(status_code=304, headers=headers)
+    encoding = negotiate(request.headers.get("accept-encoding")) if len(body) >= MIN_BYTES else None
+    if encoding is None:
+        metrics.inc("http_response_bytes_total", len(body), encoding="identity")
+        return Response(body, media_type=media_type, headers=headers)
+    data = store.get(encoding) if store is not None else None
+    if data is None:
+        data = compress(encoding, body)
+        if store is not None:
+            store.put(encoding, data)
+    headers["ETag"] = f'"{_opaque(tag)}-{encoding}"'
+    headers["Content-Encoding"] = encoding
+    metrics.inc("http_response_bytes_total", len(data), encoding=encoding)
+    metrics.inc("http_response_uncompressed_bytes_total", len(body), encoding=encoding)
+    return Response(data, media_type=media_type, headers=headers)
+
+
+async def arespond(request: Request, render: Callable[[], bytes], store=None,
+                   media_type: str = "application/json", size_hint: int = 0) -> Response:
+    """respond() for the event loop; serializing or compressing a large body runs in a worker thread.
+
+    size_hint estimates the body size while nothing is stored yet (e.g. the
+    length of the upstream text the body is built from).
+    """
+    body = store.get("identity") if store is not None else None
+    if body is None or store.get("etag") is None:
+        heavy = size_hint >= OFFLOAD_BYTES
+    else:
+        # 已有序列化结果：只有还需要压缩时才可能耗时
+        encoding = negotiate(request.headers.get("accept-encoding")) if len(body) >= MIN_BYTES else None
+        heavy = encoding is not None and store.get(encoding) is None and len(body) >= OFFLOAD_BYTES
+    if heavy:
+        metrics.inc("http_offloaded_total")
+        return await asyncio.to_thread(respond, request, render, store, media_type)
+    return respond(request, render, store, media_type)
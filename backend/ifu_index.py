@@ -0,0 +1,367 @@
+"""Local full-text index of IFU documents.
+
+Ingest extracts text per page from the IFU PDFs of one GAIA container and
+writes an on-disk inverted index; search ranks pages with BM25 and returns
+doc/page/snippet without any LLM round trip.
+
+Layout:
+    IFU_PDF_DIR/<containerid>/**/*.pdf            source documents
+    IFU_INDEX_DIR/<containerid>/index.json        docs, page table and postings
+    IFU_INDEX_DIR/<containerid>/<store>/<n>.bin   page texts of doc n (see page_store)
+    IFU_INDEX_DIR/<containerid>/<store>/<n>.off   page offset table of doc n
+    IFU_INDEX_DIR/<containerid>/<store>/embeddings-<model>.npy
+                                                  page vectors for mode=ask (see retrieval)
+
+<store> is a per-build generation directory named in index.json, so a worker
+still holding the previous index never opens page files of a newer build.
+
+Tokenization is CJK-aware: runs of CJK characters become overlapping
+bigrams (a lone character stays a unigram), other scripts are split into
+case-folded alphanumeric words.
+
+CLI:
+    python -m backend.ifu_index ingest [containerid ...]
+    python -m backend.ifu_index search <containerid> <query>
+"""
+import json
+import logging
+import math
+import os
+import re
+import shutil
+import sys
+import threading
+import time
+import unicodedata
+from array import array
+from collections import Counter
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from .page_store import PageStore, write_document
+
+logger = logging.getLogger("ifu_index")
+
+IFU_PDF_DIR = Path(os.getenv("IFU_PDF_DIR", str(Path(__file__).with_name("ifus"))))
+IFU_INDEX_DIR = Path(os.getenv("IFU_INDEX_DIR", str(Path(__file__).with_name("ifu_index"))))
+SNIPPET_CHARS = int(os.getenv("IFU_SNIPPET_CHARS", "400"))
+# 被新一代索引替换后，旧页面映射再保留多久才关闭（正在进行的检索仍可能读取）
+RETIRE_SECONDS = float(os.getenv("IFU_INDEX_RETIRE_SECONDS", "60"))
+
+# BM25 parameters
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+INDEX_VERSION = 2
+# 页面窗口按字节切片；中日韩文字在 UTF-8 中占 3 字节
+SNIPPET_BYTES = SNIPPET_CHARS * 3
+
+# Kana, CJK ideographs (incl. ext. A and compatibility) and Hangul
+_CJK = "\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff\uac00-\ud7af"
+_CJK_RE = re.compile(f"[{_CJK}]")
+_TOKEN_RE = re.compile(f"[{_CJK}]+|[^\\W_{_CJK}]+")
+
+
+def normalize_text(text: str) -> str:
+    return unicodedata.normalize("NFKC", text or "")
+
+
+def tokenize(text: str) -> List[str]:
+    """CJK bigrams + case-folded words."""
+    tokens: List[str] = []
+    for run in _TOKEN_RE.findall(normalize_text(text).casefold()):
+        if _CJK_RE.match(run):
+            if len(run) == 1:
+                tokens.append(run)
+            else:
+                tokens.extend(run[i:i + 2] for i in range(len(run) - 1))
+        else:
+            tokens.append(run)
+    return tokens
+
+
+# =============================
+# Ingest
+# =============================
+def extract_pages(pdf_path: Path) -> List[str]:
+    """Return the text of every page of a PDF (requires the optional `pypdf` package)."""
+    try:
+        from pypdf import PdfReader
+    except ImportError as e:
+        raise RuntimeError("IFU ingest 需要安装 pypdf：pip install pypdf") from e
+    reader = PdfReader(str(pdf_path))
+    pages = []
+    for page in reader.pages:
+        try:
+            pages.append(normalize_text(page.extract_text() or ""))
+        except Exception as e:
+            logger.warning("提取 %s 第 %s 页失败: %s", pdf_path.name, len(pages) + 1, e)
+            pages.append("")
+    return pages
+
+
+def build_index(containerid: str, pdf_dir: Optional[Path] = None, index_dir: Optional[Path] = None) -> Dict[str, int]:
+    """Extract every PDF under pdf_dir/<containerid> and write its index to index_dir/<containerid>."""
+    src = (pdf_dir or IFU_PDF_DIR) / containerid
+    pdfs = sorted(p for p in src.rglob("*") if p.suffix.lower() == ".pdf")
+    if not pdfs:
+        raise FileNotFoundError(f"未找到 PDF：{src}")
+    documents = ((pdf.relative_to(src).as_posix(), extract_pages(pdf)) for pdf in pdfs)
+    return write_index(containerid, documents, index_dir)
+
+
+def write_index(containerid: str, documents: Iterable[Tuple[str, List[str]]], index_dir: Optional[Path] = None) -> Dict[str, int]:
+    """Write the index for (doc name, [page text, ...]) pairs; pages are numbered from 1."""
+    dst = (index_dir or IFU_INDEX_DIR) / containerid
+    store = f"store-{time.time_ns()}"
+    (dst / store).mkdir(parents=True, exist_ok=True)
+    docs: List[str] = []
+    pages: List[list] = []  # [doc_idx, page_no, length]
+    postings: Dict[str, list] = {}
+    for doc, texts in documents:
+        doc_idx = len(docs)
+        docs.append(doc)
+        texts = [normalize_text(t) for t in texts]
+        for page_no, text in enumerate(texts, start=1):
+            page_id = len(pages)
+            tokens = tokenize(text)
+            pages.append([doc_idx, page_no, len(tokens)])
+            for term, tf in Counter(tokens).items():
+                postings.setdefault(term, []).append([page_id, tf])
+        write_document(PageStore.doc_base(dst / store, doc_idx), texts)
+
+    total = sum(p[2] for p in pages)
+    index = {
+        "version": INDEX_VERSION,
+        "containerid": containerid,
+        "built_at": time.time(),
+        "store": store,
+        "docs": docs,
+        "pages": pages,
+        "avgdl": (total / len(pages)) if pages else 0.0,
+        "postings": postings,
+    }
+    tmp_index = dst / "index.json.tmp"
+    tmp_index.write_text(json.dumps(index, ensure_ascii=False, separators=(",", ":")), encoding="utf-8")
+    # 页面文件先于 index 落盘：读端以 index.json 的 mtime 判断是否需要重新加载
+    previous = _current_store(dst)
+    tmp_index.replace(dst / "index.json")
+    # 只保留当前与上一代页面文件（其它 worker 可能仍映射着上一代）
+    for old in dst.glob("store-*"):
+        if old.name not in (store, previous):
+            shutil.rmtree(old, ignore_errors=True)
+    logger.info("IFU 索引完成 %s: %s 个文档, %s 页, %s 个词项", containerid, len(docs), len(pages), len(postings))
+    return {"docs": len(docs), "pages": len(pages), "terms": len(postings)}
+
+
+def _current_store(dst: Path) -> Optional[str]:
+    try:
+        return json.loads((dst / "index.json").read_text(encoding="utf-8")).get("store")
+    except (OSError, ValueError):
+        return None
+
+
+# =============================
+# Search
+# =============================
+class IfuIndex:
+    """One container's inverted index plus its memory-mapped page store, loaded read-only."""
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.mtime = (path / "index.json").stat().st_mtime
+        data = json.loads((path / "index.json").read_text(encoding="utf-8"))
+        if data.get("version") != INDEX_VERSION:
+            raise RuntimeError(f"不支持的索引版本：{data.get('version')}，请重新运行 ingest")
+        self.containerid: str = data["containerid"]
+        self.docs: List[str] = data["docs"]
+        self.avgdl: float = data["avgdl"] or 1.0
+        self.postings: Dict[str, list] = data["postings"]
+        # 页表压缩为定长数组，避免每页一个 Python list
+        self.page_doc = array("I", (p[0] for p in data["pages"]))
+        self.page_no = array("I", (p[1] for p in data["pages"]))
+        self.page_len = array("I", (p[2] for p in data["pages"]))
+        self._doc_ids = {doc: i for i, doc in enumerate(self.docs)}
+        self.store = PageStore(path / data["store"], self.docs)
+
+    def page_text(self, doc: str, page: int) -> Optional[str]:
+        doc_idx = self._doc_ids.get(doc)
+        return None if doc_idx is None else self.store.document(doc_idx).page_text(page)
+
+    def rank(self, query: str, top_k: int = 20) -> List[Tuple[int, float]]:
+        """BM25 top-k as (page_id, score), best first."""
+        terms = list(dict.fromkeys(tokenize(query)))
+        if not terms or not self.page_len:
+            return []
+        n = len(self.page_len)
+        page_len = self.page_len
+        scores: Dict[int, float] = {}
+        for term in terms:
+            plist = self.postings.get(term)
+            if not plist:
+                continue
+            idf = math.log(1.0 + (n - len(plist) + 0.5) / (len(plist) + 0.5))
+            for page_id, tf in plist:
+                dl = page_len[page_id]
+                norm = tf * (BM25_K1 + 1) / (tf + BM25_K1 * (1 - BM25_B + BM25_B * dl / self.avgdl))
+                scores[page_id] = scores.get(page_id, 0.0) + idf * norm
+        return sorted(scores.items(), key=lambda kv: kv[1], reverse=True)[:top_k]
+
+    def search(self, query: str, top_k: int = 20) -> List[dict]:
+        needles = snippet_needles(query)
+        hits = []
+        for page_id, score in self.rank(query, top_k):
+            doc_idx, page_no = self.page_doc[page_id], self.page_no[page_id]
+            hits.append({
+                "doc": self.docs[doc_idx],
+                "page": page_no,
+                "score": round(score, 4),
+                "snippet": self.snippet(doc_idx, page_no, needles),
+            })
+        return hits
+
+    def snippet(self, doc_idx: int, page: int, needles: List[bytes], width: int = SNIPPET_CHARS) -> str:
+        """Window of about `width` chars centred on the first needle hit (or the page start)."""
+        doc = self.store.document(doc_idx)
+        pos = doc.find(page, needles)
+        if pos < 0:
+            text, _ = doc.window(page, None, SNIPPET_BYTES)
+            return text[:width].strip()
+        text, hit = doc.window(page, pos, SNIPPET_BYTES)
+        # 字节窗口对 ASCII 文本偏宽：按字符再以命中位置为中心裁剪
+        start = max(0, min(hit - width // 2, len(text) - width))
+        return text[start:start + width].strip()
+
+
+def snippet_needles(query: str) -> List[bytes]:
+    """Byte patterns to locate a hit in the mapped page: the whole query, then each token
+    in a few common casings (the mapping is searched case-sensitively)."""
+    out: List[bytes] = []
+    whole = normalize_text(query).strip()
+    for cand in [whole, whole.lower()] + [
+        v for tok in tokenize(query) for v in (tok, tok.capitalize(), tok.upper())
+    ]:
+        b = cand.encode("utf-8")
+        if b and b not in out:
+            out.append(b)
+    return out
+
+
+_lock = threading.Lock()
+_indexes: Dict[str, IfuIndex] = {}
+# containerid -> 加载锁：同一容器只加载一次，其它容器的查找不受影响
+_load_locks: Dict[str, threading.Lock] = {}
+
+
+def _current(containerid: str, mtime: float) -> Optional[IfuIndex]:
+    with _lock:
+        idx = _indexes.get(containerid)
+    return idx if idx is not None and idx.mtime == mtime else None
+
+
+def _retire(idx: IfuIndex) -> None:
+    timer = threading.Timer(RETIRE_SECONDS, idx.store.close)
+    timer.daemon = True
+    timer.start()
+
+
+def _container_dir(containerid: str) -> Optional[Path]:
+    """IFU_INDEX_DIR/<containerid>, or None when the id would leave IFU_INDEX_DIR (.., absolute paths, separators)."""
+    if not containerid or containerid in (".", "..") or "/" in containerid or "\\" in containerid:
+        return None
+    path = IFU_INDEX_DIR / containerid
+    # 单个路径段仍可能是盘符等绝对路径（Windows）：要求仍直接位于 IFU_INDEX_DIR 下
+    return path if path.parent == IFU_INDEX_DIR and not Path(containerid).is_absolute() else None
+
+
+def get_index(containerid: str) -> Optional[IfuIndex]:
+    """Load (or reload after a new ingest) the index for one container; None if not built."""
+    path = _container_dir(containerid)
+    if path is None:
+        return None
+    try:
+        mtime = (path / "index.json").stat().st_mtime
+    except OSError:
+        return None
+    idx = _current(containerid, mtime)
+    if idx is not None:
+        return idx
+    with _lock:
+        load_lock = _load_locks.setdefault(containerid, threading.Lock())
+    with load_lock:
+        idx = _current(containerid, mtime)
+        if idx is not None:
+            return idx
+        idx = IfuIndex(path)  # 读取整个 index.json，不占用全局锁
+        with _lock:
+            old = _indexes.get(containerid)
+            _indexes[containerid] = idx
+    if old is not None:
+        _retire(old)
+    return idx
+
+
+def available_containers() -> List[str]:
+    if not IFU_INDEX_DIR.is_dir():
+        return []
+    return sorted(p.name for p in IFU_INDEX_DIR.iterdir() if (p / "index.json").is_file())
+
+
+def find_page(doc_path: str, page: int, containerids: Iterable[str] = ()) -> Optional[str]:
+    """Page text for doc_path ("<containerid>/<doc>" or a bare doc name) across indexed containers."""
+    doc_path = (doc_path or "").strip().lstrip("/")
+    if ".." in doc_path.replace("\\", "/").split("/"):
+        return None
+    head, _, rest = doc_path.partition("/")
+    head_dir = _container_dir(head) if rest else None
+    if head_dir is not None and (head_dir / "index.json").is_file():
+        idx = get_index(head)
+        return idx.page_text(rest, page) if idx else None
+    for cid in list(containerids) or available_containers():
+        idx = get_index(cid)
+        if idx is not None:
+            text = idx.page_text(doc_path, page)
+            if text is not None:
+                return text
+    return None
+
+
+def _main(argv: List[str]) -> int:
+    logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO"))
+    if not argv or argv[0] not in ("ingest", "search"):
+        print(__doc__)
+        return 2
+    if argv[0] == "ingest":
+        containers = argv[1:]
+        if not containers:
+            from .ifu_registry import get_registry
+            containers = get_registry().index.containers()
+        from . import retrieval
+        status = 0
+        for cid in containers:
+            try:
+                print(cid, build_index(cid))
+                if retrieval.available():
+                    # mode=ask 混合检索用的页面向量随索引一起生成，不留到第一次查询
+                    print(cid, {"embeddings": retrieval.build_embeddings(cid)})
+            except Exception as e:
+                print(cid, f"失败: {e}", file=sys.stderr)
+                status = 1
+        return status
+    if len(argv) < 3:
+        print(__doc__)
+        return 2
+    idx = get_index(argv[1])
+    if idx is None:
+        print(f"索引不存在：{argv[1]}", file=sys.stderr)
+        return 1
+    t0 = time.perf_counter()
+    hits = idx.search(" ".join(argv[2:]))
+    for h in hits:
+        print(f"{h['score']:8.3f}  {h['doc']} p.{h['page']}  {h['snippet'][:80]!r}")
+    print(f"{len(hits)} hits in {(time.perf_counter() - t0) * 1000:.2f} ms")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(_main(sys.argv[1:]))
@@ -0,0 +1,305 @@
+"""Device model registry for /api/get_ifu: model name -> (assistantid, containerid).
+
+The mapping lives in a JSON data file (IFU_MODELS_FILE, default
+backend/ifu_models.json):
+
+    {"models": [{"model": "Vista 300", "assistantid": "...", "containerid": "...",
+                 "aliases": ["Vista300", "V300"]}]}
+
+and is compiled into a lookup index over normalized names (NFKC, case-folded,
+only letters and digits kept, so "VISTA-300" == "vista 300"):
+
+1. exact: hash of the normalized name;
+2. prefix: a trie over every name, entered also from each word start
+   ("vista300", "300"), so "Vista" or "300" still resolve; every node keeps
+   its best entry, so a lookup costs one step per query character;
+3. fuzzy, for OCR/QR noise: characters that OCR confuses (0/o, 1/i/l, 5/s,
+   8/b, 2/z) are folded together, so "Vlsta 3OO" hits "Vista 300" directly;
+   otherwise a SymSpell-style delete index finds names within
+   IFU_REGISTRY_MAX_EDITS further edits, verified with the optimal string
+   alignment distance. Each extra allowed edit multiplies the size of the
+   delete index by roughly the name length, hence the default of 1.
+
+Among several prefix candidates the earliest row in the file wins; among fuzzy
+candidates the closest one, then the earliest. The data file is checked for changes at most every
+IFU_REGISTRY_CHECK_INTERVAL seconds. On change, a new index is built off to
+the side and swapped in with one assignment, so lookups never see a half-built
+index. A file that fails to load keeps the previous index.
+"""
+import json
+import logging
+import os
+import threading
+import time
+import unicodedata
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from . import metrics
+
+logger = logging.getLogger("ifu_registry")
+
+MODELS_FILE = os.getenv("IFU_MODELS_FILE", str(Path(__file__).with_name("ifu_models.json")))
+MAX_EDITS = int(os.getenv("IFU_REGISTRY_MAX_EDITS", "1"))
+CHECK_INTERVAL = float(os.getenv("IFU_REGISTRY_CHECK_INTERVAL", "2"))
+# 少于该长度的查询不做模糊匹配（太短的字符串编辑距离没有区分度）
+FUZZY_MIN_CHARS = int(os.getenv("IFU_REGISTRY_FUZZY_MIN_CHARS", "4"))
+
+# (model, assistantid, containerid)
+Entry = Tuple[str, str, str]
+
+_BEST = ""  # trie 节点中存放最佳条目的键（字符键均为单个字符，不会冲突）
+
+# OCR 易混淆字符归为一类
+_OCR_FOLD = str.maketrans({"0": "o", "1": "l", "i": "l", "5": "s", "8": "b", "2": "z"})
+
+
+def normalize(text: str) -> str:
+    """NFKC + case-fold, letters and digits only."""
+    text = unicodedata.normalize("NFKC", text or "").casefold()
+    return "".join(ch for ch in text if ch.isalnum())
+
+
+def fold(key: str) -> str:
+    """Map OCR look-alikes in a normalized key to one representative."""
+    return key.translate(_OCR_FOLD)
+
+
+def _word_starts(text: str) -> List[int]:
+    """Offsets in normalize(text) where a word starts (after separators and at letter/digit switches)."""
+    text = unicodedata.normalize("NFKC", text or "").casefold()
+    starts: List[int] = []
+    pos = 0
+    prev = None  # 上一个字符的类别：'d' 数字 / 'a' 其它字母；None 表示分隔符
+    for ch in text:
+        if not ch.isalnum():
+            prev = None
+            continue
+        kind = "d" if ch.isdigit() else "a"
+        if kind != prev:
+            starts.append(pos)
+        prev = kind
+        pos += 1
+    return starts
+
+
+def _deletes(word: str, max_edits: int) -> set:
+    out = {word}
+    frontier = {word}
+    for _ in range(max_edits):
+        nxt = set()
+        for w in frontier:
+            if len(w) <= 1:
+                continue
+            for i in range(len(w)):
+                nxt.add(w[:i] + w[i + 1:])
+        out |= nxt
+        frontier = nxt
+    return out
+
+
+def _osa_distance(a: str, b: str, limit: int) -> int:
+    """Optimal string alignment distance, or limit + 1 when it exceeds limit."""
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    prev2: List[int] = []
+    prev = list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        cur = [i] + [0] * len(b)
+        row_min = i
+        for j in range(1, len(b) + 1):
+            cost = 0 if a[i - 1] == b[j - 1] else 1
+            v = min(prev[j] + 1, cur[j - 1] + 1, prev[j - 1] + cost)
+            if i > 1 and j > 1 and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]:
+                v = min(v, prev2[j - 2] + 1)
+            cur[j] = v
+            row_min = min(row_min, v)
+        if row_min > limit:
+            return limit + 1
+        prev2, prev = prev, cur
+    return prev[-1]
+
+
+class RegistryIndex:
+    """Immutable lookup index built from a list of (name, entry) pairs."""
+
+    __slots__ = ("entries", "_exact", "_trie", "_folded", "_deletes", "_names", "max_edits")
+
+    def __init__(self, rows: Iterable[Tuple[str, Entry]], max_edits: int = MAX_EDITS):
+        self.max_edits = max_edits
+        self.entries: List[Entry] = []
+        self._names: List[str] = []  # 归并 OCR 混淆字符后的名称，下标即行号（rank）
+        self._exact: Dict[str, int] = {}
+        self._trie: dict = {}
+        self._folded: Dict[str, int] = {}
+        self._deletes: Dict[str, object] = {}
+        for name, entry in rows:
+            key = normalize(name)
+            if not key:
+                continue
+            rank = len(self._names)
+            folded = fold(key)
+            self._names.append(folded)
+            self.entries.append(entry)
+            self._exact.setdefault(key, rank)
+            self._folded.setdefault(folded, rank)
+            for start in _word_starts(name):
+                self._insert(key[start:], rank)
+            if max_edits > 0 and len(key) >= FUZZY_MIN_CHARS:
+                for d in _deletes(folded, max_edits):
+                    hit = self._deletes.get(d)
+                    if hit is None:
+                        self._deletes[d] = rank
+                    elif isinstance(hit, list):
+                        hit.append(rank)
+                    elif hit != rank:
+                        self._deletes[d] = [hit, rank]
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def _insert(self, suffix: str, rank: int) -> None:
+        node = self._trie
+        for ch in suffix:
+            node = node.setdefault(ch, {})
+            # 行号递增插入：节点上已有的条目总是更靠前
+            node.setdefault(_BEST, rank)
+
+    def lookup(self, query: str) -> Optional[Tuple[Entry, str]]:
+        """(entry, match kind) for a raw model string; kind is exact, prefix or fuzzy."""
+        key = normalize(query)
+        if not key:
+            return None
+        rank = self._exact.get(key)
+        if rank is not None:
+            return self.entries[rank], "exact"
+        node = self._trie
+        for ch in key:
+            node = node.get(ch)
+            if node is None:
+                break
+        else:
+            return self.entries[node[_BEST]], "prefix"
+        rank = self._fuzzy(key)
+        if rank is not None:
+            return self.entries[rank], "fuzzy"
+        return None
+
+    def _fuzzy(self, key: str) -> Optional[int]:
+        key = fold(key)
+        rank = self._folded.get(key)
+        if rank is not None:
+            return rank
+        if self.max_edits <= 0 or len(key) < FUZZY_MIN_CHARS:
+            return None
+        limit = min(self.max_edits, max(1, len(key) // 4))
+        best: Optional[Tuple[int, int]] = None  # (distance, rank)
+        seen = set()
+        for d in _deletes(key, limit):
+            hit = self._deletes.get(d)
+            if hit is None:
+                continue
+            for rank in (hit if isinstance(hit, list) else (hit,)):
+                if rank in seen:
+                    continue
+                seen.add(rank)
+                dist = _osa_distance(key, self._names[rank], limit)
+                if dist <= limit and (best is None or (dist, rank) < best):
+                    best = (dist, rank)
+        return None if best is None else best[1]
+
+    def assistant_container(self, assistantid: str) -> str:
+        """containerid of the first entry for an assistant ("" if none)."""
+        for _, aid, cid in self.entries:
+            if aid == assistantid and cid:
+                return cid
+        return ""
+
+    def containers(self) -> List[str]:
+        return sorted({cid for _, _, cid in self.entries if cid})
+
+
+def load_rows(path: str) -> List[Tuple[str, Entry]]:
+    """(name, entry) pairs from the data file; each alias becomes its own row."""
+    data = json.loads(Path(path).read_text(encoding="utf-8"))
+    rows: List[Tuple[str, Entry]] = []
+    for item in data.get("models", []) if isinstance(data, dict) else []:
+        if not isinstance(item, dict) or not item.get("model"):
+            continue
+        entry = (str(item["model"]), str(item.get("assistantid") or ""), str(item.get("containerid") or ""))
+        rows.append((entry[0], entry))
+        for alias in item.get("aliases") or ():
+            rows.append((str(alias), entry))
+    return rows
+
+
+class Registry:
+    """RegistryIndex bound to a data file, rebuilt when the file changes."""
+
+    def __init__(self, path: str = MODELS_FILE, check_interval: float = CHECK_INTERVAL):
+        self.path = path
+        self.check_interval = check_interval
+        self._index = RegistryIndex(())
+        self._mtime: Optional[Tuple[float, int]] = None
+        self._next_check = 0.0
+        self._reload_lock = threading.Lock()
+        self.reload()
+
+    @property
+    def index(self) -> RegistryIndex:
+        now = time.monotonic()
+        if now >= self._next_check:
+            self._next_check = now + self.check_interval
+            self._maybe_reload()
+        return self._index
+
+    def _stat(self) -> Optional[Tuple[float, int]]:
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return None
+        return st.st_mtime, st.st_size
+
+    def _maybe_reload(self) -> None:
+        if self._stat() != self._mtime:
+            self.reload()
+
+    def reload(self) -> bool:
+        """Rebuild from the data file; keeps the current index on failure."""
+        # 同一时间只由一个线程重建，其它线程继续使用旧索引
+        if not self._reload_lock.acquire(blocking=False):
+            return False
+        try:
+            stat = self._stat()
+            t0 = time.perf_counter()
+            try:
+                index = RegistryIndex(load_rows(self.path))
+            except Exception as e:
+                self._mtime = stat  # 文件再次变化前不再重试
+                metrics.inc("ifu_registry_reload_errors_total")
+                logger.warning("设备型号表加载失败（%s），继续使用旧数据: %s", self.path, e)
+                return False
+            self._index, self._mtime = index, stat
+            metrics.inc("ifu_registry_reloads_total")
+            logger.info("设备型号表已加载：%d 条，用时 %.1f ms", len(index), (time.perf_counter() - t0) * 1000)
+            return True
+        finally:
+            self._reload_lock.release()
+
+    def lookup(self, query: str) -> Optional[Tuple[Entry, str]]:
+        found = self.index.lookup(query)
+        metrics.inc("ifu_registry_lookups_total", match=found[1] if found else "none")
+        return found
+
+
+_registry: Optional[Registry] = None
+_registry_lock = threading.Lock()
+
+
+def get_registry() -> Registry:
+    global _registry
+    if _registry is None:
+        with _registry_lock:
+            if _registry is None:
+                _registry = Registry()
+    return _registry
@@ -0,0 +1,217 @@
+"""Logging setup: off-thread JSON records with request IDs and sampled payloads.
+
+setup() is called by the app at startup (main.lifespan), never on import. It
+adds one QueueHandler to the root logger; handlers the host already installed
+are left alone, and shutdown() removes it again. The request thread
+only attaches the request ID to the record and enqueues it. Message
+formatting, JSON encoding and the actual write happen on a QueueListener
+thread. Because of that, log arguments must not be mutated after the call
+(the code only logs values it no longer changes).
+
+- LOG_FORMAT=json (default): one JSON object per line with ts, level,
+  logger, msg, request_id, any `extra={...}` fields, and exc when present.
+  LOG_FORMAT=text gives the classic one-line format plus the request ID.
+- RequestIdMiddleware takes X-Request-ID from the client (or generates one),
+  keeps it in a ContextVar for the request, and echoes it in the response.
+- Payload logs (full request payload, upstream answer) are sampled per
+  request: sample_payload() is true for LOG_PAYLOAD_SAMPLE_RATE of requests
+  (default 1%) and only while GAIA_LOG_PAYLOADS is on. Error paths log their
+  payloads regardless.
+- prompt_ref() replaces prompt text by a short hash. The full text is
+  logged once per process the first time a hash is seen.
+
+A successful request therefore writes no INFO record by default (the prompt
+ID goes to DEBUG); see backend/bench/bench_logging.py for the cost.
+"""
+import atexit
+import contextvars
+import hashlib
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import re
+import sys
+import time
+import uuid
+from typing import Any, Dict, Optional
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json").strip().lower()
+LOG_PAYLOADS = os.getenv("GAIA_LOG_PAYLOADS", "true").lower() in ("1", "true", "yes", "on")
+PAYLOAD_SAMPLE_RATE = float(os.getenv("LOG_PAYLOAD_SAMPLE_RATE", "0.01"))
+MAX_LOG_CHARS = int(os.getenv("GAIA_MAX_LOG_CHARS", "2000"))
+# prompt_ref 记住的提示词哈希个数上限
+PROMPT_REF_CACHE = 1024
+
+REQUEST_ID_HEADER = "x-request-id"
+_REQUEST_ID_RE = re.compile(r"^[A-Za-z0-9._:-]{1,64}$")
+
+_request_id: contextvars.ContextVar = contextvars.ContextVar("request_id", default="")
+# 当前请求是否采样记录 payload（None：尚未决定）
+_sampled: contextvars.ContextVar = contextvars.ContextVar("payload_sampled", default=None)
+
+_listener: Optional[logging.handlers.QueueListener] = None
+_handler: Optional[logging.Handler] = None
+_seen_prompts: Dict[str, None] = {}
+
+logger = logging.getLogger("logs")
+
+# LogRecord 自带的属性；其余属性视为 extra 字段写入 JSON
+_RECORD_ATTRS = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime", "request_id"}
+
+
+def request_id() -> str:
+    return _request_id.get()
+
+
+def clip(value: Any, limit: int = MAX_LOG_CHARS) -> str:
+    """str(value) cut to `limit` characters for logging."""
+    try:
+        text = "" if value is None else str(value)
+    except Exception:
+        text = "<unprintable>"
+    if len(text) <= limit:
+        return text
+    return f"{text[:limit]}... [truncated {len(text) - limit} chars]"
+
+
+def sample_payload() -> bool:
+    """Whether this request logs full payloads (decided once per request)."""
+    if not LOG_PAYLOADS:
+        return False
+    sampled = _sampled.get()
+    if sampled is None:
+        sampled = random.random() < PAYLOAD_SAMPLE_RATE
+        _sampled.set(sampled)
+    return sampled
+
+
+def prompt_ref(text: Optional[str]) -> str:
+    """Short stable ID for a prompt; the full text is logged once under that ID."""
+    text = text or ""
+    ref = "p-" + hashlib.sha1(text.encode("utf-8")).hexdigest()[:12]
+    if ref not in _seen_prompts:
+        if len(_seen_prompts) >= PROMPT_REF_CACHE:
+            _seen_prompts.pop(next(iter(_seen_prompts)))
+        _seen_prompts[ref] = None
+        logger.info("prompt %s (%d chars): %s", ref, len(text), clip(text))
+    return ref
+
+
+def payload_summary(payload: Dict[str, Any]) -> Dict[str, Any]:
+    """Payload copy for logging, with system prompts replaced by prompt_ref()."""
+    out = dict(payload)
+    messages = payload.get("messages")
+    if isinstance(messages, list):
+        out["messages"] = [
+            {**m, "content": prompt_ref(m.get("content"))} if isinstance(m, dict) and m.get("role") == "system" else m
+            for m in messages
+        ]
+    return out
+
+
+class _RequestIdFilter(logging.Filter):
+    def filter(self, record: logging.LogRecord) -> bool:
+        if not hasattr(record, "request_id"):
+            record.request_id = _request_id.get()
+        return True
+
+
+class _DeferredQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that leaves formatting to the listener thread."""
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        if record.exc_info and not record.exc_text:
+            # traceback 在当前线程渲染，避免跨线程持有帧对象
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+        record.exc_info = None
+        return record
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        data: Dict[str, Any] = {
+            "ts": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(record.created)) + f".{int(record.msecs):03d}",
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        rid = getattr(record, "request_id", "")
+        if rid:
+            data["request_id"] = rid
+        for k, v in record.__dict__.items():
+            if k not in _RECORD_ATTRS and not k.startswith("_"):
+                data[k] = v
+        if record.exc_text:
+            data["exc"] = record.exc_text
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+
+def setup(stream=None) -> None:
+    """Route all logging through a background thread (idempotent)."""
+    global _listener, _handler
+    if _listener is not None:
+        return
+    target = logging.StreamHandler(stream or sys.stderr)
+    if LOG_FORMAT == "text":
+        target.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s [%(request_id)s] %(message)s"))
+    else:
+        target.setFormatter(JsonFormatter())
+    q: "queue.SimpleQueue[logging.LogRecord]" = queue.SimpleQueue()
+    handler = _DeferredQueueHandler(q)
+    handler.addFilter(_RequestIdFilter())
+    root = logging.getLogger()
+    root.addHandler(handler)
+    root.setLevel(LOG_LEVEL)
+    _handler = handler
+    _listener = logging.handlers.QueueListener(q, target, respect_handler_level=True)
+    _listener.start()
+    atexit.register(shutdown)
+
+
+def shutdown() -> None:
+    """Flush queued records, stop the listener thread and detach the handler."""
+    global _listener, _handler
+    if _handler is not None:
+        logging.getLogger().removeHandler(_handler)
+        _handler = None
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+class RequestIdMiddleware:
+    """ASGI middleware: one request ID per HTTP request (X-Request-ID in and out)."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        rid = ""
+        for name, value in scope.get("headers") or ():
+            if name == REQUEST_ID_HEADER.encode("latin-1"):
+                rid = value.decode("latin-1")
+                break
+        if not _REQUEST_ID_RE.match(rid):
+            rid = uuid.uuid4().hex[:16]
+        token = _request_id.set(rid)
+        sampled = _sampled.set(None)
+
+        async def send_with_id(message):
+            if message["type"] == "http.response.start":
+                headers = list(message.get("headers") or [])
+                headers.append((REQUEST_ID_HEADER.encode("latin-1"), rid.encode("latin-1")))
+                message = {**message, "headers": headers}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_id)
+        finally:
+            _sampled.reset(sampled)
+            _request_id.reset(token)
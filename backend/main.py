@@ -1,29 +1,48 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import Depends, FastAPI, Header, HTTPException, Query, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import HTMLResponse, Response
+from fastapi.responses import HTMLResponse, Response, StreamingResponse
 from pydantic import BaseModel, Field
+import asyncio
 import os
 import logging
-import json
-import threading
-from pathlib import Path
+from typing import Optional
+from contextlib import asynccontextmanager
+
+from fastapi.concurrency import run_in_threadpool
 
-from .gaia_client import call_gaia, call_ifu_search, call_atlan_qa
+from . import admission, breaker, cache_warmer, hedge, http_cache, ifu_index, ifu_registry, logs, metrics, result_cache, retrieval, shared_state, votes
+from .gaia_client import (
+    call_gaia, call_ifu_search, call_atlan_qa, aclose_client, prewarm_pool,
+    stream_gaia, stream_ifu_search, finalize_result, token_stats, STREAM_RESET, PLACEHOLDER,
+)
+from .results import FastJSONResponse, ResultStream, SearchResult, dumps, ifu_item, render_json
 
 logger = logging.getLogger("api")
-LOG_PAYLOADS = os.getenv("GAIA_LOG_PAYLOADS", "true").lower() in ("1", "true", "yes", "on")
-MAX_LOG_CHARS = int(os.getenv("GAIA_MAX_LOG_CHARS", "2000"))
 
-def _clip_for_log(s) -> str:
-    try:
-        t = "" if s is None else str(s)
-    except Exception:
-        t = "<unprintable>"
-    if len(t) <= MAX_LOG_CHARS:
-        return t
-    return f"{t[:MAX_LOG_CHARS]}... [truncated {len(t) - MAX_LOG_CHARS} chars]"
 
-app = FastAPI(title="Gaia Proxy API", version="0.2.0")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # 日志经队列在后台线程写出（LOG_FORMAT、LOG_LEVEL）
+    logs.setup()
+    # 后台预热到 GAIA 的长连接，不阻塞启动
+    warm = asyncio.create_task(prewarm_pool())
+    # 定时 / 启动后的结果缓存预热（IFU_WARM_ON_START、IFU_WARM_INTERVAL）
+    warm_schedule = asyncio.create_task(cache_warmer.schedule(_warmer))
+    yield
+    warm.cancel()
+    warm_schedule.cancel()
+    _warmer.cancel()
+    # 写入尚未落盘的投票
+    await run_in_threadpool(votes.close)
+    # 关闭到 GAIA 的连接池
+    await aclose_client()
+    logs.shutdown()
+
+
+app = FastAPI(title="Gaia Proxy API", version="0.2.0", lifespan=lifespan)
+
+# 请求级指标：endpoint / mode / assistantid 标签与每个接口的耗时（GET /metrics）
+app.add_middleware(metrics.RequestMetricsMiddleware)
 
 # CORS for local dev and miniprogram cloud envs
 origins = os.getenv("CORS_ORIGINS", "*")
@@ -32,10 +51,21 @@ app.add_middleware(
     allow_origins=[o.strip() for o in origins.split(",") if o.strip()] if origins else ["*"],
     allow_credentials=True,
     allow_methods=["*"],
-    allow_headers=["*"]
+    allow_headers=["*"],
+    expose_headers=["X-Request-ID", "ETag"],
 )
 
+# 请求 ID（X-Request-ID），写入该请求期间的每条日志；放在最外层，CORS 预检响应也带上
+app.add_middleware(logs.RequestIdMiddleware)
+
 DEFAULT_SYSTEM_PROMPT = os.getenv("DEFAULT_SYSTEM_PROMPT", "你是一个有帮助的助手，请用简洁中文回答。")
+# 管理接口令牌；未配置时管理接口不做校验（仅限内网部署）
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "")
+
+
+def _require_admin(x_admin_token: Optional[str] = Header(None)):
+    if ADMIN_TOKEN and x_admin_token != ADMIN_TOKEN:
+        raise HTTPException(status_code=403, detail="管理员令牌无效")
 
 
 class GaiaRequest(BaseModel):
@@ -54,6 +84,26 @@ def health():
     return {"status": "ok"}
 
 
+@app.get("/api/stats")
+async def stats():
+    # 进程内计数器（重试次数、等待时长、缓存命中、每次调用 token 分布等）
+    # 在事件循环上运行：准入、对冲、熔断的字典只由协程修改，这里遍历时不会被并发改动
+    data = metrics.snapshot()
+    data["cache"] = result_cache.cache.stats()
+    data["tokens"] = await token_stats()
+    data["admission"] = admission.stats()
+    data["hedge"] = hedge.stats()
+    data["breaker"] = breaker.stats()
+    data["shared_state"] = shared_state.stats()
+    return data
+
+
+@app.get("/metrics")
+def prometheus_metrics():
+    # Prometheus 文本格式：各阶段耗时直方图（排队、建连、首字节、首 token、整流、解析、序列化）与计数器
+    return Response(metrics.render_prometheus(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+
 @app.get("/", response_class=HTMLResponse)
 def root():
     # Simple landing page to avoid 404 and help users discover endpoints
@@ -99,31 +149,33 @@ class DocSearchResponse(BaseModel):
     results: list[DocSearchResultItem]
 
 
+# 系统提示：显式要求使用 Documents 搜索，并严格输出 JSON（仅结构，不要其它文字）
+DOC_SEARCH_SYSTEM_PROMPT = (
+    "你是文档检索与结构化助手。\n"
+    "必须使用 GAIA 的 Documents 搜索工具（document_rag_search 或后端已集成的 RAG 能力），\n"
+    "仅在 ragConfig.globFilter 指定的容器/文档范围内检索（若提供）。\n"
+    "严格返回 JSON，且只返回如下结构，不要任何多余文字：\n"
+    "{\"results\":[{\"doc\":string,\"page\":number,\"refId\":string,\"snippet\":string}]}\n"
+    "要求：\n"
+    "- doc: 使用来源的 sourceFile 或文档可辨识名称；\n"
+    "- page: 使用命中内容的页码；\n"
+    "- refId: 使用检索结果中的 refId；\n"
+    "- snippet: 直接使用命中文本片段，不要改写与翻译，可包含换行；\n"
+    "- 只返回与问题强相关的若干条记录。\n"
+)
+
+
 @app.post("/api/doc_search", response_model=DocSearchResponse)
-def doc_search(req: DocSearchRequest):
+async def doc_search(req: DocSearchRequest):
     q = (req.query or "").strip()
     if not q:
         raise HTTPException(status_code=400, detail="query 不能为空")
-
-    # 系统提示：显式要求使用 Documents 搜索，并严格输出 JSON（仅结构，不要其它文字）
-    system_prompt = (
-        "你是文档检索与结构化助手。\n"
-        "必须使用 GAIA 的 Documents 搜索工具（document_rag_search 或后端已集成的 RAG 能力），\n"
-        "仅在 ragConfig.globFilter 指定的容器/文档范围内检索（若提供）。\n"
-        "严格返回 JSON，且只返回如下结构，不要任何多余文字：\n"
-        "{\"results\":[{\"doc\":string,\"page\":number,\"refId\":string,\"snippet\":string}]}\n"
-        "要求：\n"
-        "- doc: 使用来源的 sourceFile 或文档可辨识名称；\n"
-        "- page: 使用命中内容的页码；\n"
-        "- refId: 使用检索结果中的 refId；\n"
-        "- snippet: 直接使用命中文本片段，不要改写与翻译，可包含换行；\n"
-        "- 只返回与问题强相关的若干条记录。\n"
-    )
+    metrics.set_context(assistantid=req.assistantId or os.getenv("GAIA_ASSISTANT_ID"))
 
     try:
-        content = call_gaia(
+        result = await call_gaia(
             text=q,
-            system_prompt=system_prompt,
+            system_prompt=DOC_SEARCH_SYSTEM_PROMPT,
             assistantid=(req.assistantId or os.getenv("GAIA_ASSISTANT_ID")),
             glob_filter=req.globFilter,
         )
@@ -133,51 +185,8 @@ def doc_search(req: DocSearchRequest):
         logger.exception("doc_search 上游错误: %s", e)
         raise HTTPException(status_code=502, detail="上游服务异常，请稍后再试。") from e
 
-    # 解析 JSON；若非 JSON，返回空数组以保证前端稳定
-    results: list[DocSearchResultItem] = []
-    if content:
-        try:
-            data = json.loads(content)
-            if isinstance(data, dict):
-                arr = data.get("results", [])
-            elif isinstance(data, list):
-                arr = data
-            else:
-                arr = []
-
-            for it in arr or []:
-                if not isinstance(it, dict):
-                    continue
-                # 灵活兜底字段名，保证 doc/page/refId/snippet 存在
-                doc = (
-                    it.get("doc")
-                    or it.get("sourceFile")
-                    or it.get("id")
-                    or ""
-                )
-                page = (
-                    it.get("page")
-                    or it.get("sourcePage")
-                    or 1
-                )
-                ref_id = it.get("refId") or it.get("refID") or ""
-                snippet = it.get("snippet") if it.get("snippet") is not None else it.get("content")
-                # 严格不修改 snippet 内容
-                if not isinstance(snippet, str):
-                    continue
-                try:
-                    page_int = int(page)
-                except Exception:
-                    page_int = 1
-                if not isinstance(doc, str):
-                    doc = str(doc)
-                if not isinstance(ref_id, str):
-                    ref_id = str(ref_id)
-                results.append(DocSearchResultItem(doc=doc, page=page_int, refId=ref_id, snippet=snippet))
-        except Exception as e:
-            logger.warning("doc_search 返回非 JSON 或解析失败: %s", e)
-
-    return DocSearchResponse(results=results)
+    # 直接由解析好的结果构造响应，只序列化一次
+    return FastJSONResponse({"results": result.doc_results()})
 
 
 class FormatSnippetsRequest(BaseModel):
@@ -219,86 +228,156 @@ def format_snippets(req: FormatSnippetsRequest):
 from typing import Optional
 from urllib.parse import unquote
 
-# Simple in-memory IFU mapping and mock data
-_IFU_MAP = {
-    "Vista 300": {"assistantid":"fab9226e-cb6b-4ced-9310-e3560804e675","containerid":"41f4f2b3-4ae1-42f3-b824-b7430ffb45c5"},
-    "Vista 120": {"assistantid":"fab9226e-cb6b-4ced-9310-e3560804e675","containerid":"41f4f2b3-4ae1-42f3-b824-b7430ffb45c5"},
-    "Atlan 100": {"assistantid":"7498650d-ad0c-45b9-9e2e-0b2ecece5a9f","containerid":"e05d7522-891a-416a-8bed-cbefc0c64209"},
-    #"Atlan 100": {"assistantid":"45bcc1e2-79f6-46bf-94fc-3e5c94168ee7","containerid":"e05d7522-891a-416a-8bed-cbefc0c64209"},
-    "Epic": {"assistantid":"fab9226e-cb6b-4ced-9310-e3560804e675","containerid":"41f4f2b3-4ae1-42f3-b824-b7430ffb45c5"}
-}
-
-
+# 设备型号 -> 助手/容器 映射见 backend/ifu_models.json（backend.ifu_registry，修改后自动重新加载）
+# 响应带 ETag，重复请求携带 If-None-Match 时返回 304（见 backend.http_cache）
 @app.get("/get_ifu")
 @app.get("/api/get_ifu")
-def get_ifu(model: str):
+def get_ifu(request: Request, model: str):
     model = (model or "").strip()
     if not model:
         raise HTTPException(status_code=400, detail="model 不能为空")
-    # 支持宽松匹配：完全匹配优先，其次大小写不敏感包含
-    if model in _IFU_MAP:
-        result = _IFU_MAP[model]
+    # 完全匹配优先，其次前缀 / 单词匹配，最后容错匹配（OCR / 二维码识别误差）
+    found = ifu_registry.get_registry().lookup(model)
+    if found is None:
+        body = {"assistantid": "", "containerid": ""}
     else:
-        low = model.lower()
-        for k, v in _IFU_MAP.items():
-            if low in k.lower():
-                result = v
-                break
-    if not result:
-        return {"assistantid": "", "containerid": ""}
-    return {"assistantid": result["assistantid"], "containerid": result["containerid"]}
+        (name, assistantid, containerid), match = found
+        body = {"assistantid": assistantid, "containerid": containerid, "model": name, "match": match}
+    return http_cache.respond(request, lambda: render_json(body))
 
 
-@app.get("/search_ifu")
-@app.get("/api/search_ifu")
-def search_ifu(keyword: str, assistantid: Optional[str] = None, containerid: Optional[str] = None, mode: Optional[str] = None):
+def _check_search_params(keyword: str, assistantid: Optional[str]) -> tuple[str, str]:
     keyword = (keyword or "").strip()
     if not keyword:
         raise HTTPException(status_code=400, detail="keyword 不能为空")
     localassistantid = (assistantid or "").strip()
     if not localassistantid:
         raise HTTPException(status_code=400, detail="必须提供 assistantid 才能检索")
+    return keyword, unquote(localassistantid)
+
 
-    # Use GAIA restricted search only; no local mock fallback
-    assistantID = unquote(localassistantid)
+async def _ask_passages(keyword: str, assistantID: str, containerid: Optional[str]) -> Optional[list[dict]]:
+    """IFU_HYBRID_ASK 开启且容器有本地索引时，先在本地做混合检索，只把 top-k 片段交给 GAIA。"""
+    if not retrieval.HYBRID_ASK or not retrieval.available():
+        return None
+    cid = _container_for(assistantID, containerid)
+    if not cid:
+        return None
     try:
-        system_prompt = (
-            "你是医疗设备说明书检索助手。仅在 ragConfig.globFilter 指定的 IFU 文档中检索。\n"
-            "根据用户关键词返回严格的 JSON（仅 JSON，无多余文字）。\n"
-            "snippet 必须为原文截取：以命中关键词为中心，向前后扩展若干句，尽量接近长度上限。\n"
-            "输出格式: {\"results\":[{\"doc\":string,\"page\":number,\"refId\":string,\"score\":number,\"snippet\":string}]}\n"
-            "要求: 每条 snippet 300–800字，允许换行与标点；尽量接近上限；若无法确定页码，使用1；返回最多1000条。"
-        )
-        # 根据前端传入的 mode 决定调用后端能力：
-        # - mode=="ask" 走问答：call_atlan_qa(question=keyword, assistantid=assistantID)
-        # - 其它（含未提供）走搜索：call_ifu_search(keyword=f"keyword: {keyword}", assistantid=assistantID, container_id=containerid)
-        call_mode = (mode or "").strip().lower()
-        if call_mode == "ask":
-            content = call_atlan_qa(question=keyword, assistantid=assistantID, mode=mode)
+        passages = await run_in_threadpool(retrieval.retrieve, cid, keyword)
+    except Exception as e:
+        logger.warning("本地混合检索失败，改用助手自带检索: %s", e)
+        return None
+    return passages or None
+
+
+def _cacheable(result: SearchResult) -> bool:
+    # 上游失败时返回（或被 call_atlan_qa 包装后的）PLACEHOLDER 不能进入缓存
+    return bool(result.raw) and PLACEHOLDER not in result.raw
+
+
+async def _ifu_content(keyword: str, assistantID: str, containerid: Optional[str], mode: Optional[str],
+                       limit: Optional[int] = None) -> SearchResult:
+    """call_ifu_search / call_atlan_qa behind the result cache (limit: see call_ifu_search)."""
+    key = result_cache.make_key(assistantID, containerid, mode, keyword, limit)
+    if result_cache.CACHE_ENABLED:
+        cached = await result_cache.cache.aget(key)
+        if cached is not None:
+            return SearchResult.parse(cached)
+
+    # 根据前端传入的 mode 决定调用后端能力：
+    # - mode=="ask" 走问答：call_atlan_qa(question=keyword, assistantid=assistantID)
+    # - 其它（含未提供）走搜索：call_ifu_search(keyword=f"keyword: {keyword}", assistantid=assistantID, container_id=containerid)
+    call_mode = (mode or "").strip().lower()
+    if call_mode == "ask":
+        passages = await _ask_passages(keyword, assistantID, containerid)
+        result = await call_atlan_qa(question=keyword, assistantid=assistantID, mode=mode, passages=passages, limit=limit)
+    else:
+        result = await call_ifu_search(keyword=keyword, assistantid=assistantID, container_id=containerid, mode=mode, limit=limit)
+
+    if result_cache.CACHE_ENABLED:
+        if _cacheable(result):
+            await result_cache.cache.aput(key, result.raw)
         else:
-            content = call_ifu_search(keyword=keyword, assistantid=assistantID, container_id=containerid, mode=mode)
-        if content:
-            try:
-                data = json.loads(content)
-                results = data.get("results", []) if isinstance(data, dict) else []
-                # Basic validation of result items
-                valid = []
-                for it in results:
-                    doc = str(it.get("doc", assistantID)).strip() if isinstance(it, dict) else ""
-                    page = int(it.get("page", 0)) if isinstance(it, dict) else 0
-                    snippet = str(it.get("snippet", "")).strip() if isinstance(it, dict) else ""
-                    if doc:
-                        valid.append({
-                            "doc": doc,
-                            "page": max(0, page),
-                            "snippet": snippet[:3000]
-                        })
-                return {"results": valid}
-            except Exception:
-                # If upstream returns non-JSON, 为了兼容前端，包装为一条记录（使用 assistantID 作为 doc，page=0）
-                snippet = str(content) if content is not None else ""
-                return {"results": [{"doc": assistantID, "page": 0, "snippet": snippet[:3000]}]}
-        return {"results": []}
+            # 上游不可用（熔断打开或重试耗尽）：返回同一查询最近一次成功的结果，并标记为过期
+            stale = await _stale_result(key)
+            if stale is not None:
+                return stale
+    return result
+
+
+async def _stale_result(key: result_cache.CacheKey) -> Optional[SearchResult]:
+    raw = await result_cache.cache.aget_stale(key)
+    if raw is None:
+        return None
+    result = SearchResult.parse(raw)
+    result.stale = True
+    metrics.inc("ifu_stale_served_total", **metrics.context_labels())
+    return result
+
+
+def _ifu_body(result: SearchResult, assistantID: str) -> dict:
+    body = {"results": result.ifu_results(assistantID)}
+    if result.stale:
+        body["stale"] = True
+    return body
+
+
+LOCAL_TOP_K = int(os.getenv("IFU_LOCAL_TOP_K", "50"))
+
+
+def _container_for(assistantID: str, containerid: Optional[str]) -> str:
+    cid = (containerid or "").strip()
+    if cid:
+        return unquote(cid)
+    return ifu_registry.get_registry().index.assistant_container(assistantID)
+
+
+def _local_search(keyword: str, assistantID: str, containerid: Optional[str], limit: Optional[int] = None) -> dict:
+    """mode=local：在本地倒排索引（BM25）中检索，不经过 LLM。"""
+    cid = _container_for(assistantID, containerid)
+    idx = ifu_index.get_index(cid) if cid else None
+    if idx is None:
+        raise HTTPException(status_code=404, detail="该容器尚未建立本地索引，请先运行 python -m backend.ifu_index ingest")
+    hits = idx.search(keyword, top_k=limit or LOCAL_TOP_K)
+    return {"results": [{"doc": h["doc"], "page": h["page"], "snippet": h["snippet"][:3000]} for h in hits]}
+
+
+_LIMIT_QUERY = Query(None, ge=1, le=1000, description="最多返回的结果条数，取满即停止上游生成")
+_TOP_K_QUERY = Query(None, ge=1, le=1000, description="limit 的别名")
+
+
+@app.get("/search_ifu")
+@app.get("/api/search_ifu")
+async def search_ifu(
+    request: Request,
+    keyword: str,
+    assistantid: Optional[str] = None,
+    containerid: Optional[str] = None,
+    mode: Optional[str] = None,
+    limit: Optional[int] = _LIMIT_QUERY,
+    top_k: Optional[int] = _TOP_K_QUERY,
+):
+    # mode=local 走本地索引；其它走 GAIA restricted search（无本地 mock 兜底）
+    keyword, assistantID = _check_search_params(keyword, assistantid)
+    limit = limit or top_k
+    if (mode or "").strip().lower() == "local":
+        body = await run_in_threadpool(_local_search, keyword, assistantID, containerid, limit)
+        return http_cache.respond(request, lambda: render_json(body))
+    try:
+        key = result_cache.make_key(assistantID, containerid, mode, keyword, limit)
+        if result_cache.CACHE_ENABLED:
+            # 命中内存缓存且已有序列化好的响应（及压缩版本）：不再解析、序列化或压缩
+            reps = result_cache.cache.representations(key)
+            if reps is not None and reps.get("etag") is not None and reps.get("identity") is not None:
+                reps.hit()
+                return await http_cache.arespond(request, None, reps)
+        result = await _ifu_content(keyword, assistantID, containerid, mode, limit)
+        # 过期兜底结果不与缓存条目对应，不保存其表示
+        reps = result_cache.cache.representations(key) if result_cache.CACHE_ENABLED and not result.stale else None
+        # 大结果的序列化和压缩放到线程中（HTTP_OFFLOAD_MIN_BYTES），压缩结果随缓存条目保存
+        return await http_cache.arespond(request, lambda: render_json(_ifu_body(result, assistantID)), reps,
+                                         size_hint=len(result.raw))
     except HTTPException:
         # bubble up GAIA auth errors, etc.
         raise
@@ -307,52 +386,344 @@ def search_ifu(keyword: str, assistantid: Optional[str] = None, containerid: Opt
         return {"results": []}
 
 
+# =============================
+# 流式输出：SSE（浏览器 / Angular）或 NDJSON（小程序 enableChunked）
+# =============================
+_STREAM_MEDIA_TYPES = {"sse": "text/event-stream", "ndjson": "application/x-ndjson"}
+
+
+def _stream_event(fmt: str, event: str, data: dict) -> str:
+    if fmt == "ndjson":
+        return dumps({"type": event, **data}).decode("utf-8") + "\n"
+    return f"event: {event}\ndata: {dumps(data).decode('utf-8')}\n\n"
+
+
+async def _replay(content: str):
+    yield content
+
+
+async def _stream_response(fmt: str, deltas, finalize, on_complete=None, item_event=None,
+                           limit: Optional[int] = None) -> StreamingResponse:
+    """Forward GAIA deltas as `delta` events, then one `result` event built by finalize(result).
+
+    on_complete(result), if given, is awaited with the final SearchResult once the stream finished.
+
+    With item_event(item) -> dict|None, result items are parsed while the deltas
+    arrive and each completed one is also sent as an `item` event. With `limit`,
+    the upstream stream is closed once that many items are complete and the
+    `result` event holds just those items.
+
+    The first delta is awaited before the response starts so that errors raised
+    before any token (400/401 from upstream) still surface as regular HTTP errors.
+    A `reset` event tells the client to drop the text received so far (upstream retry).
+    """
+    fmt = (fmt or "sse").strip().lower()
+    if fmt not in _STREAM_MEDIA_TYPES:
+        raise HTTPException(status_code=400, detail="format 必须为 sse 或 ndjson")
+    try:
+        first = await deltas.__anext__()
+    except StopAsyncIteration:
+        first = None
+
+    async def all_deltas():
+        if first is None:
+            return
+        yield first
+        async for delta in deltas:
+            yield delta
+
+    async def body():
+        parts: list[str] = []
+        items = ResultStream() if (item_event is not None or limit) else None
+        try:
+            async for delta in all_deltas():
+                if delta is STREAM_RESET:
+                    parts.clear()
+                    if items is not None:
+                        items.reset()
+                    yield _stream_event(fmt, "reset", {})
+                    continue
+                parts.append(delta)
+                yield _stream_event(fmt, "delta", {"text": delta})
+                if items is None:
+                    continue
+                for it in items.feed(delta):
+                    data = item_event(it) if item_event is not None else None
+                    if data is not None:
+                        yield _stream_event(fmt, "item", data)
+                if limit and len(items.items) >= limit:
+                    metrics.inc("gaia_streams_closed_early_total")
+                    break
+            if limit and items.items:
+                result = items.result(limit)
+            else:
+                result = finalize_result(parts)
+            if on_complete is not None:
+                await on_complete(result)
+            yield _stream_event(fmt, "result", finalize(result))
+        except HTTPException as e:
+            yield _stream_event(fmt, "error", {"status": e.status_code, "detail": e.detail})
+        except Exception as e:
+            logger.exception("流式输出上游错误: %s", e)
+            yield _stream_event(fmt, "error", {"status": 502, "detail": "上游服务异常，请稍后再试。"})
+        finally:
+            await deltas.aclose()
+
+    return StreamingResponse(
+        body(),
+        media_type=_STREAM_MEDIA_TYPES[fmt],
+        # 禁止 Nginx 等反向代理缓冲，保证增量即时到达客户端
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@app.get("/search_ifu/stream")
+@app.get("/api/search_ifu/stream")
+async def search_ifu_stream(
+    keyword: str,
+    assistantid: Optional[str] = None,
+    containerid: Optional[str] = None,
+    mode: Optional[str] = None,
+    fmt: str = Query("sse", alias="format", description="sse 或 ndjson"),
+    limit: Optional[int] = _LIMIT_QUERY,
+    top_k: Optional[int] = _TOP_K_QUERY,
+):
+    keyword, assistantID = _check_search_params(keyword, assistantid)
+    limit = limit or top_k
+    key = result_cache.make_key(assistantID, containerid, mode, keyword, limit)
+    cached = await result_cache.cache.aget(key) if result_cache.CACHE_ENABLED else None
+    stale = None
+    if cached is None and result_cache.CACHE_ENABLED and breaker.is_open(assistantID):
+        # 熔断打开：不等上游，直接回放最近一次成功的结果（result 事件带 stale 标记）
+        stale = await _stale_result(key)
+    if stale is not None:
+        deltas, on_complete = _replay(stale.raw), None
+    elif cached is not None:
+        # 命中缓存：直接以单个增量 + 结果事件返回
+        deltas, on_complete = _replay(cached), None
+    else:
+        passages = await _ask_passages(keyword, assistantID, containerid) if (mode or "").strip().lower() == "ask" else None
+        deltas = stream_ifu_search(keyword=keyword, assistantid=assistantID, container_id=containerid, mode=mode, passages=passages)
+
+        async def on_complete(result: SearchResult):
+            if result_cache.CACHE_ENABLED and _cacheable(result):
+                await result_cache.cache.aput(key, result.raw)
+
+    def finalize(result: SearchResult) -> dict:
+        result.stale = stale is not None
+        return _ifu_body(result, assistantID)
+
+    return await _stream_response(
+        fmt, deltas, finalize, on_complete, item_event=lambda it: ifu_item(it, assistantID), limit=limit,
+    )
+
+
+# =============================
+# 批量检索：一次请求并发执行多个 search_ifu 查询
+# =============================
+BATCH_MAX_QUERIES = int(os.getenv("IFU_BATCH_MAX_QUERIES", "20"))
+BATCH_CONCURRENCY = int(os.getenv("IFU_BATCH_CONCURRENCY", "4"))
+_BATCH_MEDIA_TYPES = {"json": "application/json", **_STREAM_MEDIA_TYPES}
+
+
+class IfuQuery(BaseModel):
+    keyword: str = Field(..., description="检索关键词")
+    assistantid: Optional[str] = Field(None, description="GAIA 助手 ID")
+    containerid: Optional[str] = Field(None, description="IFU 容器 ID，可选")
+    mode: Optional[str] = Field(None, description="与 /api/search_ifu 相同：search（默认）/ ask / local")
+    limit: Optional[int] = Field(None, ge=1, le=1000, description="最多返回的结果条数")
+
+
+class BatchSearchRequest(BaseModel):
+    queries: list[IfuQuery] = Field(..., description="查询列表，结果按相同顺序返回")
+
+
+def _batch_key(q: IfuQuery) -> tuple:
+    local = (q.mode or "").strip().lower() == "local"
+    return result_cache.make_key(q.assistantid, q.containerid, q.mode, q.keyword, q.limit), local
+
+
+async def _batch_one(q: IfuQuery, sem: asyncio.Semaphore, indexes: list[int]) -> tuple[list[int], dict]:
+    """One sub-query as {"status": 200, "results": [...]} or {"status": ..., "detail": ...},
+    together with the request positions it answers."""
+    async with sem:
+        return indexes, await _batch_result(q)
+
+
+async def _batch_result(q: IfuQuery) -> dict:
+    # 每个子查询在独立的任务中运行，指标按各自的 mode / assistantid 标记
+    metrics.set_context(mode=q.mode, assistantid=q.assistantid)
+    try:
+        keyword, assistantID = _check_search_params(q.keyword, q.assistantid)
+        if (q.mode or "").strip().lower() == "local":
+            data = await run_in_threadpool(_local_search, keyword, assistantID, q.containerid, q.limit)
+            return {"status": 200, "results": data["results"]}
+        result = await _ifu_content(keyword, assistantID, q.containerid, q.mode, q.limit)
+        return {"status": 200, **_ifu_body(result, assistantID)}
+    except HTTPException as e:
+        return {"status": e.status_code, "detail": e.detail}
+    except Exception as e:
+        logger.exception("批量检索子查询失败: %s", e)
+        return {"status": 502, "detail": "上游服务异常，请稍后再试。"}
+
+
+@app.post("/api/search_ifu/batch")
+async def search_ifu_batch(req: BatchSearchRequest, fmt: str = Query("json", alias="format", description="json、sse 或 ndjson")):
+    """并发执行多个 search_ifu 查询（最多 IFU_BATCH_CONCURRENCY 个同时进行），相同的子查询只执行一次。
+
+    每个子查询单独返回 status：成功为 200 + results，失败为错误码 + detail，互不影响。
+    format=json 时等全部完成后按请求顺序返回；sse/ndjson 时每完成一个就推送一个
+    `result` 事件（带 index），最后是 `done`。
+    """
+    fmt = (fmt or "json").strip().lower()
+    if fmt not in _BATCH_MEDIA_TYPES:
+        raise HTTPException(status_code=400, detail="format 必须为 json、sse 或 ndjson")
+    if not req.queries:
+        raise HTTPException(status_code=400, detail="queries 不能为空")
+    if len(req.queries) > BATCH_MAX_QUERIES:
+        raise HTTPException(status_code=400, detail=f"queries 最多 {BATCH_MAX_QUERIES} 条")
+
+    # 相同的子查询（归一化后的缓存键一致）合并为一个任务
+    groups: dict[tuple, list[int]] = {}
+    for i, q in enumerate(req.queries):
+        groups.setdefault(_batch_key(q), []).append(i)
+    metrics.inc("ifu_batch_queries_total", len(req.queries))
+    metrics.inc("ifu_batch_deduped_total", len(req.queries) - len(groups))
+
+    sem = asyncio.Semaphore(max(1, BATCH_CONCURRENCY))
+    tasks = [
+        asyncio.ensure_future(_batch_one(req.queries[indexes[0]], sem, indexes))
+        for indexes in groups.values()
+    ]
+
+    if fmt == "json":
+        try:
+            done = await asyncio.gather(*tasks)
+        finally:
+            for t in tasks:
+                t.cancel()
+        out: list[Optional[dict]] = [None] * len(req.queries)
+        for indexes, res in done:
+            for i in indexes:
+                out[i] = {"index": i, **res}
+        return FastJSONResponse({"results": out})
+
+    async def body():
+        try:
+            for fut in asyncio.as_completed(tasks):
+                indexes, res = await fut
+                for i in indexes:
+                    yield _stream_event(fmt, "result", {"index": i, **res})
+            yield _stream_event(fmt, "done", {})
+        finally:
+            # 客户端提前断开：取消尚未完成的子查询
+            for t in tasks:
+                t.cancel()
+
+    return StreamingResponse(
+        body(),
+        media_type=_STREAM_MEDIA_TYPES[fmt],
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@app.post("/api/doc_search/stream")
+async def doc_search_stream(req: DocSearchRequest, fmt: str = Query("sse", alias="format", description="sse 或 ndjson")):
+    q = (req.query or "").strip()
+    if not q:
+        raise HTTPException(status_code=400, detail="query 不能为空")
+    metrics.set_context(assistantid=req.assistantId or os.getenv("GAIA_ASSISTANT_ID"))
+    deltas = stream_gaia(
+        text=q,
+        system_prompt=DOC_SEARCH_SYSTEM_PROMPT,
+        assistantid=(req.assistantId or os.getenv("GAIA_ASSISTANT_ID")),
+        glob_filter=req.globFilter,
+    )
+    return await _stream_response(
+        fmt, deltas, lambda result: {"results": result.doc_results()}
+    )
+
+
+@app.delete("/api/admin/cache", dependencies=[Depends(_require_admin)])
+async def invalidate_cache(assistantid: str, warm: bool = Query(False, description="清除后立即按预热列表重新预热该助手")):
+    """IFU 容器更新后，清除该助手的全部缓存结果。"""
+    assistantid = unquote((assistantid or "").strip())
+    if not assistantid:
+        raise HTTPException(status_code=400, detail="assistantid 不能为空")
+    removed = await run_in_threadpool(result_cache.cache.invalidate_assistant, assistantid)
+    logger.info("已清除助手 %s 的缓存结果 %s 条", assistantid, removed)
+    data = {"assistantid": assistantid, "removed": removed}
+    if warm:
+        data["warming"] = await _start_warm(assistantid, "invalidate")
+    return data
+
+
+# 结果缓存预热：与 /api/search_ifu 走同一路径（含 ask 模式的本地检索）
+_warmer = cache_warmer.Warmer(lambda q: _ifu_content(q.keyword, q.assistantid, q.containerid, q.mode))
+
+
+async def _start_warm(assistantid: Optional[str], reason: str) -> bool:
+    if not result_cache.CACHE_ENABLED:
+        raise HTTPException(status_code=400, detail="结果缓存未启用（IFU_CACHE_ENABLED=false），无需预热")
+    try:
+        return await _warmer.start(assistantid, reason)
+    except ValueError as e:
+        raise HTTPException(status_code=500, detail=f"预热列表无效: {e}")
+
+
+@app.post("/api/admin/cache/warm", status_code=202, dependencies=[Depends(_require_admin)])
+async def start_cache_warm(assistantid: Optional[str] = None):
+    """按预热列表（IFU_WARM_FILE）在后台预先计算常见查询的结果；assistantid 可只预热一个助手。"""
+    if not await _start_warm(unquote(assistantid.strip()) if assistantid else None, "admin"):
+        raise HTTPException(status_code=409, detail="预热任务正在进行，请稍后再试")
+    return _warmer.progress()
+
+
+@app.get("/api/admin/cache/warm", dependencies=[Depends(_require_admin)])
+async def cache_warm_status(assistantid: Optional[str] = None):
+    """预热进度，以及各型号预热查询当前的缓存覆盖率。"""
+    try:
+        coverage = await run_in_threadpool(_warmer.coverage, unquote(assistantid.strip()) if assistantid else None)
+    except ValueError as e:
+        raise HTTPException(status_code=500, detail=f"预热列表无效: {e}")
+    return {"progress": _warmer.progress(), "coverage": coverage}
+
+
 @app.get("/get_content")
 @app.get("/api/get_content")
 def get_content(doc_path: str, page: int = 1):
-    # Local mock content has been removed; this endpoint is no longer supported.
-    raise HTTPException(status_code=501, detail="本地模拟内容已移除：/get_content 不再提供服务，请改用 GAIA 检索与内容获取。")
+    # 由本地 IFU 索引的页面文本提供（python -m backend.ifu_index ingest）
+    text = ifu_index.find_page(unquote(doc_path or ""), page)
+    if text is None:
+        raise HTTPException(status_code=404, detail="未找到该文档页面：请确认 doc_path/page，或先为该容器建立本地索引。")
+    return {"content": text, "images": []}
 
 
 # =============================
-# Simple file-based voting
+# Voting (backend.votes: SQLite WAL, batched writes)
 # =============================
 class VoteRequest(BaseModel):
     type: str = Field(..., description="投票类型：up 或 down")
+    assistantid: Optional[str] = Field(None, description="被评价回答所属的助手 ID，可选")
+    answerid: Optional[str] = Field(None, description="被评价回答的 ID，可选；与 assistantid 一起用于归因")
 
 class VoteCounts(BaseModel):
     up: int = 0
     down: int = 0
 
-_votes_lock = threading.Lock()
-_votes_file = Path(__file__).with_name("votes.json")
-
 
-def _read_votes() -> VoteCounts:
-    try:
-        if not _votes_file.exists():
-            return VoteCounts(up=0, down=0)
-        data = json.loads(_votes_file.read_text(encoding="utf-8"))
-        up = int(data.get("up", 0))
-        down = int(data.get("down", 0))
-        return VoteCounts(up=up, down=down)
-    except Exception:
-        # If file corrupted, reset
-        return VoteCounts(up=0, down=0)
-
-
-def _write_votes(vc: VoteCounts):
-    tmp = _votes_file.with_suffix(".json.tmp")
-    data = {"up": int(vc.up), "down": int(vc.down)}
-    tmp.write_text(json.dumps(data, ensure_ascii=False), encoding="utf-8")
-    tmp.replace(_votes_file)
+def _vote_scope(assistantid: Optional[str], answerid: Optional[str]) -> tuple[Optional[str], Optional[str]]:
+    # 未提供的维度不参与过滤
+    aid = unquote(assistantid.strip()) if assistantid and assistantid.strip() else None
+    ans = answerid.strip() if answerid and answerid.strip() else None
+    return aid, ans
 
 
 @app.get("/api/vote", response_model=VoteCounts)
 @app.get("/vote", response_model=VoteCounts)
-def get_votes():
-    with _votes_lock:
-        return _read_votes()
+def get_votes(assistantid: Optional[str] = None, answerid: Optional[str] = None):
+    up, down = votes.get_store().counts(*_vote_scope(assistantid, answerid))
+    return VoteCounts(up=up, down=down)
 
 
 @app.post("/api/vote", response_model=VoteCounts)
@@ -361,11 +732,16 @@ def post_vote(req: VoteRequest):
     t = (req.type or "").strip().lower()
     if t not in ("up", "down"):
         raise HTTPException(status_code=400, detail="type 必须为 up 或 down")
-    with _votes_lock:
-        vc = _read_votes()
-        if t == "up":
-            vc.up += 1
-        else:
-            vc.down += 1
-        _write_votes(vc)
-        return vc
+    aid, ans = _vote_scope(req.assistantid, req.answerid)
+    store = votes.get_store()
+    store.add(t, aid or "", ans or "")
+    # 返回与请求相同范围的计数（未带 assistantid/answerid 时为总数）
+    up, down = store.counts(aid, ans)
+    return VoteCounts(up=up, down=down)
+
+
+@app.get("/api/admin/votes", dependencies=[Depends(_require_admin)])
+def vote_breakdown(assistantid: Optional[str] = None):
+    """按助手 / 回答汇总的投票明细（已落盘部分）。"""
+    aid, _ = _vote_scope(assistantid, None)
+    return {"votes": votes.get_store().breakdown(aid)}
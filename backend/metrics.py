@@ -0,0 +1,256 @@
+"""In-process metrics registry.
+
+Counters and histograms are keyed by (name, sorted label pairs) and are safe
+to update from both the event loop and threadpool handlers. `snapshot()`
+returns a JSON-able view that main.py exposes under /api/stats.
+
+Histograms use fixed cumulative buckets; register custom bounds with
+register_histogram() before the first observe(), otherwise DEFAULT_BUCKETS
+(seconds) are used.
+
+Request context: RequestMetricsMiddleware puts the endpoint, mode and
+assistantid of the current request in a ContextVar. Stage metrics deeper in
+the call stack add them with **context_labels() (or timer()), so upstream
+timings can be broken down per endpoint and assistant without threading the
+values through every call. render_prometheus() returns everything in the
+Prometheus text format for GET /metrics.
+"""
+import bisect
+import contextvars
+import math
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Tuple
+from urllib.parse import parse_qs, unquote
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+# 解析 / 序列化等 CPU 阶段的耗时（秒）
+FAST_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0)
+# 每个标签最多记录的不同取值（如 assistantid），超出的归为 "other"，防止时间序列无限增长
+MAX_LABEL_VALUES = int(os.getenv("METRICS_MAX_LABEL_VALUES", "200"))
+
+_lock = threading.Lock()
+_counters: Dict[Tuple[str, Tuple[Tuple[str, str], ...]], float] = {}
+_bucket_bounds: Dict[str, Tuple[float, ...]] = {}
+# key -> [per-bucket counts (+Inf last), sum, count]
+_histograms: Dict[Tuple[str, Tuple[Tuple[str, str], ...]], list] = {}
+
+
+def _key(name: str, labels: Dict[str, Any]) -> Tuple[str, Tuple[Tuple[str, str], ...]]:
+    return name, tuple(sorted((k, "" if v is None else str(v)) for k, v in labels.items()))
+
+
+def inc(name: str, value: float = 1.0, **labels: Any) -> None:
+    """Add `value` to the counter `name{labels}`."""
+    k = _key(name, labels)
+    with _lock:
+        _counters[k] = _counters.get(k, 0.0) + value
+
+
+def get(name: str, **labels: Any) -> float:
+    with _lock:
+        return _counters.get(_key(name, labels), 0.0)
+
+
+def register_histogram(name: str, buckets: Sequence[float]) -> None:
+    """Set the bucket upper bounds of histogram `name`."""
+    with _lock:
+        _bucket_bounds[name] = tuple(sorted(float(b) for b in buckets))
+
+
+def observe(name: str, value: float, **labels: Any) -> None:
+    """Record one observation in the histogram `name{labels}`."""
+    k = _key(name, labels)
+    with _lock:
+        bounds = _bucket_bounds.setdefault(name, DEFAULT_BUCKETS)
+        h = _histograms.get(k)
+        if h is None:
+            h = _histograms[k] = [[0] * (len(bounds) + 1), 0.0, 0]
+        h[0][bisect.bisect_left(bounds, value)] += 1
+        h[1] += value
+        h[2] += 1
+
+
+def _histogram_view(bounds: Tuple[float, ...], h: list) -> Dict[str, Any]:
+    buckets: List[list] = []
+    total = 0
+    for bound, n in zip(bounds + (float("inf"),), h[0]):
+        total += n
+        buckets.append(["+Inf" if bound == float("inf") else bound, total])
+    return {"buckets": buckets, "sum": h[1], "count": h[2]}
+
+
+def snapshot() -> Dict[str, Any]:
+    with _lock:
+        items = list(_counters.items())
+        hists = [(k, [list(v[0]), v[1], v[2]], _bucket_bounds[k[0]]) for k, v in _histograms.items()]
+    counters: Dict[str, list] = {}
+    for (name, labels), value in sorted(items):
+        counters.setdefault(name, []).append({"labels": dict(labels), "value": value})
+    histograms: Dict[str, list] = {}
+    for (name, labels), h, bounds in sorted(hists, key=lambda x: x[0]):
+        histograms.setdefault(name, []).append({"labels": dict(labels), **_histogram_view(bounds, h)})
+    return {"counters": counters, "histograms": histograms}
+
+
+# =============================
+# Request context labels
+# =============================
+CONTEXT_LABELS = ("endpoint", "mode", "assistantid")
+_EMPTY_CONTEXT = {k: "" for k in CONTEXT_LABELS}
+_context: contextvars.ContextVar = contextvars.ContextVar("metrics_context", default=_EMPTY_CONTEXT)
+_label_values: Dict[str, set] = {}
+_MODES = ("search", "ask", "local")
+
+
+def _bounded(label: str, value: str) -> str:
+    if not value:
+        return ""
+    seen = _label_values.setdefault(label, set())
+    if value in seen:
+        return value
+    with _lock:
+        if len(seen) >= MAX_LABEL_VALUES:
+            return "other"
+        seen.add(value)
+    return value
+
+
+def set_context(**labels: Any) -> None:
+    """Update the context labels of the current task (endpoint, mode, assistantid)."""
+    ctx = dict(_context.get())
+    for k, v in labels.items():
+        if k not in ctx:
+            continue
+        v = "" if v is None else str(v).strip()
+        if k == "mode":
+            v = v.lower() if v.lower() in _MODES else ""
+        elif k == "assistantid":
+            v = _bounded(k, unquote(v))
+        ctx[k] = v
+    _context.set(ctx)
+
+
+def context_labels() -> Dict[str, str]:
+    return _context.get()
+
+
+@contextmanager
+def timer(name: str, **labels: Any) -> Iterator[None]:
+    """Observe the duration of the block in histogram `name`, with the context labels."""
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - t0, **_context.get(), **labels)
+
+
+register_histogram("http_request_duration_seconds", DEFAULT_BUCKETS)
+
+
+class RequestMetricsMiddleware:
+    """ASGI middleware: sets the context labels and records per-endpoint request latency.
+
+    The endpoint label is the name of the matched route's function, so
+    /search_ifu and /api/search_ifu share one series and unknown paths are
+    reported as "other".
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self._endpoints: Dict[Tuple[str, str], str] = {}
+
+    def _endpoint(self, scope) -> str:
+        key = (scope.get("method", ""), scope.get("path", ""))
+        name = self._endpoints.get(key)
+        if name is not None:
+            return name
+        from starlette.routing import Match
+
+        name = "other"
+        for route in getattr(scope.get("app"), "routes", ()):
+            match, _ = route.matches(scope)
+            if match == Match.FULL:
+                name = getattr(getattr(route, "endpoint", None), "__name__", None) or "other"
+                break
+        if name != "other" and len(self._endpoints) < 1024:
+            self._endpoints[key] = name
+        return name
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        query = parse_qs(scope.get("query_string", b"").decode("latin-1"))
+        token = _context.set(dict(_EMPTY_CONTEXT))
+        set_context(
+            endpoint=self._endpoint(scope),
+            mode=(query.get("mode") or [""])[0],
+            assistantid=(query.get("assistantid") or [""])[0],
+        )
+        status = {"code": 500}
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                status["code"] = message["status"]
+            await send(message)
+
+        t0 = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            ctx = _context.get()
+            observe("http_request_duration_seconds", time.perf_counter() - t0, **ctx)
+            inc("http_requests_total", endpoint=ctx["endpoint"], status=status["code"])
+            _context.reset(token)
+
+
+# =============================
+# Prometheus text exposition
+# =============================
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels_text(labels: Sequence[Tuple[str, str]], extra: Optional[Tuple[str, str]] = None) -> str:
+    pairs = list(labels) + ([extra] if extra else [])
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in pairs) + "}"
+
+
+def _num(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+def render_prometheus() -> str:
+    """All counters and histograms in the Prometheus text format (version 0.0.4)."""
+    with _lock:
+        items = sorted(_counters.items())
+        hists = sorted(
+            ((k, list(v[0]), v[1], v[2], _bucket_bounds[k[0]]) for k, v in _histograms.items()),
+            key=lambda x: x[0],
+        )
+    lines: List[str] = []
+    last = None
+    for (name, labels), value in items:
+        if name != last:
+            lines.append(f"# TYPE {name} counter")
+            last = name
+        lines.append(f"{name}{_labels_text(labels)} {_num(value)}")
+    last = None
+    for (name, labels), counts, total, count, bounds in hists:
+        if name != last:
+            lines.append(f"# TYPE {name} histogram")
+            last = name
+        cumulative = 0
+        for bound, n in zip(bounds + (float("inf"),), counts):
+            cumulative += n
+            lines.append(f"{name}_bucket{_labels_text(labels, ('le', _num(bound)))} {cumulative}")
+        lines.append(f"{name}_sum{_labels_text(labels)} {_num(total)}")
+        lines.append(f"{name}_count{_labels_text(labels)} {count}")
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,146 @@
+"""Memory-mapped page store for IFU page texts.
+
+Each document is stored as two files:
+    <name>.bin  all page texts as one contiguous UTF-8 blob
+    <name>.off  native uint64 array of n_pages + 1 byte offsets into the blob
+
+Both are opened with mmap (read-only), so page text lives in the OS page
+cache and is shared by every uvicorn worker instead of each worker holding
+its own copy on the Python heap. A page lookup is two offset reads and a
+slice, O(1) in document size; snippet windows are sliced zero-copy from the
+mapping and only the window itself is decoded.
+"""
+import mmap
+import os
+from array import array
+from pathlib import Path
+from typing import Iterable, List, Optional, Tuple
+
+_EMPTY = memoryview(b"")
+
+
+def write_document(base: Path, pages: Iterable[str]) -> int:
+    """Write <base>.bin / <base>.off atomically; returns the number of pages."""
+    offsets = array("Q", [0])
+    tmp_bin = base.with_name(base.name + ".bin.tmp")
+    tmp_off = base.with_name(base.name + ".off.tmp")
+    with tmp_bin.open("wb") as f:
+        pos = 0
+        for text in pages:
+            data = (text or "").encode("utf-8")
+            f.write(data)
+            pos += len(data)
+            offsets.append(pos)
+    with tmp_off.open("wb") as f:
+        offsets.tofile(f)
+    tmp_bin.replace(base.with_name(base.name + ".bin"))
+    tmp_off.replace(base.with_name(base.name + ".off"))
+    return len(offsets) - 1
+
+
+def _map(path: Path) -> Optional[mmap.mmap]:
+    with path.open("rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return None  # mmap cannot map empty files
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+class DocumentStore:
+    """Read-only view of one document's pages (page numbers start at 1)."""
+
+    __slots__ = ("_blob", "_blob_view", "_off_map", "_offsets")
+
+    def __init__(self, base: Path):
+        self._blob = _map(base.with_name(base.name + ".bin"))
+        self._blob_view = memoryview(self._blob) if self._blob is not None else _EMPTY
+        self._off_map = _map(base.with_name(base.name + ".off"))
+        if self._off_map is None:
+            raise ValueError(f"页偏移表为空：{base}")
+        self._offsets = memoryview(self._off_map).cast("Q")
+
+    def __len__(self) -> int:
+        return len(self._offsets) - 1
+
+    def _bounds(self, page: int) -> Optional[tuple]:
+        if page < 1 or page > len(self):
+            return None
+        return self._offsets[page - 1], self._offsets[page]
+
+    def page_bytes(self, page: int) -> Optional[memoryview]:
+        """Zero-copy view of one page's UTF-8 bytes."""
+        b = self._bounds(page)
+        return None if b is None else self._blob_view[b[0]:b[1]]
+
+    def page_text(self, page: int) -> Optional[str]:
+        view = self.page_bytes(page)
+        return None if view is None else str(view, "utf-8")
+
+    def find(self, page: int, needles: Iterable[bytes]) -> int:
+        """Absolute blob offset of the first needle found in the page, or -1."""
+        b = self._bounds(page)
+        if b is None or self._blob is None:
+            return -1
+        for needle in needles:
+            if needle:
+                pos = self._blob.find(needle, b[0], b[1])
+                if pos >= 0:
+                    return pos
+        return -1
+
+    def window(self, page: int, center: Optional[int], width_bytes: int) -> Tuple[str, int]:
+        """Decode a ~width_bytes window of the page around blob offset `center`
+        (page start when None), trimmed to whole UTF-8 characters.
+
+        Returns (text, char index of `center` within text).
+        """
+        b = self._bounds(page)
+        if b is None:
+            return "", 0
+        if center is None:
+            center = b[0]
+        start = max(b[0], center - width_bytes // 2)
+        end = min(b[1], start + width_bytes)
+        view = self._blob_view
+        while start < end and 0x80 <= view[start] < 0xC0:
+            start += 1
+        while end > start and end < b[1] and 0x80 <= view[end] < 0xC0:
+            end -= 1
+        head = str(view[start:max(start, min(center, end))], "utf-8", "replace")
+        return head + str(view[max(start, min(center, end)):end], "utf-8", "replace"), len(head)
+
+    def close(self) -> None:
+        self._offsets.release()
+        if self._blob is not None:
+            self._blob_view.release()
+            self._blob.close()
+        self._off_map.close()
+
+
+class PageStore:
+    """Page stores of all documents in one container, opened lazily."""
+
+    def __init__(self, root: Path, docs: List[str]):
+        self.root = root
+        self.docs = docs
+        self._stores: List[Optional[DocumentStore]] = [None] * len(docs)
+
+    @staticmethod
+    def doc_base(root: Path, doc_idx: int) -> Path:
+        return root / str(doc_idx)
+
+    def document(self, doc_idx: int) -> DocumentStore:
+        store = self._stores[doc_idx]
+        if store is None:
+            store = DocumentStore(self.doc_base(self.root, doc_idx))
+            self._stores[doc_idx] = store
+        return store
+
+    def close(self) -> None:
+        """Unmap every opened document (the store must no longer be in use)."""
+        stores, self._stores = self._stores, [None] * len(self.docs)
+        for store in stores:
+            if store is not None:
+                try:
+                    store.close()
+                except BufferError:
+                    pass  # 仍有视图引用该映射：交给垃圾回收
@@ -0,0 +1,436 @@
+"""Response cache for IFU searches.
+
+Entries are keyed by (assistantid, containerid, mode, normalized keyword,
+result limit) and hold the raw content returned by call_ifu_search / call_atlan_qa.
+
+Tiers:
+- memory: LRU with per-entry TTL, bounded by the total UTF-8 size of the values;
+- disk (optional, IFU_CACHE_DISK_PATH): a SQLite file that survives restarts.
+  A memory miss falls through to disk and promotes the entry on hit.
+  Without a disk path but with a shared state backend (SHARED_STATE_URL, see
+  shared_state), that backend is the second tier, so every worker reuses the
+  results another one fetched.
+
+With a shared state backend, invalidate_assistant() and clear() bump a
+generation counter there instead of deleting keys one by one. Entries of an
+older generation are ignored by every worker; each worker rereads the
+counters at most every IFU_CACHE_SYNC_INTERVAL seconds (default 1).
+
+Expired entries are kept for another IFU_CACHE_STALE_TTL seconds (default 7
+days, 0 disables). get() never returns them; get_stale() does, so an endpoint
+can answer with the last good result while GAIA is unavailable (see breaker).
+
+Next to a fresh memory entry the endpoints can keep its HTTP representations
+(serialized body, ETag, compressed variants; see http_cache) through
+representations(). They count toward IFU_CACHE_MAX_BYTES and are dropped
+together with the entry, so they never outlive the value they were built from.
+
+Async callers use aget() / aput() / aget_stale(): a memory hit is answered
+inline, anything that reaches the disk or shared tier (or has to reread the
+shared generations) runs in a worker thread, so SQLite / network I/O (and
+lock waits) never block the event loop.
+
+Hits, misses, evictions, expirations and stale hits are counted in backend.metrics.
+"""
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from typing import Callable, Dict, Optional, Tuple
+from urllib.parse import unquote
+
+from . import metrics, shared_state
+
+logger = logging.getLogger("result_cache")
+
+CACHE_ENABLED = os.getenv("IFU_CACHE_ENABLED", "true").lower() in ("1", "true", "yes", "on")
+CACHE_TTL = float(os.getenv("IFU_CACHE_TTL", "21600"))
+CACHE_MAX_BYTES = int(os.getenv("IFU_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+CACHE_DISK_PATH = os.getenv("IFU_CACHE_DISK_PATH", "")
+CACHE_STALE_TTL = float(os.getenv("IFU_CACHE_STALE_TTL", str(7 * 24 * 3600)))
+SYNC_INTERVAL = float(os.getenv("IFU_CACHE_SYNC_INTERVAL", "1"))
+
+CacheKey = Tuple[str, str, str, str, str]
+
+
+def normalize_keyword(keyword: str) -> str:
+    """NFKC (full-width -> half-width), case-fold and collapse whitespace."""
+    text = unicodedata.normalize("NFKC", keyword or "")
+    return " ".join(text.casefold().split())
+
+
+def make_key(assistantid: str, containerid: Optional[str], mode: Optional[str], keyword: str,
+             limit: Optional[int] = None) -> CacheKey:
+    # 与各接口对 assistantid / containerid 的处理一致（strip + unquote），
+    # 批量子查询与 GET 查询、以及百分号编码的重复查询落在同一条目上
+    call_mode = "ask" if (mode or "").strip().lower() == "ask" else "search"
+    return (
+        unquote((assistantid or "").strip()).strip(),
+        unquote((containerid or "").strip()).strip(),
+        call_mode,
+        normalize_keyword(keyword),
+        str(limit or ""),
+    )
+
+
+class _DiskTier:
+    def __init__(self, path: str, stale_ttl: float = CACHE_STALE_TTL):
+        self.stale_ttl = stale_ttl
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS cache ("
+            " key TEXT PRIMARY KEY, assistantid TEXT NOT NULL, expires_at REAL NOT NULL, value TEXT NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS cache_assistant ON cache(assistantid)")
+        self._conn.execute("DELETE FROM cache WHERE expires_at <= ?", (time.time() - self.stale_ttl,))
+
+    @staticmethod
+    def _k(key: CacheKey) -> str:
+        return json.dumps(key, ensure_ascii=False)
+
+    def get(self, key: CacheKey, stale: bool = False) -> Optional[Tuple[float, str]]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT expires_at, value FROM cache WHERE key = ?", (self._k(key),)
+            ).fetchone()
+        if row is None:
+            return None
+        now = time.time()
+        if row[0] + self.stale_ttl <= now:
+            self.delete(key)
+            return None
+        if row[0] <= now and not stale:
+            return None
+        return row[0], row[1]
+
+    def put(self, key: CacheKey, value: str, expires_at: float) -> None:
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO cache(key, assistantid, expires_at, value) VALUES (?, ?, ?, ?)",
+                (self._k(key), key[0], expires_at, value),
+            )
+
+    def delete(self, key: CacheKey) -> None:
+        with self._lock:
+            self._conn.execute("DELETE FROM cache WHERE key = ?", (self._k(key),))
+
+    def invalidate_assistant(self, assistantid: str) -> int:
+        with self._lock:
+            return self._conn.execute("DELETE FROM cache WHERE assistantid = ?", (assistantid,)).rowcount
+
+    def clear(self) -> int:
+        with self._lock:
+            return self._conn.execute("DELETE FROM cache").rowcount
+
+
+class _SharedTier:
+    """Entries in the shared state backend, stored as JSON {"e": expires_at, "v": value}."""
+
+    def __init__(self, state: shared_state.SharedState, stale_ttl: float, generation: Callable[[str], str]):
+        self._state = state
+        self.stale_ttl = stale_ttl
+        self._generation = generation
+
+    def _k(self, key: CacheKey) -> str:
+        return f"cache:{self._generation(key[0])}:" + json.dumps(key, ensure_ascii=False)
+
+    def get(self, key: CacheKey, stale: bool = False) -> Optional[Tuple[float, str]]:
+        try:
+            raw = self._state.get(self._k(key))
+        except shared_state.SharedStateError as e:
+            logger.log(shared_state.log_level(e), "结果缓存共享层读取失败: %s", e)
+            return None
+        if raw is None:
+            return None
+        entry = json.loads(raw)
+        if entry["e"] <= time.time() and not stale:
+            return None
+        return entry["e"], entry["v"]
+
+    def put(self, key: CacheKey, value: str, expires_at: float) -> None:
+        ttl = max(1.0, expires_at - time.time() + self.stale_ttl)
+        self._state.set(self._k(key), json.dumps({"e": expires_at, "v": value}, ensure_ascii=False), ttl=ttl)
+
+    def invalidate_assistant(self, assistantid: str) -> int:
+        return 0  # 由 ResultCache 递增代数，旧键随 TTL 过期
+
+    def clear(self) -> int:
+        return 0
+
+
+class ResultCache:
+    """Thread-safe LRU + TTL cache bounded by total value size in bytes."""
+
+    def __init__(self, max_bytes: int = CACHE_MAX_BYTES, ttl: float = CACHE_TTL, disk_path: str = CACHE_DISK_PATH,
+                 stale_ttl: float = CACHE_STALE_TTL, state: Optional[shared_state.SharedState] = None):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self._lock = threading.Lock()
+        # key -> (expires_at_monotonic, value, size, generation)
+        self._entries: "OrderedDict[CacheKey, Tuple[float, str, int, str]]" = OrderedDict()
+        self._bytes = 0
+        # key -> {name: bytes}，随条目一起淘汰（见 representations）
+        self._extras: Dict[CacheKey, Dict[str, bytes]] = {}
+        self._state = state if state is not None and state.shared else None
+        # assistantid -> (refresh_at_monotonic, generation)
+        self._generations: Dict[str, Tuple[float, str]] = {}
+        self._disk = None
+        if disk_path:
+            try:
+                self._disk = _DiskTier(disk_path, stale_ttl)
+            except Exception as e:
+                logger.warning("结果缓存磁盘层不可用（%s）：%s", disk_path, e)
+        elif self._state is not None:
+            self._disk = _SharedTier(self._state, stale_ttl, self._generation)
+
+    def _known_generation(self, assistantid: str) -> Optional[str]:
+        """The generation if it can be had without I/O, None when it is due for a reread."""
+        if self._state is None:
+            return ""
+        cached = self._generations.get(assistantid)
+        if cached is not None and cached[0] > time.monotonic():
+            return cached[1]
+        return None
+
+    def _generation(self, assistantid: str) -> str:
+        """Invalidation generation "<global>.<assistant>" ("" without shared state)."""
+        if self._state is None:
+            return ""
+        now = time.monotonic()
+        cached = self._generations.get(assistantid)
+        if cached is not None and cached[0] > now:
+            return cached[1]
+        try:
+            gen = f"{self._state.get('cache:gen') or 0}.{self._state.get('cache:gen:' + assistantid) or 0}"
+        except shared_state.SharedStateError as e:
+            logger.log(shared_state.log_level(e), "结果缓存代数读取失败: %s", e)
+            return cached[1] if cached is not None else "0.0"
+        self._generations[assistantid] = (now + SYNC_INTERVAL, gen)
+        return gen
+
+    def get(self, key: CacheKey) -> Optional[str]:
+        now = time.monotonic()
+        gen = self._generation(key[0])
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry[3] != gen:
+                    self._drop(key)  # 其他 worker 已使其失效
+                elif entry[0] > now:
+                    self._entries.move_to_end(key)
+                    metrics.inc("ifu_cache_hits_total", tier="memory")
+                    return entry[1]
+                elif entry[0] + self.stale_ttl <= now:
+                    self._drop(key)
+                    metrics.inc("ifu_cache_expirations_total")
+        if self._disk is not None:
+            hit = self._disk.get(key)
+            if hit is not None:
+                expires_at, value = hit
+                metrics.inc("ifu_cache_hits_total", tier="disk" if isinstance(self._disk, _DiskTier) else "shared")
+                self._put_memory(key, value, now + max(0.0, expires_at - time.time()), gen)
+                return value
+        metrics.inc("ifu_cache_misses_total")
+        return None
+
+    def _peek(self, key: CacheKey) -> Optional[str]:
+        """Fresh memory-tier value, counted as a memory hit; None otherwise (nothing counted)."""
+        gen = self._known_generation(key[0])
+        if gen is None:
+            return None  # 代数需要重新读取：交给 get()（在线程中）
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[3] != gen or entry[0] <= time.monotonic():
+                return None
+            self._entries.move_to_end(key)
+        metrics.inc("ifu_cache_hits_total", tier="memory")
+        return entry[1]
+
+    async def aget(self, key: CacheKey) -> Optional[str]:
+        """get() for the event loop: the lower tiers (and shared generations) are read in a worker thread."""
+        if self._disk is None and self._state is None:
+            return self.get(key)
+        value = self._peek(key)
+        if value is not None:
+            return value
+        return await asyncio.to_thread(self.get, key)
+
+    async def aput(self, key: CacheKey, value: str) -> None:
+        if self._disk is None and self._state is None:
+            self.put(key, value)
+        else:
+            await asyncio.to_thread(self.put, key, value)
+
+    async def aget_stale(self, key: CacheKey) -> Optional[str]:
+        if self._disk is None and self._state is None:
+            return self.get_stale(key)
+        return await asyncio.to_thread(self.get_stale, key)
+
+    async def acontains(self, key: CacheKey) -> bool:
+        if self._disk is None and self._state is None:
+            return self.contains(key)
+        return await asyncio.to_thread(self.contains, key)
+
+    def contains(self, key: CacheKey) -> bool:
+        """Whether a fresh entry exists (not counted in the metrics, not promoted)."""
+        gen = self._generation(key[0])
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[3] == gen and entry[0] > time.monotonic():
+                return True
+        return self._disk is not None and self._disk.get(key) is not None
+
+    def representations(self, key: CacheKey) -> Optional["Representations"]:
+        """Stored representations of a fresh memory entry, None without one (not counted in the metrics)."""
+        gen = self._known_generation(key[0])
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or gen is None or entry[3] != gen or entry[0] <= time.monotonic():
+                return None
+            return Representations(self, key, entry, dict(self._extras.get(key, ())))
+
+    def get_stale(self, key: CacheKey) -> Optional[str]:
+        """Last stored value for `key`, expired or not (within IFU_CACHE_STALE_TTL)."""
+        now = time.monotonic()
+        gen = self._generation(key[0])
+        value = None
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[3] == gen and entry[0] + self.stale_ttl > now:
+                value = entry[1]
+        if value is None and self._disk is not None:
+            hit = self._disk.get(key, stale=True)
+            if hit is not None:
+                value = hit[1]
+        if value is not None:
+            metrics.inc("ifu_cache_stale_hits_total")
+        return value
+
+    def put(self, key: CacheKey, value: str) -> None:
+        if not value:
+            return
+        self._put_memory(key, value, time.monotonic() + self.ttl, self._generation(key[0]))
+        if self._disk is not None:
+            try:
+                self._disk.put(key, value, time.time() + self.ttl)
+            except Exception as e:
+                logger.log(shared_state.log_level(e), "结果缓存写入磁盘失败: %s", e)
+
+    def invalidate_assistant(self, assistantid: str) -> int:
+        """Drop every entry for one assistant (e.g. after its IFU container was updated)."""
+        with self._lock:
+            keys = [k for k in self._entries if k[0] == assistantid]
+            for k in keys:
+                self._drop(k)
+        removed = len(keys)
+        if self._state is not None:
+            self._bump("cache:gen:" + assistantid)
+            self._generations.pop(assistantid, None)
+        if self._disk is not None:
+            removed = max(removed, self._disk.invalidate_assistant(assistantid))
+        metrics.inc("ifu_cache_invalidations_total", removed)
+        return removed
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._extras.clear()
+            self._bytes = 0
+        if self._state is not None:
+            self._bump("cache:gen")
+            self._generations.clear()
+        if self._disk is not None:
+            self._disk.clear()
+
+    def _bump(self, key: str) -> None:
+        try:
+            self._state.incr(key)
+        except shared_state.SharedStateError as e:
+            logger.log(shared_state.log_level(e), "结果缓存失效未能同步到其他 worker: %s", e)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "ttl": self.ttl,
+                "stale_ttl": self.stale_ttl,
+                "disk": isinstance(self._disk, _DiskTier),
+                "shared": self._state is not None,
+            }
+
+    def _put_memory(self, key: CacheKey, value: str, expires_at: float, generation: str = "") -> None:
+        size = len(value.encode("utf-8")) + sum(len(part) for part in key)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._drop(key)
+            self._entries[key] = (expires_at, value, size, generation)
+            self._bytes += size
+            self._evict()
+
+    def _put_extra(self, key: CacheKey, entry: tuple, name: str, data: bytes) -> None:
+        with self._lock:
+            if self._entries.get(key) is not entry:
+                return  # 条目已被替换或淘汰
+            extras = self._extras.setdefault(key, {})
+            old = extras.get(name)
+            extras[name] = data
+            self._bytes += len(data) - (len(old) if old is not None else 0)
+            self._evict()
+
+    def _evict(self) -> None:
+        # caller holds self._lock
+        while self._bytes > self.max_bytes and self._entries:
+            old_key = next(iter(self._entries))
+            self._drop(old_key)
+            metrics.inc("ifu_cache_evictions_total")
+
+    def _drop(self, key: CacheKey) -> None:
+        # caller holds self._lock
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._bytes -= entry[2]
+        extras = self._extras.pop(key, None)
+        if extras:
+            self._bytes -= sum(len(data) for data in extras.values())
+
+
+class Representations:
+    """Snapshot of the representations stored with one cache entry; put() adds to the entry."""
+
+    __slots__ = ("_cache", "_key", "_entry", "_data")
+
+    def __init__(self, cache: ResultCache, key: CacheKey, entry: tuple, data: Dict[str, bytes]):
+        self._cache = cache
+        self._key = key
+        self._entry = entry
+        self._data = data
+
+    def get(self, name: str) -> Optional[bytes]:
+        return self._data.get(name)
+
+    def put(self, name: str, data: bytes) -> None:
+        self._data[name] = data
+        self._cache._put_extra(self._key, self._entry, name, data)
+
+    def hit(self) -> None:
+        """Count a request answered from these representations as a memory hit."""
+        with self._cache._lock:
+            if self._key in self._cache._entries:
+                self._cache._entries.move_to_end(self._key)
+        metrics.inc("ifu_cache_hits_total", tier="memory")
+
+
+cache = ResultCache(state=shared_state.get_state())
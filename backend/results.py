@@ -0,0 +1,292 @@
+"""Parsed GAIA search results, shared by gaia_client and the endpoints.
+
+A GAIA answer is parsed once into a SearchResult: the upstream text (`raw`,
+what the result cache stores) plus compact ResultItem objects sorted by page.
+Endpoints build their response bodies straight from the items and serialize
+once with FastJSONResponse (orjson when installed).
+
+ResultStream extracts the items of a {"results": [...]} document from text
+deltas while they arrive, so a caller can stop reading the upstream stream
+once it has enough of them.
+"""
+import json
+import re
+from typing import Any, List, Optional
+
+from fastapi.responses import JSONResponse
+
+from . import metrics
+
+try:
+    import orjson
+except ImportError:  # optional dependency
+    orjson = None
+
+SNIPPET_MAX_CHARS = 3000
+
+# parse：上游文本 -> SearchResult；normalize：SearchResult -> 接口结果列表
+metrics.register_histogram("ifu_result_processing_seconds", metrics.FAST_BUCKETS)
+metrics.register_histogram("http_serialize_seconds", metrics.FAST_BUCKETS)
+
+
+def loads(data):
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def dumps(obj: Any) -> bytes:
+    """Compact UTF-8 JSON (non-ASCII kept as is)."""
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def render_json(content: Any) -> bytes:
+    """dumps() for a response body, timed in http_serialize_seconds."""
+    with metrics.timer("http_serialize_seconds"):
+        return dumps(content)
+
+
+class FastJSONResponse(JSONResponse):
+    """JSONResponse rendered with orjson when available."""
+
+    def render(self, content: Any) -> bytes:
+        return render_json(content)
+
+
+class ResultItem:
+    """One hit; missing fields are None so each endpoint can apply its own defaults."""
+
+    __slots__ = ("doc", "page", "refId", "score", "snippet")
+
+    def __init__(self, doc=None, page=None, refId=None, score=None, snippet=None):
+        self.doc = doc
+        self.page = page
+        self.refId = refId
+        self.score = score
+        self.snippet = snippet
+
+    @classmethod
+    def from_dict(cls, it: dict) -> "ResultItem":
+        # 兼容上游的不同字段名
+        doc = it.get("doc")
+        if doc is None:
+            doc = it.get("sourceFile") or it.get("id")
+        page = it.get("page")
+        if page is None:
+            page = it.get("sourcePage")
+        snippet = it.get("snippet")
+        if snippet is None:
+            snippet = it.get("content")
+        return cls(doc, page, it.get("refId") or it.get("refID"), it.get("score"), snippet)
+
+    def to_dict(self) -> dict:
+        return {"doc": self.doc, "page": self.page, "refId": self.refId, "score": self.score, "snippet": self.snippet}
+
+
+def _page_key(item: ResultItem) -> float:
+    p = item.page
+    return p if isinstance(p, (int, float)) and not isinstance(p, bool) else float("inf")
+
+
+def _int(value, default: int) -> int:
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return default
+
+
+def ifu_item(it: ResultItem, assistantid: str) -> Optional[dict]:
+    """One /api/search_ifu result (None for items without a doc)."""
+    doc = (assistantid if it.doc is None else str(it.doc)).strip()
+    if not doc:
+        return None
+    snippet = "" if it.snippet is None else str(it.snippet).strip()
+    return {"doc": doc, "page": max(0, _int(it.page, 0)), "snippet": snippet[:SNIPPET_MAX_CHARS]}
+
+
+class SearchResult:
+    """Upstream text plus its parsed items.
+
+    items is None when the text is not a {"results": [...]} JSON document
+    (free-text answers, PLACEHOLDER). stale is True for a last known good result
+    served from the cache while GAIA is unavailable.
+    """
+
+    __slots__ = ("raw", "items", "stale", "_text")
+
+    def __init__(self, raw: str, items: Optional[List[ResultItem]] = None):
+        self.raw = raw
+        self.items = items
+        self.stale = False
+        self._text: Optional[str] = None
+
+    @classmethod
+    def from_items(cls, items: List[ResultItem]) -> "SearchResult":
+        items = sorted(items, key=_page_key)
+        return cls(dumps({"results": [it.to_dict() for it in items]}).decode("utf-8"), items)
+
+    @classmethod
+    def parse(cls, raw: str) -> "SearchResult":
+        """Parse once; results are sorted by page (items without a numeric page go last)."""
+        raw = raw or ""
+        items = None
+        if raw[:1] in ("{", "["):
+            with metrics.timer("ifu_result_processing_seconds", stage="parse"):
+                try:
+                    data = loads(raw)
+                except ValueError:
+                    data = None
+                if isinstance(data, dict) and isinstance(data.get("results"), list):
+                    items = [ResultItem.from_dict(it) for it in data["results"] if isinstance(it, dict)]
+                    items.sort(key=_page_key)
+        return cls(raw, items)
+
+    @property
+    def structured(self) -> bool:
+        return self.items is not None
+
+    @property
+    def text(self) -> str:
+        """The answer as one string: page-sorted JSON for structured results, else raw."""
+        if self._text is None:
+            if self.items is None:
+                self._text = self.raw
+            else:
+                self._text = dumps({"results": [it.to_dict() for it in self.items]}).decode("utf-8")
+        return self._text
+
+    def ifu_results(self, assistantid: str) -> List[dict]:
+        """Items as /api/search_ifu results: doc/page/snippet, snippet capped at SNIPPET_MAX_CHARS."""
+        if self.items is None:
+            # 非 JSON 时为了兼容前端，包装为一条记录（使用 assistantid 作为 doc，page=0）
+            if not self.raw:
+                return []
+            return [{"doc": assistantid, "page": 0, "snippet": self.raw[:SNIPPET_MAX_CHARS]}]
+        out = []
+        with metrics.timer("ifu_result_processing_seconds", stage="normalize"):
+            for it in self.items:
+                d = ifu_item(it, assistantid)
+                if d is not None:
+                    out.append(d)
+        return out
+
+    def doc_results(self) -> List[dict]:
+        """Items as /api/doc_search results: doc/page/refId/snippet, snippet unchanged."""
+        out = []
+        with metrics.timer("ifu_result_processing_seconds", stage="normalize"):
+            for it in self.items or ():
+                # 严格不修改 snippet 内容
+                if not isinstance(it.snippet, str):
+                    continue
+                out.append({
+                    "doc": "" if it.doc is None else str(it.doc),
+                    "page": _int(it.page or 1, 1),
+                    "refId": "" if it.refId is None else str(it.refId),
+                    "snippet": it.snippet,
+                })
+        return out
+
+
+_RESULTS_RE = re.compile(r'"results"\s*:\s*\[')
+_ITEM_START = re.compile(r"[{\]]")
+_STRUCTURAL = re.compile(r'["{}\[\]]')
+_STRING_END = re.compile(r'["\\]')
+
+
+class ResultStream:
+    """Incremental extractor for the items of a {"results": [...]} document.
+
+    feed() takes text deltas and returns the items whose closing brace has
+    arrived, in upstream order. Only the unfinished tail of the text is
+    buffered. reset() starts over (upstream retry, see STREAM_RESET).
+    """
+
+    __slots__ = ("items", "done", "_buf", "_pos", "_in_array", "_depth", "_in_str", "_start")
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self) -> None:
+        self.items: List[ResultItem] = []
+        self.done = False  # closing "]" of the results array seen
+        self._buf = ""
+        self._pos = 0
+        self._in_array = False
+        self._depth = 0
+        self._in_str = False
+        self._start = 0
+
+    def feed(self, delta: str) -> List[ResultItem]:
+        if self.done or not delta:
+            return []
+        buf = self._buf + delta
+        if not self._in_array:
+            m = _RESULTS_RE.search(buf)
+            if m is None:
+                self._buf = buf[-32:]  # 仅保留可能被拆开的 "results" 键
+                return []
+            self._in_array = True
+            buf, self._pos = buf[m.end():], 0
+        new: List[ResultItem] = []
+        i, n = self._pos, len(buf)
+        while i < n:
+            if self._depth == 0:
+                m = _ITEM_START.search(buf, i)
+                if m is None:
+                    i = n
+                    break
+                if m.group() == "]":
+                    self.done = True
+                    i = n
+                    break
+                self._depth, self._start, i = 1, m.start(), m.end()
+            elif self._in_str:
+                m = _STRING_END.search(buf, i)
+                if m is None:
+                    i = n
+                elif m.group() == "\\":
+                    if m.end() >= n:
+                        i = m.start()  # 转义符在末尾：等下一段再判断
+                        break
+                    i = m.end() + 1
+                else:
+                    self._in_str, i = False, m.end()
+            else:
+                m = _STRUCTURAL.search(buf, i)
+                if m is None:
+                    i = n
+                    break
+                ch, i = m.group(), m.end()
+                if ch == '"':
+                    self._in_str = True
+                elif ch in "{[":
+                    self._depth += 1
+                else:
+                    self._depth -= 1
+                    if self._depth == 0:
+                        item = self._decode(buf[self._start:i])
+                        if item is not None:
+                            new.append(item)
+        # 只保留尚未完成的条目
+        if self._depth:
+            buf, i = buf[self._start:], i - self._start
+            self._start = 0
+        else:
+            buf, i = buf[i:], 0
+        self._buf, self._pos = buf, i
+        self.items.extend(new)
+        return new
+
+    @staticmethod
+    def _decode(text: str) -> Optional[ResultItem]:
+        try:
+            obj = loads(text)
+        except ValueError:
+            return None
+        return ResultItem.from_dict(obj) if isinstance(obj, dict) else None
+
+    def result(self, limit: Optional[int] = None) -> SearchResult:
+        """SearchResult of the first `limit` items (all when None), sorted by page."""
+        return SearchResult.from_items(self.items[:limit] if limit else self.items)
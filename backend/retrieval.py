@@ -0,0 +1,204 @@
+"""Hybrid retrieval over the local IFU index for mode=ask.
+
+Pages are ranked twice — lexically with the BM25 index (ifu_index) and
+semantically with a CPU-only embedding model behind a NumPy cosine-similarity
+index — and the two rankings are fused with reciprocal rank fusion. The top-k
+pages are cut down to passages around the best hit and handed to
+gaia_client.call_atlan_qa as grounded context, so GAIA sees only a few
+thousand characters instead of whatever the assistant's built-in RAG retrieves.
+
+Embedding model:
+- default: hashed character n-gram vectors (no download, deterministic, fast);
+- IFU_EMBED_MODEL=<sentence-transformers model name>: used when the optional
+  `sentence-transformers` package is installed.
+
+Page vectors are computed by `python -m backend.ifu_index ingest` right after
+the index is written (build_embeddings) and saved next to the page store as
+embeddings-<model>.npy, loaded with mmap_mode="r" and shared across workers.
+When the file is missing (index written some other way, different
+IFU_EMBED_MODEL) it is built once in a background thread; until it is ready
+mode=ask ranks pages lexically only, so no request waits for the encode.
+NumPy is an optional dependency; without it hybrid retrieval is disabled.
+"""
+import hashlib
+import logging
+import os
+import threading
+from typing import Dict, List, Optional, Set
+
+try:
+    import numpy as np
+except ImportError:  # optional dependency
+    np = None
+
+from . import ifu_index
+
+logger = logging.getLogger("retrieval")
+
+HYBRID_ASK = os.getenv("IFU_HYBRID_ASK", "false").lower() in ("1", "true", "yes", "on")
+HYBRID_TOP_K = int(os.getenv("IFU_HYBRID_TOP_K", "5"))
+HYBRID_CANDIDATES = int(os.getenv("IFU_HYBRID_CANDIDATES", "50"))
+PASSAGE_CHARS = int(os.getenv("IFU_HYBRID_PASSAGE_CHARS", "800"))
+EMBED_MODEL = os.getenv("IFU_EMBED_MODEL", "")
+EMBED_DIM = int(os.getenv("IFU_EMBED_DIM", "384"))
+RRF_K = 60
+
+
+def available() -> bool:
+    return np is not None
+
+
+class HashingEmbedder:
+    """Hashed character 1–3-gram bag, L2-normalised. Works on CJK and Latin text alike."""
+
+    name = "hashing"
+
+    def __init__(self, dim: int = EMBED_DIM):
+        self.dim = dim
+
+    def _bucket(self, gram: str) -> int:
+        return int.from_bytes(hashlib.blake2b(gram.encode("utf-8"), digest_size=4).digest(), "little") % self.dim
+
+    def encode(self, texts: List[str]) -> "np.ndarray":
+        out = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            s = "".join(ifu_index.normalize_text(text).casefold().split())
+            for n in (1, 2, 3):
+                for i in range(len(s) - n + 1):
+                    out[row, self._bucket(s[i:i + n])] += 1.0
+        norms = np.linalg.norm(out, axis=1, keepdims=True)
+        np.divide(out, norms, out=out, where=norms > 0)
+        return out
+
+
+class SentenceTransformerEmbedder:
+    def __init__(self, model_name: str):
+        from sentence_transformers import SentenceTransformer  # optional dependency
+        self.name = model_name
+        self._model = SentenceTransformer(model_name, device="cpu")
+
+    def encode(self, texts: List[str]) -> "np.ndarray":
+        vecs = self._model.encode(texts, batch_size=32, normalize_embeddings=True)
+        return np.asarray(vecs, dtype=np.float32)
+
+
+_embedder = None
+_embedder_lock = threading.Lock()
+# 只保护 _vectors / _building，不在持锁期间做磁盘读取或模型加载
+_lock = threading.Lock()
+# (containerid, index mtime) -> page embedding matrix
+_vectors: Dict[tuple, "np.ndarray"] = {}
+# 正在后台计算向量的 (containerid, index mtime)
+_building: Set[tuple] = set()
+
+
+def get_embedder():
+    global _embedder
+    if _embedder is not None:
+        return _embedder
+    with _embedder_lock:
+        if _embedder is None:
+            embedder = None
+            if EMBED_MODEL:
+                try:
+                    embedder = SentenceTransformerEmbedder(EMBED_MODEL)
+                except Exception as e:
+                    logger.warning("无法加载嵌入模型 %s（%s），改用 hashing 向量。", EMBED_MODEL, e)
+            _embedder = embedder or HashingEmbedder()
+    return _embedder
+
+
+def _embeddings_path(idx: "ifu_index.IfuIndex", embedder):
+    return idx.store.root / f"embeddings-{embedder.name.replace('/', '_')}.npy"
+
+
+def build_embeddings(containerid: str) -> Optional[int]:
+    """Encode every page of the container's current index and save the matrix; returns the page count."""
+    if np is None:
+        return None
+    idx = ifu_index.get_index(containerid)
+    if idx is None:
+        return None
+    embedder = get_embedder()
+    texts = [idx.store.document(doc_idx).page_text(page_no) or "" for doc_idx, page_no in zip(idx.page_doc, idx.page_no)]
+    vecs = embedder.encode(texts)
+    path = _embeddings_path(idx, embedder)
+    # 每个进程/线程各用一个临时文件，整体替换，其它 worker 不会读到写了一半的文件
+    tmp = path.with_name(f"{path.name}.{os.getpid()}.{threading.get_ident()}.tmp.npy")
+    np.save(tmp, vecs)
+    tmp.replace(path)
+    return len(texts)
+
+
+def _build_in_background(idx: "ifu_index.IfuIndex", key: tuple) -> None:
+    try:
+        build_embeddings(idx.containerid)
+        logger.info("页面向量已生成：%s", idx.containerid)
+    except Exception as e:
+        logger.warning("页面向量生成失败（%s）：%s", idx.containerid, e)
+    finally:
+        with _lock:
+            _building.discard(key)
+
+
+def _page_vectors(idx: "ifu_index.IfuIndex") -> Optional["np.ndarray"]:
+    """The page embedding matrix, or None while it is still being built."""
+    key = (idx.containerid, idx.mtime)
+    with _lock:
+        vecs = _vectors.get(key)
+    if vecs is not None:
+        return vecs
+    path = _embeddings_path(idx, get_embedder())
+    try:
+        vecs = np.load(path, mmap_mode="r")
+    except (OSError, ValueError):
+        with _lock:
+            if key in _building:
+                return None
+            _building.add(key)
+        logger.info("页面向量不存在，后台生成中（%s）；此前 mode=ask 仅用词法检索", idx.containerid)
+        threading.Thread(target=_build_in_background, args=(idx, key), daemon=True).start()
+        return None
+    with _lock:
+        _vectors.clear()  # 只保留当前构建的向量
+        _vectors[key] = vecs
+    return vecs
+
+
+def retrieve(containerid: str, query: str, top_k: int = HYBRID_TOP_K) -> List[dict]:
+    """Top-k passages {"doc","page","score","text"} for `query`, or [] when unavailable."""
+    if np is None:
+        return []
+    idx = ifu_index.get_index(containerid)
+    if idx is None or not idx.page_len:
+        return []
+
+    lexical = idx.rank(query, HYBRID_CANDIDATES)
+    vecs = _page_vectors(idx)
+    if vecs is not None:
+        q = get_embedder().encode([query])[0]
+        sims = vecs @ q
+        k = min(HYBRID_CANDIDATES, len(sims))
+        dense = np.argpartition(-sims, k - 1)[:k]
+        dense = dense[np.argsort(-sims[dense])]
+        dense = dense[sims[dense] > 0]  # 与查询毫无相似的页（含空白页）不参与融合
+    else:
+        dense = np.empty(0, dtype=np.int64)
+
+    fused: Dict[int, float] = {}
+    for rank, (page_id, _) in enumerate(lexical):
+        fused[page_id] = fused.get(page_id, 0.0) + 1.0 / (RRF_K + rank + 1)
+    for rank, page_id in enumerate(dense.tolist()):
+        fused[page_id] = fused.get(page_id, 0.0) + 1.0 / (RRF_K + rank + 1)
+
+    needles = ifu_index.snippet_needles(query)
+    passages = []
+    for page_id, score in sorted(fused.items(), key=lambda kv: kv[1], reverse=True):
+        doc_idx, page_no = idx.page_doc[page_id], idx.page_no[page_id]
+        text = idx.snippet(doc_idx, page_no, needles, width=PASSAGE_CHARS)
+        if not text:
+            continue
+        passages.append({"doc": idx.docs[doc_idx], "page": page_no, "score": round(score, 5), "text": text})
+        if len(passages) >= top_k:
+            break
+    return passages
@@ -0,0 +1,85 @@
+"""Retry scheduling for upstream GAIA calls.
+
+- Full-jitter exponential backoff with a cap (sleep = uniform(0, min(cap, base ** attempt))).
+- `Retry-After` (seconds or HTTP-date) is honoured for 429/503 responses.
+- Every call carries a `Deadline`; no wait or attempt is allowed to run past it,
+  so the total latency of a call never exceeds GAIA_CALL_DEADLINE.
+- Waiting uses asyncio.sleep, so no worker thread is parked during backoff.
+"""
+import asyncio
+import os
+import random
+import time
+from email.utils import parsedate_to_datetime
+from typing import Optional
+
+from . import metrics
+
+BACKOFF_BASE = float(os.getenv("GAIA_BACKOFF_BASE", "1.5"))
+BACKOFF_CAP = float(os.getenv("GAIA_BACKOFF_CAP", "10"))
+CALL_DEADLINE = float(os.getenv("GAIA_CALL_DEADLINE", "120"))
+
+# 仅在这些状态码上读取 Retry-After
+RETRY_AFTER_STATUSES = (429, 503)
+
+
+class Deadline:
+    """Monotonic per-call latency budget."""
+
+    __slots__ = ("expires_at",)
+
+    def __init__(self, budget: float = CALL_DEADLINE):
+        self.expires_at = time.monotonic() + max(0.0, budget)
+
+    def remaining(self) -> float:
+        return max(0.0, self.expires_at - time.monotonic())
+
+    def expired(self) -> bool:
+        return self.remaining() <= 0.0
+
+
+def backoff_delay(attempt: int, base: float = BACKOFF_BASE, cap: float = BACKOFF_CAP) -> float:
+    """Full-jitter delay for the given 1-based attempt number."""
+    return random.uniform(0.0, min(cap, base ** attempt))
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Parse a Retry-After header (delta-seconds or HTTP-date) into seconds."""
+    if not value:
+        return None
+    value = value.strip()
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        when = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if when is None:
+        return None
+    return max(0.0, when.timestamp() - time.time())
+
+
+def next_delay(attempt: int, status: Optional[int] = None, retry_after: Optional[str] = None) -> float:
+    """Delay before the next attempt; Retry-After wins over jitter on 429/503."""
+    if status in RETRY_AFTER_STATUSES:
+        hinted = parse_retry_after(retry_after)
+        if hinted is not None:
+            return hinted
+    return backoff_delay(attempt)
+
+
+async def sleep_within(delay: float, deadline: Deadline, reason: str) -> bool:
+    """Sleep for `delay` unless that would cross the deadline.
+
+    Returns False (without sleeping) when the budget cannot cover the wait, in
+    which case the caller should give up instead of retrying.
+    """
+    if delay >= deadline.remaining():
+        metrics.inc("gaia_retry_giveups_total", reason="deadline")
+        return False
+    metrics.inc("gaia_retries_total", reason=reason, **metrics.context_labels())
+    metrics.inc("gaia_retry_wait_seconds_total", delay)
+    await asyncio.sleep(delay)
+    return True
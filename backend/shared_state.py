@@ -0,0 +1,566 @@
+"""State shared by all uvicorn / gunicorn workers.
+
+SHARED_STATE_URL selects the backend:
+- "" (default): MemoryState, private to the process (the single-worker behaviour);
+- sqlite:///state.db (relative) or sqlite:////var/lib/ifu/state.db: a SQLite
+  file in WAL mode, shared by the workers of one host without any extra service;
+- redis://[:password@]host:6379/0: a server speaking the Redis protocol (RESP).
+  Only PING, AUTH, SELECT, GET, SET (PX, NX), INCRBY, PEXPIRE (NX), MULTI /
+  EXEC and DEL are used; PEXPIRE ... NX needs Redis 7 or later. The stand-in
+  in this module is enough for local runs (it keeps one keyspace in memory
+  and ignores the database number):
+
+      python -m backend.shared_state serve --port 6380
+
+Every backend offers the same operations on string values: get, set (with an
+optional TTL and only-if-absent), incr (TTL set when the key is created) and
+delete. Users: the session token budget (tokens.SessionBudget), the hedge
+budget (hedge.acquire) and the result cache tier and invalidation generations
+(result_cache). Backend failures raise SharedStateError; the callers then fall
+back to their per-process state, so an unavailable store never fails a request.
+
+The SQLite and Redis backends block (file locks, sockets), so callers on the
+event loop run them in a worker thread (asyncio.to_thread). After a failure a
+backend is skipped for SHARED_STATE_COOLDOWN seconds (default 5): calls raise
+SharedStateError at once instead of reconnecting, so a dead or blackholed
+server costs one timeout per cooldown, not one per call. Failures and skipped
+calls are counted in shared_state_errors_total / shared_state_skipped_total.
+"""
+import argparse
+import asyncio
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+from typing import Dict, Optional, Tuple
+from urllib.parse import unquote, urlparse
+
+from . import metrics
+
+logger = logging.getLogger("shared_state")
+
+SHARED_STATE_URL = os.getenv("SHARED_STATE_URL", "")
+SOCKET_TIMEOUT = float(os.getenv("SHARED_STATE_TIMEOUT", "0.5"))
+COOLDOWN = float(os.getenv("SHARED_STATE_COOLDOWN", "5"))
+# 每写入多少次顺带清理一次过期键
+SWEEP_EVERY = 1000
+
+
+class SharedStateError(Exception):
+    """The shared state backend failed (connection, protocol or database error)."""
+
+
+class SharedStateCooldown(SharedStateError):
+    """The call was skipped: the backend failed less than SHARED_STATE_COOLDOWN seconds ago."""
+
+
+def log_level(e: BaseException) -> int:
+    """Level for logging a caller's fallback: skipped calls at DEBUG (the failure itself was logged once)."""
+    return logging.DEBUG if isinstance(e, SharedStateCooldown) else logging.WARNING
+
+
+class SharedState:
+    """Key/value store with TTLs and atomic counters."""
+
+    name = "memory"
+    shared = False  # True：其他 worker 也能看到写入
+    _down_until = 0.0  # 失败后的冷却期（monotonic）
+
+    def available(self) -> bool:
+        return self._down_until <= time.monotonic()
+
+    def _check(self) -> None:
+        """Raise at once while the backend is cooling down after a failure."""
+        if self._down_until > time.monotonic():
+            metrics.inc("shared_state_skipped_total")
+            raise SharedStateCooldown(f"共享状态（{self.name}）暂不可用，冷却中")
+
+    def _failed(self, e: BaseException) -> None:
+        now = time.monotonic()
+        if self._down_until <= now:
+            logger.warning("共享状态（%s）不可用，%g 秒内不再尝试: %s", self.name, COOLDOWN, e)
+        self._down_until = now + COOLDOWN
+        metrics.inc("shared_state_errors_total", backend=self.name)
+
+    def get(self, key: str) -> Optional[str]:
+        raise NotImplementedError
+
+    def set(self, key: str, value: str, ttl: Optional[float] = None, nx: bool = False) -> bool:
+        """Store `value`; with nx only when the key is absent. Returns whether it was stored."""
+        raise NotImplementedError
+
+    def incr(self, key: str, amount: int = 1, ttl: Optional[float] = None) -> int:
+        """Add `amount` and return the new value; a new key starts at 0 and gets `ttl`."""
+        raise NotImplementedError
+
+    def delete(self, key: str) -> None:
+        raise NotImplementedError
+
+    def close(self) -> None:
+        pass
+
+
+class MemoryState(SharedState):
+    """Per-process dict (thread-safe)."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._data: Dict[str, Tuple[str, Optional[float]]] = {}  # key -> (value, expires_at_monotonic)
+        self._writes = 0
+
+    def _live(self, key: str, now: float) -> Optional[str]:
+        # caller holds self._lock
+        entry = self._data.get(key)
+        if entry is None:
+            return None
+        if entry[1] is not None and entry[1] <= now:
+            del self._data[key]
+            return None
+        return entry[0]
+
+    def _wrote(self, now: float) -> None:
+        # caller holds self._lock
+        self._writes += 1
+        if self._writes % SWEEP_EVERY == 0:
+            for k in [k for k, (_, exp) in self._data.items() if exp is not None and exp <= now]:
+                del self._data[k]
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            return self._live(key, time.monotonic())
+
+    def set(self, key: str, value: str, ttl: Optional[float] = None, nx: bool = False) -> bool:
+        now = time.monotonic()
+        with self._lock:
+            if nx and self._live(key, now) is not None:
+                return False
+            self._data[key] = (str(value), now + ttl if ttl else None)
+            self._wrote(now)
+            return True
+
+    def incr(self, key: str, amount: int = 1, ttl: Optional[float] = None) -> int:
+        now = time.monotonic()
+        with self._lock:
+            current = self._live(key, now)
+            if current is None:
+                value, expires_at = amount, (now + ttl if ttl else None)
+            else:
+                try:
+                    value = int(current) + amount
+                except ValueError:
+                    raise SharedStateError(f"{key} 的值不是整数")
+                expires_at = self._data[key][1]
+            self._data[key] = (str(value), expires_at)
+            self._wrote(now)
+            return value
+
+    def expire(self, key: str, ttl: float, nx: bool = False) -> bool:
+        """Set the TTL of an existing key; with nx only if it has none yet."""
+        now = time.monotonic()
+        with self._lock:
+            value = self._live(key, now)
+            if value is None or (nx and self._data[key][1] is not None):
+                return False
+            self._data[key] = (value, now + ttl)
+            return True
+
+    def delete(self, key: str) -> None:
+        with self._lock:
+            self._data.pop(key, None)
+
+
+class SqliteState(SharedState):
+    """One SQLite file (WAL) shared by the processes of a host; connections are per process."""
+
+    name = "sqlite"
+    shared = True
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn_obj: Optional[sqlite3.Connection] = None
+        self._pid = 0
+        self._writes = 0
+        self._conn()  # 路径有误时尽早报错
+
+    def _conn(self) -> sqlite3.Connection:
+        # caller holds self._lock (or is __init__)；fork 之后的子进程重新建连
+        if self._conn_obj is None or self._pid != os.getpid():
+            try:
+                conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None, timeout=5)
+                conn.execute("PRAGMA journal_mode=WAL")
+                conn.execute("PRAGMA synchronous=NORMAL")
+                conn.execute("CREATE TABLE IF NOT EXISTS kv (key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL)")
+            except sqlite3.Error as e:
+                raise SharedStateError(f"共享状态库无法打开（{self.path}）：{e}") from e
+            self._conn_obj, self._pid = conn, os.getpid()
+        return self._conn_obj
+
+    def _execute(self, sql: str, args: tuple = (), write: bool = False) -> Tuple[Optional[tuple], int]:
+        """(first row, rowcount) of one statement; rows are fetched while holding the lock."""
+        self._check()
+        try:
+            with self._lock:
+                conn = self._conn()
+                cur = conn.execute(sql, args)
+                row = cur.fetchone()
+                rowcount = cur.rowcount
+                if write:
+                    self._writes += 1
+                    if self._writes % SWEEP_EVERY == 0:
+                        conn.execute("DELETE FROM kv WHERE expires_at <= ?", (time.time(),))
+                return row, rowcount
+        except sqlite3.Error as e:
+            self._failed(e)
+            raise SharedStateError(str(e)) from e
+        except SharedStateError as e:  # 无法打开数据库
+            self._failed(e)
+            raise
+
+    def get(self, key: str) -> Optional[str]:
+        row, _ = self._execute(
+            "SELECT value FROM kv WHERE key = ? AND (expires_at IS NULL OR expires_at > ?)", (key, time.time())
+        )
+        return row[0] if row else None
+
+    def set(self, key: str, value: str, ttl: Optional[float] = None, nx: bool = False) -> bool:
+        now = time.time()
+        expires_at = now + ttl if ttl else None
+        if nx:
+            # 已存在但过期的键视为不存在
+            _, changed = self._execute(
+                "INSERT INTO kv(key, value, expires_at) VALUES (?, ?, ?) ON CONFLICT(key) DO UPDATE"
+                " SET value = excluded.value, expires_at = excluded.expires_at"
+                " WHERE kv.expires_at IS NOT NULL AND kv.expires_at <= ?",
+                (key, str(value), expires_at, now), write=True,
+            )
+            return changed > 0
+        self._execute("INSERT OR REPLACE INTO kv(key, value, expires_at) VALUES (?, ?, ?)",
+                      (key, str(value), expires_at), write=True)
+        return True
+
+    def incr(self, key: str, amount: int = 1, ttl: Optional[float] = None) -> int:
+        now = time.time()
+        expired = "(kv.expires_at IS NOT NULL AND kv.expires_at <= ?)"
+        row, _ = self._execute(
+            "INSERT INTO kv(key, value, expires_at) VALUES (?, ?, ?) ON CONFLICT(key) DO UPDATE SET"
+            f" value = CASE WHEN {expired} THEN excluded.value ELSE CAST(kv.value AS INTEGER) + ? END,"
+            f" expires_at = CASE WHEN {expired} THEN excluded.expires_at ELSE kv.expires_at END"
+            " RETURNING value",
+            (key, str(amount), now + ttl if ttl else None, now, amount, now), write=True,
+        )
+        return int(row[0])
+
+    def delete(self, key: str) -> None:
+        self._execute("DELETE FROM kv WHERE key = ?", (key,), write=True)
+
+    def close(self) -> None:
+        with self._lock:
+            if self._conn_obj is not None and self._pid == os.getpid():
+                self._conn_obj.close()
+            self._conn_obj = None
+
+
+class RedisState(SharedState):
+    """Minimal blocking RESP2 client: one connection per process, reconnected once on failure."""
+
+    name = "redis"
+    shared = True
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 6379, db: int = 0,
+                 password: Optional[str] = None, timeout: float = SOCKET_TIMEOUT):
+        self.host, self.port, self.db, self.password, self.timeout = host, port, db, password, timeout
+        self._lock = threading.Lock()
+        self._sock: Optional[socket.socket] = None
+        self._file = None
+        self._pid = 0
+
+    @classmethod
+    def from_url(cls, url: str) -> "RedisState":
+        u = urlparse(url)
+        db = (u.path or "/").strip("/")
+        return cls(u.hostname or "127.0.0.1", u.port or 6379, int(db) if db else 0,
+                   unquote(u.password) if u.password else None)
+
+    def _connect(self) -> None:
+        self._disconnect()
+        sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._sock, self._file, self._pid = sock, sock.makefile("rb"), os.getpid()
+        if self.password:
+            self._roundtrip("AUTH", self.password)
+        if self.db:
+            self._roundtrip("SELECT", self.db)
+
+    def _disconnect(self) -> None:
+        if self._sock is not None and self._pid == os.getpid():
+            try:
+                self._file.close()
+                self._sock.close()
+            except OSError:
+                pass
+        self._sock = self._file = None
+
+    @staticmethod
+    def _encode(args) -> bytes:
+        out = [b"*%d\r\n" % len(args)]
+        for a in args:
+            data = a if isinstance(a, bytes) else str(a).encode("utf-8")
+            out.append(b"$%d\r\n%s\r\n" % (len(data), data))
+        return b"".join(out)
+
+    def _read(self):
+        line = self._file.readline()
+        if not line.endswith(b"\r\n"):
+            raise ConnectionError("连接已关闭")
+        kind, rest = line[:1], line[1:-2]
+        if kind == b"+":
+            return rest.decode("utf-8")
+        if kind == b"-":
+            raise SharedStateError(rest.decode("utf-8", "replace"))
+        if kind == b":":
+            return int(rest)
+        if kind == b"$":
+            n = int(rest)
+            if n < 0:
+                return None
+            data = self._file.read(n + 2)
+            if len(data) != n + 2:
+                raise ConnectionError("连接已关闭")
+            return data[:-2].decode("utf-8")
+        if kind == b"*":
+            n = int(rest)
+            if n < 0:
+                return None
+            items, error = [], None
+            for _ in range(n):
+                # 数组中的错误（EXEC 的某条命令失败）：读完整个回复再抛出，连接保持同步
+                try:
+                    items.append(self._read())
+                except SharedStateError as e:
+                    error = error or e
+                    items.append(None)
+            if error is not None:
+                raise error
+            return items
+        raise SharedStateError(f"无法解析的 RESP 回复: {line[:40]!r}")
+
+    def _roundtrip(self, *args):
+        # caller holds self._lock
+        self._sock.sendall(self._encode(args))
+        return self._read()
+
+    def _pipeline(self, commands) -> list:
+        # caller holds self._lock；一次发送、依次读回全部回复
+        self._sock.sendall(b"".join(self._encode(args) for args in commands))
+        replies, error = [], None
+        for _ in commands:
+            try:
+                replies.append(self._read())
+            except SharedStateError as e:
+                error = error or e
+                replies.append(None)
+        if error is not None:
+            raise error
+        return replies
+
+    def command(self, *args):
+        return self.pipeline([args])[0]
+
+    def pipeline(self, commands) -> list:
+        """Send several commands in one round trip; returns their replies."""
+        self._check()
+        with self._lock:
+            self._check()  # 等锁期间另一个调用可能刚失败
+            for attempt in (1, 2):
+                try:
+                    if self._sock is None or self._pid != os.getpid():
+                        self._connect()
+                    return self._pipeline(commands)
+                except OSError as e:
+                    # 连接断开（服务重启、空闲超时）：重连一次
+                    self._disconnect()
+                    if attempt == 2:
+                        self._failed(e)
+                        raise SharedStateError(f"{self.host}:{self.port} 不可用：{e}") from e
+
+    def get(self, key: str) -> Optional[str]:
+        return self.command("GET", key)
+
+    def set(self, key: str, value: str, ttl: Optional[float] = None, nx: bool = False) -> bool:
+        args = ["SET", key, value]
+        if ttl:
+            args += ["PX", max(1, int(ttl * 1000))]
+        if nx:
+            args.append("NX")
+        return self.command(*args) is not None
+
+    def incr(self, key: str, amount: int = 1, ttl: Optional[float] = None) -> int:
+        if not ttl:
+            return self.command("INCRBY", key, amount)
+        # 一次往返的事务：递增，并只在键还没有过期时间时设置（PEXPIRE NX），
+        # 不会与其他 worker 的递增交错，也不会延长已有的过期时间
+        replies = self.pipeline([
+            ("MULTI",),
+            ("INCRBY", key, amount),
+            ("PEXPIRE", key, max(1, int(ttl * 1000)), "NX"),
+            ("EXEC",),
+        ])
+        return replies[-1][0]
+
+    def delete(self, key: str) -> None:
+        self.command("DEL", key)
+
+    def close(self) -> None:
+        with self._lock:
+            self._disconnect()
+
+
+def from_url(url: str) -> SharedState:
+    if not url:
+        return MemoryState()
+    scheme = urlparse(url).scheme
+    if scheme == "sqlite":
+        # 与 SQLAlchemy 相同：sqlite:///relative.db、sqlite:////absolute/path.db
+        return SqliteState(url[len("sqlite:///"):])
+    if scheme in ("redis", "tcp"):
+        return RedisState.from_url(url)
+    raise ValueError(f"不支持的 SHARED_STATE_URL: {url}")
+
+
+_state: Optional[SharedState] = None
+_state_lock = threading.Lock()
+
+
+def get_state() -> SharedState:
+    """The process-wide backend configured by SHARED_STATE_URL (MemoryState if it cannot be opened)."""
+    global _state
+    if _state is None:
+        with _state_lock:
+            if _state is None:
+                try:
+                    _state = from_url(SHARED_STATE_URL)
+                except (SharedStateError, ValueError) as e:
+                    logger.warning("共享状态不可用，改用进程内状态: %s", e)
+                    _state = MemoryState()
+    return _state
+
+
+def stats() -> dict:
+    state = get_state()
+    return {"backend": state.name, "shared": state.shared, "available": state.available()}
+
+
+# =============================
+# 本地 RESP 替身：python -m backend.shared_state serve
+# =============================
+async def _serve_client(store: MemoryState, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+    queued: Optional[list] = None  # MULTI 之后排队的命令
+    try:
+        while True:
+            header = await reader.readline()
+            if not header:
+                break
+            if not header.startswith(b"*"):
+                writer.write(b"-ERR inline commands are not supported\r\n")
+                continue
+            args = []
+            for _ in range(int(header[1:])):
+                n = int((await reader.readline())[1:])
+                args.append((await reader.readexactly(n + 2))[:-2].decode("utf-8"))
+            cmd, rest = args[0].upper(), args[1:]
+            if cmd == "MULTI":
+                reply = b"-ERR MULTI calls can not be nested\r\n" if queued is not None else b"+OK\r\n"
+                if queued is None:
+                    queued = []
+            elif cmd == "EXEC":
+                if queued is None:
+                    reply = b"-ERR EXEC without MULTI\r\n"
+                else:
+                    # 事件循环单线程、中间没有 await：排队的命令整体原子执行
+                    replies = [_dispatch(store, c, r) for c, r in queued]
+                    reply = b"*%d\r\n" % len(replies) + b"".join(replies)
+                    queued = None
+            elif cmd == "DISCARD":
+                reply = b"-ERR DISCARD without MULTI\r\n" if queued is None else b"+OK\r\n"
+                queued = None
+            elif queued is not None:
+                queued.append((cmd, rest))
+                reply = b"+QUEUED\r\n"
+            else:
+                reply = _dispatch(store, cmd, rest)
+            writer.write(reply)
+            await writer.drain()
+    except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+        pass
+    finally:
+        writer.close()
+
+
+def _dispatch(store: MemoryState, cmd: str, rest: list) -> bytes:
+    def bulk(value: Optional[str]) -> bytes:
+        if value is None:
+            return b"$-1\r\n"
+        data = value.encode("utf-8")
+        return b"$%d\r\n%s\r\n" % (len(data), data)
+
+    try:
+        if cmd == "PING":
+            reply = b"+PONG\r\n"
+        elif cmd in ("AUTH", "SELECT"):
+            reply = b"+OK\r\n"
+        elif cmd == "GET":
+            reply = bulk(store.get(rest[0]))
+        elif cmd == "SET":
+            opts = [o.upper() for o in rest[2:]]
+            ttl = None
+            for unit, scale in (("PX", 1000.0), ("EX", 1.0)):
+                if unit in opts:
+                    ttl = float(rest[2 + opts.index(unit) + 1]) / scale
+            stored = store.set(rest[0], rest[1], ttl=ttl, nx="NX" in opts)
+            reply = b"+OK\r\n" if stored else b"$-1\r\n"
+        elif cmd in ("INCR", "INCRBY"):
+            reply = b":%d\r\n" % store.incr(rest[0], int(rest[1]) if cmd == "INCRBY" else 1)
+        elif cmd == "PEXPIRE":
+            nx = [o.upper() for o in rest[2:]] == ["NX"]
+            if rest[2:] and not nx:
+                raise ValueError("only the NX option is supported")
+            reply = b":%d\r\n" % int(store.expire(rest[0], int(rest[1]) / 1000.0, nx=nx))
+        elif cmd == "DEL":
+            found = [k for k in rest if store.get(k) is not None]
+            for k in rest:
+                store.delete(k)
+            reply = b":%d\r\n" % len(found)
+        else:
+            reply = f"-ERR unknown command '{cmd}'\r\n".encode("utf-8")
+    except (IndexError, ValueError, SharedStateError) as e:
+        reply = f"-ERR {e}\r\n".encode("utf-8")
+    return reply
+
+
+async def _serve(host: str, port: int) -> None:
+    store = MemoryState()
+    server = await asyncio.start_server(lambda r, w: _serve_client(store, r, w), host, port)
+    print(f"shared state stand-in listening on {host}:{port}")
+    async with server:
+        await server.serve_forever()
+
+
+def main(argv=None) -> int:
+    ap = argparse.ArgumentParser(description="Local Redis-protocol stand-in for SHARED_STATE_URL=redis://…")
+    sub = ap.add_subparsers(dest="cmd", required=True)
+    serve = sub.add_parser("serve")
+    serve.add_argument("--host", default="127.0.0.1")
+    serve.add_argument("--port", type=int, default=6380)
+    args = ap.parse_args(argv)
+    try:
+        asyncio.run(_serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
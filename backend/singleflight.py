@@ -0,0 +1,107 @@
+"""Single-flight coalescing of identical concurrent async streams.
+
+The first caller for a key starts the underlying async iterator in a
+background task (the "flight"); every concurrent caller with the same key
+subscribes to that flight and receives all items from the beginning, followed
+by new items as they arrive. Errors raised by the source are re-raised in
+every subscriber. When the last subscriber goes away before the source has
+finished, the flight is cancelled so the upstream request is closed.
+"""
+import asyncio
+import hashlib
+import json
+import logging
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional
+
+from . import metrics
+
+logger = logging.getLogger("singleflight")
+
+
+def fingerprint(*parts: Any) -> str:
+    """Stable hash of JSON-serialisable request parts (dict keys are sorted)."""
+    raw = json.dumps(parts, sort_keys=True, ensure_ascii=False, separators=(",", ":"), default=str)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class _Flight:
+    __slots__ = ("key", "items", "done", "error", "subscribers", "task", "_changed", "_group")
+
+    def __init__(self, key: str, group: "SingleFlight"):
+        self.key = key
+        self.items: List[Any] = []
+        self.done = False
+        self.error: Optional[BaseException] = None
+        self.subscribers = 0
+        self.task: Optional[asyncio.Task] = None
+        self._changed = asyncio.Event()
+        self._group = group
+
+    def _notify(self) -> None:
+        changed, self._changed = self._changed, asyncio.Event()
+        changed.set()
+
+    async def run(self, source: AsyncIterator[Any]) -> None:
+        try:
+            async for item in source:
+                self.items.append(item)
+                self._notify()
+        except asyncio.CancelledError:
+            self.error = asyncio.CancelledError()
+            raise
+        except BaseException as e:  # re-raised in every subscriber
+            self.error = e
+        finally:
+            self.done = True
+            self._group._forget(self)
+            self._notify()
+            aclose = getattr(source, "aclose", None)
+            if aclose is not None:
+                await aclose()
+
+    async def subscribe(self) -> AsyncIterator[Any]:
+        self.subscribers += 1
+        i = 0
+        try:
+            while True:
+                while i < len(self.items):
+                    yield self.items[i]
+                    i += 1
+                if self.done:
+                    if self.error is not None:
+                        raise self.error
+                    return
+                await self._changed.wait()
+        finally:
+            self.subscribers -= 1
+            if self.subscribers == 0 and not self.done and self.task is not None:
+                # 所有等待方都已离开：取消上游请求
+                self.task.cancel()
+                self._group._forget(self)
+
+
+class SingleFlight:
+    """Registry of in-progress flights, keyed by request fingerprint."""
+
+    def __init__(self, name: str):
+        self.name = name
+        self._flights: Dict[str, _Flight] = {}
+
+    def stream(self, key: str, factory: Callable[[], AsyncIterator[Any]]) -> AsyncIterator[Any]:
+        """Subscribe to the flight for `key`, starting factory() if none is running."""
+        flight = self._flights.get(key)
+        if flight is None or flight.done:
+            flight = _Flight(key, self)
+            self._flights[key] = flight
+            flight.task = asyncio.get_running_loop().create_task(flight.run(factory()))
+            metrics.inc("singleflight_leaders_total", group=self.name)
+        else:
+            metrics.inc("singleflight_coalesced_total", group=self.name)
+        return flight.subscribe()
+
+    def in_flight(self) -> int:
+        return len(self._flights)
+
+    def _forget(self, flight: _Flight) -> None:
+        if self._flights.get(flight.key) is flight:
+            del self._flights[flight.key]
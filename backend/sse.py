@@ -0,0 +1,124 @@
+"""Incremental Server-Sent Events parser working on raw byte chunks.
+
+Implements the event-stream grammar of the HTML spec: lines end with CRLF,
+LF or CR; `data:` fields of one event are joined with "\\n"; an empty line
+dispatches the event; lines starting with ":" are comments; `event`, `id`
+and `retry` fields are honoured.
+
+The parser keeps one bytearray buffer that is compacted in place, checks
+field prefixes directly on the buffer and only copies the data payloads.
+JSON payloads are decoded from bytes with orjson when it is installed.
+"""
+import json
+from typing import AsyncIterator, List, Optional, Tuple
+
+try:
+    import orjson
+except ImportError:  # optional dependency
+    orjson = None
+
+# (event type, data payload)
+Event = Tuple[str, bytes]
+
+_DATA = b"data:"
+_LF = 0x0A
+_COLON = 0x3A
+_SPACE = 0x20
+
+
+def loads(data: bytes):
+    """json.loads for a UTF-8 payload (orjson when available)."""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+class SSEParser:
+    __slots__ = ("_buf", "_data", "_event", "_cr", "last_event_id", "retry")
+
+    def __init__(self):
+        self._buf = bytearray()
+        self._data: List[bytes] = []
+        self._event: Optional[str] = None
+        self._cr = False  # 上一块以 CR 结尾，可能是被拆开的 CRLF
+        self.last_event_id = ""
+        self.retry: Optional[int] = None
+
+    def feed(self, chunk: bytes) -> List[Event]:
+        """Consume one chunk; returns the events completed by it."""
+        buf = self._buf
+        if self._cr or b"\r" in chunk:
+            self._normalize(chunk)
+        else:
+            buf += chunk
+        events: List[Event] = []
+        pos = 0
+        while True:
+            nl = buf.find(b"\n", pos)
+            if nl < 0:
+                break
+            if nl == pos:
+                self._dispatch(events)
+            elif buf.startswith(_DATA, pos, nl):
+                start = pos + 5
+                if start < nl and buf[start] == _SPACE:
+                    start += 1
+                self._data.append(bytes(buf[start:nl]))
+            elif buf[pos] != _COLON:
+                self._field(bytes(buf[pos:nl]))
+            pos = nl + 1
+        if pos:
+            del buf[:pos]
+        return events
+
+    def flush(self) -> List[Event]:
+        """End of stream: dispatch a final event that lacks its trailing blank line."""
+        events: List[Event] = []
+        if self._buf:
+            tail = self.feed(b"\n")
+            events.extend(tail)
+        self._dispatch(events)
+        return events
+
+    def _normalize(self, chunk: bytes) -> None:
+        buf = self._buf
+        if self._cr:
+            buf += b"\r"
+            self._cr = False
+        buf += chunk
+        if buf.endswith(b"\r"):
+            del buf[-1:]
+            self._cr = True
+        buf[:] = buf.replace(b"\r\n", b"\n").replace(b"\r", b"\n")
+
+    def _field(self, line: bytes) -> None:
+        name, sep, value = line.partition(b":")
+        if sep and value[:1] == b" ":
+            value = value[1:]
+        if name == b"data":
+            self._data.append(value)
+        elif name == b"event":
+            self._event = value.decode("utf-8", "replace")
+        elif name == b"id":
+            if b"\0" not in value:
+                self.last_event_id = value.decode("utf-8", "replace")
+        elif name == b"retry":
+            if value.isdigit():
+                self.retry = int(value)
+
+    def _dispatch(self, events: List[Event]) -> None:
+        data = self._data
+        if data:
+            events.append((self._event or "message", data[0] if len(data) == 1 else b"\n".join(data)))
+            data.clear()
+        self._event = None
+
+
+async def aiter_events(chunks: AsyncIterator[bytes]) -> AsyncIterator[Event]:
+    """Parse an async iterator of byte chunks (e.g. httpx Response.aiter_bytes())."""
+    parser = SSEParser()
+    async for chunk in chunks:
+        for event in parser.feed(chunk):
+            yield event
+    for event in parser.flush():
+        yield event
@@ -0,0 +1,48 @@
+"""Shared fixtures: a fake GAIA server (backend.fake_gaia) on a free local port."""
+import socket
+import threading
+import time
+
+import httpx
+import pytest
+import uvicorn
+
+from backend import fake_gaia
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+@pytest.fixture(scope="session")
+def fake_gaia_url():
+    """Base URL of a fake GAIA running in a background thread for the whole session."""
+    port = _free_port()
+    server = uvicorn.Server(uvicorn.Config(fake_gaia.app, host="127.0.0.1", port=port, log_level="warning"))
+    thread = threading.Thread(target=server.run, name="fake-gaia", daemon=True)
+    thread.start()
+    deadline = time.monotonic() + 10
+    while not server.started:
+        if time.monotonic() > deadline:
+            raise RuntimeError("fake GAIA 未能启动")
+        time.sleep(0.02)
+    yield f"http://127.0.0.1:{port}"
+    server.should_exit = True
+    thread.join(timeout=5)
+
+
+@pytest.fixture
+def fake_gaia_server(fake_gaia_url, monkeypatch):
+    """Fake GAIA with fast, fault-free defaults and cleared counters; gaia_client points at it."""
+    from backend import gaia_client
+
+    httpx.post(f"{fake_gaia_url}/config", json={
+        "base_latency": 0.2, "rag_tokens": 0, "tokens_per_second": 4000, "results": 3, "answer_chars": 200,
+        "rate_limit_rate": 0, "error_rate": 0, "drop_rate": 0, "stall_rate": 0,
+    }).raise_for_status()
+    httpx.post(f"{fake_gaia_url}/stats/reset").raise_for_status()
+    monkeypatch.setattr(gaia_client, "GAIA_BASE_URL_RAW",
+                        fake_gaia_url + "/api/assistants/{assistantid}/chat/completions?format=codegpt&stream=true")
+    return fake_gaia_url
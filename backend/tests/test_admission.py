@@ -0,0 +1,131 @@
+import asyncio
+
+import pytest
+from fastapi import HTTPException
+
+from backend import admission, retry
+from backend.admission import Limiter
+
+
+@pytest.fixture(autouse=True)
+def settings(monkeypatch):
+    monkeypatch.setattr(admission, "ADAPTIVE", True)
+    monkeypatch.setattr(admission, "MIN_CONCURRENCY", 2)
+    monkeypatch.setattr(admission, "LIMIT_BACKOFF", 0.5)
+    monkeypatch.setattr(admission, "LIMIT_COOLDOWN", 2.0)
+    monkeypatch.setattr(admission, "LATENCY_TARGET", 1.0)
+    monkeypatch.setattr(admission, "QUEUE_MAX", 256)
+    monkeypatch.setattr(admission, "QUEUE_TIMEOUT", 5.0)
+    yield
+    assert admission._queued == 0
+
+
+def test_additive_increase_up_to_max():
+    lim = Limiter("t", 10)
+    lim.limit = 4.0
+    lim.feedback(False, 0.1)
+    assert lim.limit == pytest.approx(4.25)
+    for _ in range(1000):
+        lim.feedback(False, 0.1)
+    assert lim.limit == 10.0
+
+
+def test_multiplicative_decrease_once_per_cooldown(monkeypatch):
+    lim = Limiter("t", 16)
+    lim.feedback(True, None)
+    assert lim.limit == 8.0
+    # 冷却期内的第二次限流不再降低
+    lim.feedback(True, None)
+    assert lim.limit == 8.0
+    monkeypatch.setattr(admission, "LIMIT_COOLDOWN", 0.0)
+    lim.feedback(False, 5.0)  # 首 token 超过目标延迟同样算过载
+    assert lim.limit == 4.0
+    for _ in range(5):
+        lim.feedback(True, None)
+    assert lim.limit == 2.0
+
+
+def test_no_feedback_without_adaptive(monkeypatch):
+    monkeypatch.setattr(admission, "ADAPTIVE", False)
+    lim = Limiter("t", 8)
+    lim.feedback(True, None)
+    assert lim.limit == 8.0
+
+
+def test_waiters_are_served_fifo_on_release():
+    async def main():
+        lim = Limiter("t", 1)
+        deadline = retry.Deadline()
+        await lim.acquire(deadline)
+        order = []
+
+        async def waiter(name):
+            await lim.acquire(deadline)
+            order.append(name)
+
+        tasks = [asyncio.ensure_future(waiter(n)) for n in "abc"]
+        await asyncio.sleep(0.01)
+        assert lim.stats()["queued"] == 3
+        for _ in "abc":
+            lim.release()
+            await asyncio.sleep(0.01)
+        await asyncio.gather(*tasks)
+        return order, lim
+
+    order, lim = asyncio.run(main())
+    assert order == list("abc")
+    assert lim.in_use == 1
+
+
+def test_raising_the_limit_wakes_waiters():
+    async def main():
+        lim = Limiter("t", 4)
+        lim.limit = 1.0
+        deadline = retry.Deadline()
+        await lim.acquire(deadline)
+        task = asyncio.ensure_future(lim.acquire(deadline))
+        await asyncio.sleep(0.01)
+        assert not task.done()
+        lim.feedback(False, 0.1)  # 1 -> 2
+        await asyncio.sleep(0.01)
+        assert task.done()
+        return lim
+
+    assert asyncio.run(main()).in_use == 2
+
+
+def test_slot_sheds_with_503_when_queue_is_full(monkeypatch):
+    monkeypatch.setattr(admission, "QUEUE_MAX", 0)
+    monkeypatch.setattr(admission, "_global", Limiter("global", 1))
+    monkeypatch.setattr(admission, "_assistants", {})
+
+    async def main():
+        deadline = retry.Deadline()
+        async with admission.slot("a", deadline):
+            assert admission.load("a") == 1.0
+            with pytest.raises(HTTPException) as exc:
+                async with admission.slot("a", deadline):
+                    pass
+            return exc.value
+
+    err = asyncio.run(main())
+    assert err.status_code == 503
+    assert err.headers["Retry-After"] == str(admission.SHED_RETRY_AFTER)
+    assert admission._global.in_use == 0
+
+
+def test_waiter_times_out(monkeypatch):
+    monkeypatch.setattr(admission, "QUEUE_TIMEOUT", 0.05)
+
+    async def main():
+        lim = Limiter("t", 1)
+        deadline = retry.Deadline()
+        await lim.acquire(deadline)
+        with pytest.raises(admission._Shed) as exc:
+            await lim.acquire(deadline)
+        return exc.value, lim
+
+    err, lim = asyncio.run(main())
+    assert err.reason == "timeout"
+    assert lim.in_use == 1
+    assert not lim._waiters
@@ -0,0 +1,93 @@
+import pytest
+
+from backend import breaker
+from backend.breaker import CLOSED, HALF_OPEN, OPEN, CircuitBreaker
+
+
+@pytest.fixture(autouse=True)
+def settings(monkeypatch):
+    monkeypatch.setattr(breaker, "MIN_CALLS", 4)
+    monkeypatch.setattr(breaker, "FAILURE_RATIO", 0.5)
+    monkeypatch.setattr(breaker, "OPEN_SECONDS", 30.0)
+    monkeypatch.setattr(breaker, "HALF_OPEN_PROBES", 1)
+
+
+def _open(cb: CircuitBreaker) -> None:
+    for _ in range(breaker.MIN_CALLS):
+        assert cb.allow()
+        cb.record(True)
+    assert cb.state == OPEN
+
+
+def _expire(monkeypatch) -> None:
+    monkeypatch.setattr(breaker, "OPEN_SECONDS", 0.0)
+
+
+def test_stays_closed_below_min_calls_or_ratio():
+    cb = CircuitBreaker("a")
+    for _ in range(breaker.MIN_CALLS - 1):
+        cb.record(True)
+    assert cb.state == CLOSED
+    cb = CircuitBreaker("b")
+    for failed in (True, False, False, False, True, False):
+        cb.record(failed)
+    assert cb.state == CLOSED
+
+
+def test_opens_on_failure_ratio_and_rejects():
+    cb = CircuitBreaker("a")
+    _open(cb)
+    assert not cb.allow()
+    assert cb.stats()["state"] == OPEN
+    assert cb.stats()["retry_in"] > 0
+
+
+def test_half_open_probe_success_closes(monkeypatch):
+    cb = CircuitBreaker("a")
+    _open(cb)
+    _expire(monkeypatch)
+    assert cb.allow()
+    assert cb.state == HALF_OPEN
+    # 探测名额已被占用
+    assert not cb.allow()
+    cb.record(False)
+    assert cb.state == CLOSED
+    assert cb.stats()["calls"] == 0
+
+
+def test_half_open_probe_failure_reopens(monkeypatch):
+    cb = CircuitBreaker("a")
+    _open(cb)
+    _expire(monkeypatch)
+    assert cb.allow()
+    monkeypatch.setattr(breaker, "OPEN_SECONDS", 30.0)
+    cb.record(True)
+    assert cb.state == OPEN
+    assert not cb.allow()
+
+
+def test_release_returns_the_probe_without_verdict(monkeypatch):
+    cb = CircuitBreaker("a")
+    _open(cb)
+    _expire(monkeypatch)
+    assert cb.allow()
+    cb.release()
+    assert cb.state == HALF_OPEN
+    assert cb.allow()
+
+
+def test_outcomes_recorded_while_open_are_ignored():
+    cb = CircuitBreaker("a")
+    _open(cb)
+    cb.record(False)
+    assert cb.state == OPEN
+
+
+def test_is_open_reflects_registry(monkeypatch):
+    monkeypatch.setattr(breaker, "ENABLED", True)
+    monkeypatch.setattr(breaker, "_breakers", {})
+    assert not breaker.is_open("x")
+    _open(breaker.get("x"))
+    assert breaker.is_open("x")
+    monkeypatch.setattr(breaker, "ENABLED", False)
+    assert not breaker.is_open("x")
@@ -0,0 +1,72 @@
+"""gaia_client against the fake GAIA: coalescing and early close."""
+import asyncio
+import time
+
+import httpx
+
+from backend import gaia_client, hedge
+from backend.gaia_client import STREAM_RESET
+
+
+async def _drain(stream) -> str:
+    parts = []
+    async for delta in stream:
+        if delta is STREAM_RESET:
+            parts.clear()
+        else:
+            parts.append(delta)
+    return "".join(parts)
+
+
+def _stats(url: str) -> dict:
+    return httpx.get(f"{url}/stats").json()
+
+
+def test_concurrent_identical_streams_share_one_upstream_call(fake_gaia_server, monkeypatch):
+    monkeypatch.setattr(gaia_client, "COALESCE", True)
+    monkeypatch.setattr(hedge, "ENABLED", False)
+
+    async def main():
+        try:
+            streams = [gaia_client.stream_ifu_search("报警", "coalesce-test") for _ in range(10)]
+            return await asyncio.gather(*(_drain(s) for s in streams))
+        finally:
+            await gaia_client.aclose_client()
+
+    answers = asyncio.run(main())
+    assert _stats(fake_gaia_server)["calls"] == 1
+    assert answers[0].startswith('{"results"')
+    assert all(a == answers[0] for a in answers)
+
+
+def test_distinct_streams_are_not_coalesced(fake_gaia_server, monkeypatch):
+    monkeypatch.setattr(gaia_client, "COALESCE", True)
+    monkeypatch.setattr(hedge, "ENABLED", False)
+
+    async def main():
+        try:
+            await asyncio.gather(*(_drain(gaia_client.stream_ifu_search(q, "coalesce-test")) for q in ("报警", "电池")))
+        finally:
+            await gaia_client.aclose_client()
+
+    asyncio.run(main())
+    assert _stats(fake_gaia_server)["calls"] == 2
+
+
+def test_limit_closes_upstream_early(fake_gaia_server, monkeypatch):
+    monkeypatch.setattr(hedge, "ENABLED", False)
+    httpx.post(f"{fake_gaia_server}/config", json={"results": 20, "tokens_per_second": 400}).raise_for_status()
+
+    async def main():
+        try:
+            return await gaia_client.call_ifu_search("报警", "early-close-test", limit=1)
+        finally:
+            await gaia_client.aclose_client()
+
+    result = asyncio.run(main())
+    assert len(result.items) == 1
+    # 服务端在检测到断开后才记录提前关闭
+    deadline = time.monotonic() + 5
+    while _stats(fake_gaia_server)["closed_early"] < 1 and time.monotonic() < deadline:
+        time.sleep(0.05)
+    assert _stats(fake_gaia_server)["closed_early"] == 1
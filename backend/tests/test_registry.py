@@ -0,0 +1,89 @@
+import json
+
+from backend import ifu_registry
+from backend.ifu_registry import Registry, RegistryIndex, _osa_distance
+
+VISTA300 = ("Vista 300", "a-vista", "c-vista")
+VISTA120 = ("Vista 120", "a-vista", "c-vista")
+ATLAN = ("Atlan A100", "a-atlan", "c-atlan")
+ROWS = [
+    ("Vista 300", VISTA300),
+    ("V300", VISTA300),
+    ("Vista 120", VISTA120),
+    ("Atlan A100", ATLAN),
+]
+
+
+def _index(max_edits: int = 1) -> RegistryIndex:
+    return RegistryIndex(ROWS, max_edits=max_edits)
+
+
+def test_exact_ignores_case_and_separators():
+    idx = _index()
+    assert idx.lookup("VISTA-300") == (VISTA300, "exact")
+    assert idx.lookup("v 300") == (VISTA300, "exact")
+    assert idx.lookup("ＶＩＳＴＡ３００") == (VISTA300, "exact")  # 全角（NFKC）
+
+
+def test_prefix_prefers_earliest_row():
+    idx = _index()
+    assert idx.lookup("Vista") == (VISTA300, "prefix")
+    assert idx.lookup("Vista 1") == (VISTA120, "prefix")
+
+
+def test_prefix_from_word_starts():
+    idx = _index()
+    assert idx.lookup("120") == (VISTA120, "prefix")
+    # 字母与数字交界处也是词首
+    assert idx.lookup("A100") == (ATLAN, "prefix")
+    assert idx.lookup("100") == (ATLAN, "prefix")
+
+
+def test_ocr_lookalikes_fold_to_the_model():
+    idx = _index(max_edits=0)
+    assert idx.lookup("Vlsta 3OO") == (VISTA300, "fuzzy")
+    assert idx.lookup("V1STA 3oo") == (VISTA300, "fuzzy")
+
+
+def test_symspell_finds_names_within_max_edits():
+    idx = _index()
+    assert idx.lookup("Vistx 300") == (VISTA300, "fuzzy")     # 替换
+    assert idx.lookup("Vsta 300") == (VISTA300, "fuzzy")      # 删除
+    assert idx.lookup("Vistaa 120") == (VISTA120, "fuzzy")    # 插入
+    assert idx.lookup("Vitsa 300") == (VISTA300, "fuzzy")     # 相邻交换
+    assert idx.lookup("Vxxta 300") is None                   # 超出编辑距离
+    assert _index(max_edits=0).lookup("Vistx 300") is None
+
+
+def test_short_queries_are_not_fuzzy_matched():
+    idx = _index()
+    assert idx.lookup("V30O") == (VISTA300, "fuzzy")  # OCR 归并不受长度限制
+    assert idx.lookup("Vxz") is None
+    assert idx.lookup("") is None
+
+
+def test_osa_distance():
+    assert _osa_distance("vista", "vista", 2) == 0
+    assert _osa_distance("vista", "vitsa", 2) == 1
+    assert _osa_distance("vista", "vsta", 2) == 1
+    assert _osa_distance("vista", "atlan", 2) == 3
+
+
+def test_registry_reloads_changed_file(tmp_path, monkeypatch):
+    path = tmp_path / "models.json"
+    path.write_text(json.dumps({"models": [{"model": "Vista 300", "assistantid": "a1", "aliases": ["V300"]}]}))
+    reg = Registry(str(path), check_interval=0)
+    assert reg.lookup("V300") == (("Vista 300", "a1", ""), "exact")
+    path.write_text(json.dumps({"models": [{"model": "Atlan", "assistantid": "a2", "containerid": "c2"}]}))
+    assert reg.reload()
+    assert reg.lookup("Atlan") == (("Atlan", "a2", "c2"), "exact")
+    assert reg.index.assistant_container("a2") == "c2"
+    # 文件损坏时保留旧索引
+    path.write_text("{not json")
+    assert not reg.reload()
+    assert reg.lookup("Atlan") == (("Atlan", "a2", "c2"), "exact")
+
+
+def test_default_data_file_loads():
+    rows = ifu_registry.load_rows(ifu_registry.MODELS_FILE)
+    assert len(RegistryIndex(rows)) == len(rows) > 0
@@ -0,0 +1,61 @@
+import json
+
+from backend.results import ResultStream, SearchResult
+
+DOC = json.dumps({"results": [
+    {"doc": "a.pdf", "page": 3, "snippet": 'braces } and { "quotes" \\ in text'},
+    {"doc": "b.pdf", "page": 1, "snippet": "nested [1, 2]", "extra": {"k": [1, {"x": 2}]}},
+    {"doc": "c.pdf", "page": 2, "snippet": "说明书"},
+]}, ensure_ascii=False)
+
+
+def _feed_in_chunks(size: int) -> ResultStream:
+    rs = ResultStream()
+    for i in range(0, len(DOC), size):
+        rs.feed(DOC[i:i + size])
+    return rs
+
+
+def test_items_are_extracted_for_any_chunking():
+    for size in (1, 2, 3, 7, 64, len(DOC)):
+        rs = _feed_in_chunks(size)
+        assert [it.doc for it in rs.items] == ["a.pdf", "b.pdf", "c.pdf"], size
+        assert rs.done
+        assert rs.items[0].snippet == 'braces } and { "quotes" \\ in text'
+
+
+def test_items_are_returned_as_soon_as_they_close():
+    rs = ResultStream()
+    cut = DOC.index('{"doc": "b.pdf"')
+    first = rs.feed(DOC[:cut])
+    assert [it.doc for it in first] == ["a.pdf"]
+    assert not rs.done
+    rest = rs.feed(DOC[cut:])
+    assert [it.doc for it in rest] == ["b.pdf", "c.pdf"]
+
+
+def test_result_limit_is_sorted_by_page():
+    rs = _feed_in_chunks(5)
+    assert [it.doc for it in rs.result(2).items] == ["b.pdf", "a.pdf"]
+    assert [it.page for it in rs.result().items] == [1, 2, 3]
+
+
+def test_reset_starts_over():
+    rs = ResultStream()
+    rs.feed(DOC[:40])
+    rs.reset()
+    rs.feed(DOC)
+    assert len(rs.items) == 3
+
+
+def test_text_after_the_array_is_ignored():
+    rs = ResultStream()
+    rs.feed(DOC)
+    assert rs.feed('{"doc": "late.pdf"}') == []
+    assert len(rs.items) == 3
+
+
+def test_search_result_parse_matches_stream():
+    parsed = SearchResult.parse(DOC)
+    assert [it.doc for it in parsed.items] == [it.doc for it in _feed_in_chunks(4).result().items]
+    assert SearchResult.parse("free text answer").items is None
@@ -0,0 +1,140 @@
+import asyncio
+
+from backend.gaia_client import _collect
+from backend.singleflight import SingleFlight
+
+
+class Source:
+    """Async iterator yielding `items`, each after `delay` seconds; records whether it was closed."""
+
+    def __init__(self, items, delay: float = 0.0):
+        self.items = list(items)
+        self.delay = delay
+        self.yielded = 0
+        self.closed = False
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self.yielded >= len(self.items):
+            raise StopAsyncIteration
+        await asyncio.sleep(self.delay)
+        item = self.items[self.yielded]
+        self.yielded += 1
+        return item
+
+    async def aclose(self):
+        self.closed = True
+
+
+async def _take(stream, n=None):
+    out = []
+    async for item in stream:
+        out.append(item)
+        if n is not None and len(out) >= n:
+            break
+    await stream.aclose()
+    return out
+
+
+def test_subscribers_share_one_source():
+    async def main():
+        group = SingleFlight("test")
+        sources = []
+
+        def factory():
+            sources.append(Source("abc", delay=0.01))
+            return sources[-1]
+
+        results = await asyncio.gather(*(_take(group.stream("k", factory)) for _ in range(5)))
+        return results, sources, group
+
+    results, sources, group = asyncio.run(main())
+    assert len(sources) == 1
+    assert results == [list("abc")] * 5
+    assert group.in_flight() == 0
+
+
+def test_late_subscriber_gets_items_from_the_beginning():
+    async def main():
+        group = SingleFlight("test")
+        source = Source("abcd", delay=0.02)
+        first = asyncio.ensure_future(_take(group.stream("k", lambda: source)))
+        await asyncio.sleep(0.05)
+        late = await _take(group.stream("k", lambda: Source("zz")))
+        return await first, late
+
+    first, late = asyncio.run(main())
+    assert first == late == list("abcd")
+
+
+def test_last_subscriber_leaving_cancels_the_flight():
+    async def main():
+        group = SingleFlight("test")
+        source = Source("abcdefgh", delay=0.01)
+        got = await _take(group.stream("k", lambda: source), n=2)
+        await asyncio.sleep(0.05)
+        return got, source, group
+
+    got, source, group = asyncio.run(main())
+    assert got == list("ab")
+    assert source.closed
+    assert source.yielded < len(source.items)
+    assert group.in_flight() == 0
+
+
+def test_flight_continues_while_another_subscriber_remains():
+    async def main():
+        group = SingleFlight("test")
+        source = Source("abcdef", delay=0.01)
+        early, full = await asyncio.gather(
+            _take(group.stream("k", lambda: source), n=1),
+            _take(group.stream("k", lambda: source)),
+        )
+        return early, full, source
+
+    early, full, source = asyncio.run(main())
+    assert early == ["a"]
+    assert full == list("abcdef")
+    assert source.yielded == len(source.items)
+
+
+def test_source_error_reaches_every_subscriber():
+    class Boom(Exception):
+        pass
+
+    async def failing():
+        yield "a"
+        await asyncio.sleep(0.01)
+        raise Boom()
+
+    async def main():
+        group = SingleFlight("test")
+        streams = [group.stream("k", failing) for _ in range(3)]
+        return await asyncio.gather(*(_take(s) for s in streams), return_exceptions=True)
+
+    results = asyncio.run(main())
+    assert all(isinstance(r, Boom) for r in results)
+
+
+def test_collect_closes_the_stream_once_limit_items_arrived():
+    doc = '{"results":[{"doc":"a.pdf","page":2,"snippet":"x"},{"doc":"b.pdf","page":1,"snippet":"y"},'
+    rest = '{"doc":"c.pdf","page":3,"snippet":"z"}]}'
+    deltas = [doc[i:i + 7] for i in range(0, len(doc), 7)] + [rest]
+
+    consumed = []
+
+    async def stream():
+        try:
+            for d in deltas:
+                consumed.append(d)
+                yield d
+        finally:
+            consumed.append("closed")
+
+    result = asyncio.run(_collect(stream(), limit=2))
+    assert [it.doc for it in result.items] == ["b.pdf", "a.pdf"]
+    # 收满后立即关闭：最后一段不再读取
+    assert rest not in consumed
+    assert consumed[-1] == "closed"
@@ -0,0 +1,65 @@
+import asyncio
+
+from backend.sse import SSEParser, aiter_events
+
+STREAM = (
+    b": keep-alive comment\r\n"
+    b"event: delta\r\n"
+    b"id: 7\r\n"
+    b"retry: 1500\r\n"
+    b"data: {\"a\": 1}\r\n"
+    b"\r\n"
+    b"data:first\n"
+    b"data: second\n"
+    b"\n"
+    b"data: [DONE]\r\r"
+)
+EXPECTED = [("delta", b'{"a": 1}'), ("message", b"first\nsecond"), ("message", b"[DONE]")]
+
+
+def _parse_in_chunks(size: int):
+    parser = SSEParser()
+    events = []
+    for i in range(0, len(STREAM), size):
+        events.extend(parser.feed(STREAM[i:i + size]))
+    events.extend(parser.flush())
+    return parser, events
+
+
+def test_events_for_any_chunking():
+    # 单字节切分会把 CRLF 拆到两块里
+    for size in (1, 2, 3, 5, 16, len(STREAM)):
+        parser, events = _parse_in_chunks(size)
+        assert events == EXPECTED, size
+        assert parser.last_event_id == "7"
+        assert parser.retry == 1500
+
+
+def test_flush_dispatches_unterminated_event():
+    parser = SSEParser()
+    assert parser.feed(b"data: tail") == []
+    assert parser.flush() == [("message", b"tail")]
+    assert parser.flush() == []
+
+
+def test_lines_without_data_dispatch_nothing():
+    parser = SSEParser()
+    assert parser.feed(b"event: ping\n\n: comment\n\nid: 1\n\n") == []
+
+
+def test_invalid_fields_are_ignored():
+    parser = SSEParser()
+    parser.feed(b"retry: soon\nid: a\0b\nunknown: x\ndata\n\n")
+    assert parser.retry is None
+    assert parser.last_event_id == ""
+
+
+def test_aiter_events():
+    async def chunks():
+        for i in range(0, len(STREAM), 4):
+            yield STREAM[i:i + 4]
+
+    async def main():
+        return [e async for e in aiter_events(chunks())]
+
+    assert asyncio.run(main()) == EXPECTED
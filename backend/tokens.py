@@ -0,0 +1,240 @@
+"""Token counting and per-assistant session token budgets for GAIA calls.
+
+count_tokens() uses a local BPE tokenizer (tiktoken, encoding GAIA_TOKENIZER)
+when the optional package and its encoding file are available, otherwise a
+script-aware estimate: one token per CJK character, about four characters
+per token for everything else. Results are memoized, since the same system
+prompts and keywords are counted over and over.
+
+SessionBudget tracks the tokens spent in each assistant's logical session
+(identified by the X-Session-Id header). Prompt tokens are reserved from an
+estimate before the call and replaced by the upstream `usage` numbers when
+the response reports them. When the next call would not fit, the session is
+rolled: a new session id and a zeroed counter. The pooled HTTP connections
+are left alone.
+
+With a shared state backend (SHARED_STATE_URL, see shared_state), session ids
+and counters live there, so all workers spend one budget per assistant and
+roll to the same new session. If the backend fails, a call is accounted in
+this process only. Async callers use areserve() and settle(wait=False), which
+keep the backend's blocking I/O off the event loop.
+"""
+import asyncio
+import logging
+import os
+import re
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from typing import Dict, Optional
+
+from . import metrics, shared_state
+
+logger = logging.getLogger("tokens")
+
+TOKENIZER = os.getenv("GAIA_TOKENIZER", "o200k_base")
+TOKEN_CACHE_SIZE = int(os.getenv("GAIA_TOKEN_CACHE_SIZE", "4096"))
+# 每条消息的格式开销（role、分隔符等）
+MESSAGE_OVERHEAD = 4
+# 共享状态中会话键的保留时间（闲置超过即重新开始）
+SHARED_SESSION_TTL = 24 * 3600
+
+# settle(wait=False) 的共享状态写入（单线程，按提交顺序执行）
+_sync_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="budget-sync")
+
+TOKEN_BUCKETS = (16, 64, 256, 1024, 2048, 4096, 8192, 16384, 32768, 65536, 131072)
+metrics.register_histogram("gaia_tokens_per_call", TOKEN_BUCKETS)
+
+_CJK_RE = re.compile("[\u3000-\u303f\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff\uac00-\ud7af\uff00-\uffef]")
+
+_encoding = None
+_encoding_loaded = False
+_encoding_lock = threading.Lock()
+
+
+def _get_encoding():
+    global _encoding, _encoding_loaded
+    if not _encoding_loaded:
+        with _encoding_lock:
+            if not _encoding_loaded:
+                try:
+                    import tiktoken  # optional dependency
+                    _encoding = tiktoken.get_encoding(TOKENIZER)
+                except Exception as e:
+                    logger.info("tiktoken 不可用（%s），使用估算方式计数 token。", e)
+                    _encoding = None
+                _encoding_loaded = True
+    return _encoding
+
+
+def _estimate(text: str) -> int:
+    cjk = len(_CJK_RE.findall(text))
+    other = len(text) - cjk
+    return cjk + (other + 3) // 4
+
+
+@lru_cache(maxsize=TOKEN_CACHE_SIZE)
+def _count(text: str) -> int:
+    enc = _get_encoding()
+    if enc is not None:
+        return len(enc.encode(text, disallowed_special=()))
+    return _estimate(text)
+
+
+def count_tokens(text: str) -> int:
+    """Number of tokens in `text` (0 for empty text)."""
+    if not text:
+        return 0
+    return max(_count(text), 1)
+
+
+def count_messages(messages) -> int:
+    """Prompt tokens of a chat `messages` list."""
+    return sum(count_tokens(str(m.get("content") or "")) + MESSAGE_OVERHEAD for m in messages or ())
+
+
+class _Session:
+    __slots__ = ("session_id", "used", "rolls")
+
+    def __init__(self, session_id: str):
+        self.session_id = session_id
+        self.used = 0
+        self.rolls = 0
+
+
+class SessionBudget:
+    """Per-assistant token counters with session rollover (thread-safe)."""
+
+    def __init__(self, limit: int, max_response_tokens: int, initial_session_id: Optional[str] = None,
+                 state: Optional[shared_state.SharedState] = None):
+        self.limit = limit
+        self.max_response_tokens = max_response_tokens
+        self._initial_session_id = initial_session_id
+        self._state = state if state is not None and state.shared else None
+        self._lock = threading.Lock()
+        self._sessions: Dict[str, _Session] = {}
+        # 实际回答长度的滑动平均，用于预估下一次调用的输出 token，而不是按 max_tokens 上限预留
+        self._expected_completion = min(1024.0, float(max_response_tokens))
+
+    def _session(self, assistantid: str) -> _Session:
+        s = self._sessions.get(assistantid)
+        if s is None:
+            s = _Session(self._initial_session_id or uuid.uuid4().hex)
+            self._sessions[assistantid] = s
+        return s
+
+    def reserve(self, assistantid: Optional[str], prompt_tokens: int) -> str:
+        """Reserve `prompt_tokens` for one call; returns the session id to send."""
+        key = assistantid or ""
+        if self._state is not None:
+            try:
+                return self._reserve_shared(key, prompt_tokens)
+            except shared_state.SharedStateError as e:
+                logger.log(shared_state.log_level(e), "共享状态不可用，本次调用的 token 仅在本进程计数: %s", e)
+        with self._lock:
+            s = self._session(key)
+            expected = min(self._expected_completion, self.max_response_tokens)
+            if s.used and s.used + prompt_tokens + expected >= self.limit:
+                logger.info("Token budget of assistant %s reached (%d used), rolling session.", key, s.used)
+                s.session_id = uuid.uuid4().hex
+                s.used = 0
+                s.rolls += 1
+                metrics.inc("gaia_session_rolls_total")
+            s.used += prompt_tokens
+            return s.session_id
+
+    async def areserve(self, assistantid: Optional[str], prompt_tokens: int) -> str:
+        """reserve() for the event loop: with shared state it runs in a worker thread."""
+        if self._state is None:
+            return self.reserve(assistantid, prompt_tokens)
+        return await asyncio.to_thread(self.reserve, assistantid, prompt_tokens)
+
+    async def astats(self) -> dict:
+        """stats() for the event loop: with shared state it runs in a worker thread."""
+        if self._state is None:
+            return self.stats()
+        return await asyncio.to_thread(self.stats)
+
+    def _reserve_shared(self, key: str, prompt_tokens: int) -> str:
+        st = self._state
+        session_key = f"budget:{key}:session"
+        sid = st.get(session_key)
+        if sid is None:
+            st.set(session_key, self._initial_session_id or uuid.uuid4().hex, ttl=SHARED_SESSION_TTL, nx=True)
+            sid = st.get(session_key) or uuid.uuid4().hex
+        used = st.incr(f"budget:{key}:used:{sid}", prompt_tokens, ttl=SHARED_SESSION_TTL)
+        expected = min(self._expected_completion, self.max_response_tokens)
+        if used > prompt_tokens and used + expected >= self.limit:
+            # 只有一个 worker 能写入下一个会话 id，其余 worker 读取并跟随
+            st.incr(f"budget:{key}:used:{sid}", -prompt_tokens)
+            rolled = st.set(f"budget:{key}:next:{sid}", uuid.uuid4().hex, ttl=SHARED_SESSION_TTL, nx=True)
+            old, sid = sid, st.get(f"budget:{key}:next:{sid}") or uuid.uuid4().hex
+            st.set(session_key, sid, ttl=SHARED_SESSION_TTL)
+            used = st.incr(f"budget:{key}:used:{sid}", prompt_tokens, ttl=SHARED_SESSION_TTL)
+            if rolled:
+                logger.info("Token budget of assistant %s reached (session %s), rolling session.", key, old)
+                metrics.inc("gaia_session_rolls_total")
+                st.incr(f"budget:{key}:rolls")
+        with self._lock:
+            # 本进程的视图，仅用于 stats()
+            s = self._session(key)
+            s.session_id, s.used = sid, used
+        return sid
+
+    def settle(self, assistantid: Optional[str], session_id: str, estimated_prompt: int,
+               prompt_tokens: int, completion_tokens: int, wait: bool = True) -> None:
+        """Book the actual usage of a finished call (prompt_tokens=0 keeps the estimate).
+
+        wait=False hands the shared-state write to a background thread (for callers on the event loop).
+        """
+        key = assistantid or ""
+        delta = completion_tokens + ((prompt_tokens - estimated_prompt) if prompt_tokens else 0)
+        if self._state is not None and delta:
+            if wait:
+                self._sync_used(key, session_id, delta)
+            else:
+                _sync_executor.submit(self._sync_used, key, session_id, delta)
+        with self._lock:
+            s = self._sessions.get(key)
+            if s is not None and s.session_id == session_id:
+                s.used = max(0, s.used + delta)
+            if completion_tokens:
+                self._expected_completion += 0.2 * (completion_tokens - self._expected_completion)
+        metrics.observe("gaia_tokens_per_call", prompt_tokens or estimated_prompt, kind="prompt")
+        metrics.observe("gaia_tokens_per_call", completion_tokens, kind="completion")
+        ctx = metrics.context_labels()
+        metrics.inc("gaia_tokens_total", prompt_tokens or estimated_prompt, kind="prompt", **ctx)
+        metrics.inc("gaia_tokens_total", completion_tokens, kind="completion", **ctx)
+
+    def _sync_used(self, key: str, session_id: str, delta: int) -> None:
+        try:
+            self._state.incr(f"budget:{key}:used:{session_id}", delta, ttl=SHARED_SESSION_TTL)
+        except shared_state.SharedStateError as e:
+            logger.log(shared_state.log_level(e), "共享状态不可用，token 用量未同步: %s", e)
+
+    def stats(self) -> dict:
+        if self._state is not None:
+            # 其他 worker 可能已切换会话：以共享状态为准
+            with self._lock:
+                sessions = list(self._sessions.items())
+            for key, s in sessions:
+                try:
+                    sid = self._state.get(f"budget:{key}:session") or s.session_id
+                    used = self._state.get(f"budget:{key}:used:{sid}")
+                    rolls = self._state.get(f"budget:{key}:rolls")
+                except shared_state.SharedStateError:
+                    break
+                with self._lock:
+                    s.session_id, s.used, s.rolls = sid, int(used or 0), int(rolls or 0)
+        with self._lock:
+            return {
+                "limit": self.limit,
+                "shared": self._state is not None,
+                "expected_completion": round(self._expected_completion, 1),
+                "tokenizer": TOKENIZER if _get_encoding() is not None else "estimate",
+                "sessions": {
+                    k: {"session_id": s.session_id, "used": s.used, "rolls": s.rolls}
+                    for k, s in self._sessions.items()
+                },
+            }
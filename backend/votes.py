@@ -0,0 +1,292 @@
+"""Vote store for the 👍/👎 feedback buttons.
+
+Votes are counted per (assistantid, answerid) so feedback can be attributed to
+an assistant and to one answer; both are optional ("" when the client does
+not send them). Totals are sums over those rows.
+
+- Writes only bump in-memory deltas. A background thread adds them to SQLite
+  (WAL mode) in one transaction every IFU_VOTES_FLUSH_INTERVAL seconds, or
+  as soon as IFU_VOTES_FLUSH_MAX votes are pending. The UPSERT adds to the
+  stored counters, so several uvicorn workers sharing the file never lose
+  each other's votes.
+- Pending deltas stay visible until their transaction has committed; the
+  flush then moves them into the committed totals in one step, so a vote is
+  never missing from (or counted twice in) the totals while it is written.
+- Reads never aggregate the table per request. Committed totals are kept per
+  filter (all / one assistant / one answer), summed once when a filter is
+  first asked for and then updated by every flush. The caller's own pending
+  votes are added on top, so a voter sees the click immediately. Votes from
+  other workers show up when the flush thread re-reads the cached totals,
+  every IFU_VOTES_REFRESH_INTERVAL seconds.
+
+The legacy votes.json totals are imported once into an empty database.
+"""
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+from . import metrics
+
+logger = logging.getLogger("votes")
+
+VOTES_DB_PATH = os.getenv("IFU_VOTES_DB", str(Path(__file__).with_name("votes.db")))
+FLUSH_INTERVAL = float(os.getenv("IFU_VOTES_FLUSH_INTERVAL", "1.0"))
+FLUSH_MAX = int(os.getenv("IFU_VOTES_FLUSH_MAX", "100"))
+REFRESH_INTERVAL = float(os.getenv("IFU_VOTES_REFRESH_INTERVAL", "5.0"))
+MAX_TOTALS = 1024  # 缓存的过滤条件上限
+LEGACY_FILE = Path(__file__).with_name("votes.json")
+
+VoteKey = Tuple[str, str]  # (assistantid, answerid)
+FilterKey = Tuple[Optional[str], Optional[str]]  # None = 不过滤
+
+
+class VoteStore:
+    """Batched vote counters on SQLite (thread-safe, multi-process safe)."""
+
+    def __init__(self, path: str = VOTES_DB_PATH, flush_interval: float = FLUSH_INTERVAL, flush_max: int = FLUSH_MAX):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.flush_max = max(1, flush_max)
+        self._lock = threading.Lock()  # 保护 _pending 和 _totals
+        self._write_lock = threading.Lock()  # 串行化写事务、首次汇总和刷新
+        self._read_lock = threading.Lock()
+        self._pending: Dict[VoteKey, List[int]] = {}
+        self._pending_count = 0
+        self._totals: "OrderedDict[FilterKey, List[int]]" = OrderedDict()  # 已提交的合计
+        self._refreshed = time.monotonic()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._writer = self._connect()
+        self._writer.execute(
+            "CREATE TABLE IF NOT EXISTS votes ("
+            " assistantid TEXT NOT NULL, answerid TEXT NOT NULL,"
+            " up INTEGER NOT NULL DEFAULT 0, down INTEGER NOT NULL DEFAULT 0,"
+            " PRIMARY KEY (assistantid, answerid))"
+        )
+        self._import_legacy()
+        self._reader = self._connect()
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None, timeout=10)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def _import_legacy(self) -> None:
+        if not LEGACY_FILE.exists():
+            return
+        try:
+            data = json.loads(LEGACY_FILE.read_text(encoding="utf-8"))
+            up, down = int(data.get("up", 0)), int(data.get("down", 0))
+        except Exception as e:
+            logger.warning("votes.json 无法读取，跳过导入: %s", e)
+            return
+        with self._write_lock:
+            # 只在空库时导入一次（多个 worker 同时启动也只会有一个成功）
+            self._writer.execute(
+                "INSERT INTO votes(assistantid, answerid, up, down)"
+                " SELECT '', '', ?, ? WHERE NOT EXISTS (SELECT 1 FROM votes)",
+                (up, down),
+            )
+
+    def add(self, vote: str, assistantid: str = "", answerid: str = "") -> None:
+        """Count one vote ("up" or "down"); persisted by the next flush."""
+        key = (assistantid or "", answerid or "")
+        with self._lock:
+            delta = self._pending.get(key)
+            if delta is None:
+                delta = self._pending[key] = [0, 0]
+            delta[0 if vote == "up" else 1] += 1
+            self._pending_count += 1
+            full = self._pending_count >= self.flush_max
+        self._ensure_thread()
+        if full:
+            self._wake.set()
+
+    def counts(self, assistantid: Optional[str] = None, answerid: Optional[str] = None) -> Tuple[int, int]:
+        """(up, down) over all rows matching the given filters, pending votes included."""
+        fkey = (assistantid, answerid)
+        with self._lock:
+            cached = fkey in self._totals
+        if not cached:
+            # 首次查询该过滤条件：汇总一次。持有 _write_lock，避免与 flush 交错而漏算/重算
+            with self._write_lock:
+                with self._lock:
+                    cached = fkey in self._totals
+                if not cached:
+                    up, down = self._sum(assistantid, answerid)
+                    with self._lock:
+                        self._remember(fkey, [up, down])
+        self._ensure_thread()
+        with self._lock:
+            total = self._totals.get(fkey)
+            if total is None:  # 刚被挤出缓存（过滤条件极多时）
+                total = [0, 0]
+                exact = False
+            else:
+                self._totals.move_to_end(fkey)
+                exact = True
+            up, down = total
+            for (aid, ans), (u, d) in self._pending.items():
+                if self._matches(fkey, aid, ans):
+                    up += u
+                    down += d
+        if not exact:
+            u, d = self._sum(assistantid, answerid)
+            up, down = up + u, down + d
+        return up, down
+
+    def _sum(self, assistantid: Optional[str], answerid: Optional[str]) -> Tuple[int, int]:
+        where, args = self._filter(assistantid, answerid)
+        with self._read_lock:
+            row = self._reader.execute(
+                f"SELECT COALESCE(SUM(up), 0), COALESCE(SUM(down), 0) FROM votes{where}", args
+            ).fetchone()
+        return int(row[0]), int(row[1])
+
+    def _remember(self, fkey: FilterKey, total: List[int]) -> None:
+        # 调用方持有 _lock
+        self._totals[fkey] = total
+        self._totals.move_to_end(fkey)
+        while len(self._totals) > MAX_TOTALS:
+            self._totals.popitem(last=False)
+
+    @staticmethod
+    def _matches(fkey: FilterKey, aid: str, ans: str) -> bool:
+        return (fkey[0] is None or aid == fkey[0]) and (fkey[1] is None or ans == fkey[1])
+
+    def breakdown(self, assistantid: Optional[str] = None) -> List[dict]:
+        """Flushed per-answer counters, most voted first."""
+        where, args = self._filter(assistantid, None)
+        with self._read_lock:
+            rows = self._reader.execute(
+                f"SELECT assistantid, answerid, up, down FROM votes{where} ORDER BY up + down DESC", args
+            ).fetchall()
+        return [{"assistantid": r[0], "answerid": r[1], "up": r[2], "down": r[3]} for r in rows]
+
+    @staticmethod
+    def _filter(assistantid: Optional[str], answerid: Optional[str]) -> Tuple[str, tuple]:
+        clauses, args = [], []
+        if assistantid is not None:
+            clauses.append("assistantid = ?")
+            args.append(assistantid)
+        if answerid is not None:
+            clauses.append("answerid = ?")
+            args.append(answerid)
+        return (" WHERE " + " AND ".join(clauses) if clauses else ""), tuple(args)
+
+    def flush(self) -> int:
+        """Write pending deltas in one transaction; returns the number of votes written.
+
+        The deltas stay in _pending (and in counts()) until COMMIT has returned;
+        only then are they subtracted and added to the committed totals.
+        """
+        with self._write_lock:
+            return self._flush()
+
+    def _flush(self) -> int:
+        with self._lock:
+            snapshot = {key: (u, d) for key, (u, d) in self._pending.items()}
+        if not snapshot:
+            return 0
+        rows = [(aid, ans, u, d) for (aid, ans), (u, d) in snapshot.items()]
+        count = sum(u + d for u, d in snapshot.values())
+        try:
+            self._writer.execute("BEGIN IMMEDIATE")
+            try:
+                self._writer.executemany(
+                    "INSERT INTO votes(assistantid, answerid, up, down) VALUES (?, ?, ?, ?)"
+                    " ON CONFLICT(assistantid, answerid) DO UPDATE SET"
+                    " up = up + excluded.up, down = down + excluded.down",
+                    rows,
+                )
+                self._writer.execute("COMMIT")
+            except BaseException:
+                self._writer.execute("ROLLBACK")
+                raise
+        except Exception as e:
+            # 写入失败：增量仍在 _pending 中，下次再试
+            logger.warning("投票写入失败，稍后重试: %s", e)
+            return 0
+        with self._lock:
+            # 已提交：从 _pending 扣除快照（期间新增的票保留），计入已提交合计
+            for (aid, ans), (u, d) in snapshot.items():
+                delta = self._pending[(aid, ans)]
+                delta[0] -= u
+                delta[1] -= d
+                if delta == [0, 0]:
+                    del self._pending[(aid, ans)]
+                for fkey, total in self._totals.items():
+                    if self._matches(fkey, aid, ans):
+                        total[0] += u
+                        total[1] += d
+            self._pending_count = max(0, self._pending_count - count)
+        metrics.inc("votes_flushed_total", count)
+        metrics.inc("votes_flush_batches_total")
+        return count
+
+    def _ensure_thread(self) -> None:
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None and not self._stop.is_set():
+                self._thread = threading.Thread(target=self._run, name="vote-flush", daemon=True)
+                self._thread.start()
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            self.flush()
+            if time.monotonic() - self._refreshed >= REFRESH_INTERVAL:
+                self.refresh()
+
+    def refresh(self) -> None:
+        """Re-read the cached totals from the database (picks up other workers' flushes)."""
+        with self._lock:
+            fkeys = list(self._totals)
+        try:
+            with self._write_lock:  # 与 flush 串行：汇总结果和已扣除的 _pending 一致
+                fresh = [(fkey, self._sum(*fkey)) for fkey in fkeys]
+                with self._lock:
+                    for fkey, (up, down) in fresh:
+                        if fkey in self._totals:
+                            self._totals[fkey] = [up, down]
+        except Exception as e:
+            logger.warning("投票合计刷新失败: %s", e)
+        self._refreshed = time.monotonic()
+
+    def close(self) -> None:
+        """Stop the flush thread and write what is still pending."""
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+            self._thread = None
+        self.flush()
+        self._stop.clear()
+
+
+_store: Optional[VoteStore] = None
+_store_lock = threading.Lock()
+
+
+def get_store() -> VoteStore:
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                _store = VoteStore()
+    return _store
+
+
+def close() -> None:
+    if _store is not None:
+        _store.close()
@@ -94,6 +94,34 @@ function handleHttpNon2xx(res, context) {
   showErrorSuggestHelp(context || '请求失败', msg)
 }
 
+// GET 响应按 URL 记下 ETag 与数据；再次请求带 If-None-Match，后端返回 304 时直接复用上次的数据
+// （wx.request 不像浏览器那样自带 HTTP 缓存）
+const _etagCache = new Map()
+const ETAG_CACHE_MAX = 30
+
+function requestWithEtag(options) {
+  const cached = _etagCache.get(options.url)
+  const header = Object.assign({}, options.header)
+  if (cached) header['If-None-Match'] = cached.etag
+  const success = options.success
+  wx.request(Object.assign({}, options, {
+    header,
+    success: (res) => {
+      if (res.statusCode === 304 && cached) {
+        res = Object.assign({}, res, { statusCode: 200, data: cached.data })
+      } else if (res.statusCode >= 200 && res.statusCode < 300) {
+        const etag = res.header && (res.header.ETag || res.header.Etag || res.header.etag)
+        _etagCache.delete(options.url)
+        if (etag) {
+          _etagCache.set(options.url, { etag, data: res.data })
+          if (_etagCache.size > ETAG_CACHE_MAX) _etagCache.delete(_etagCache.keys().next().value)
+        }
+      }
+      if (success) success(res)
+    }
+  }))
+}
+
 // 格式化文档标题：移除前缀的 containerid（UUID 形式），例如：
 // "e05d7522-891a-416a-8bed-cbefc0c64209_A1xx_..." => "A1xx_..."
 function formatDoc(doc) {
@@ -222,7 +250,7 @@ Page({
         // 若只有型号没有 assistantid，调用后端进行定位
         if (model && !assistantid) {
           wx.showLoading({ title: '正在定位说明书...', mask: true })
-          wx.request({
+          requestWithEtag({
             url: `${baseUrl}/api/get_ifu?model=${encodeURIComponent(model)}`,
             method: 'GET',
             timeout: 35000,
@@ -275,7 +303,7 @@ Page({
 
     const loadingTitle = mode === 'ask' ? '正在向AI提问...' : '正在搜索...'
     wx.showLoading({ title: loadingTitle, mask: true })
-    wx.request({
+    requestWithEtag({
       url,
       method: 'GET',
       timeout: 35000,